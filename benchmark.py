@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+import aiohttp
+
+# Clients connect in waves so the listen backlog is not overrun
+CONNECT_CONCURRENCY = 200
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def percentiles(values):
+    """Summarise a list of latencies in seconds as milliseconds"""
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None, "mean": None}
+    ordered = sorted(values)
+
+    def pick(fraction):
+        return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3)
+    }
+
+def process_usage(pid):
+    """CPU seconds and resident memory of a process, read from /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        with open(f"/proc/{pid}/status") as status_file:
+            rss = next(int(line.split()[1]) * 1024 for line in status_file if line.startswith('VmRSS:'))
+        return cpu_seconds, rss
+    except (OSError, StopIteration, IndexError, ValueError):
+        if pid == os.getpid():
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+        return None, None
+
+class BenchmarkStats:
+    """Latency samples and counters shared by every client"""
+    def __init__(self):
+        self.fanout = []
+        self.rtt = {}
+        self.messages = 0
+        self.bytes = 0
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+
+    def record_rtt(self, request_type, seconds):
+        self.rtt.setdefault(request_type, []).append(seconds)
+        self.requests += 1
+
+class BenchmarkClient:
+    """One WebSocket client: idle subscriber, get_history bursts or a ping storm"""
+    def __init__(self, index, role, args, stats):
+        self.index = index
+        self.role = role
+        self.args = args
+        self.stats = stats
+        self.pending = {}
+        self.request_counter = 0
+        self.window = asyncio.Semaphore(args.ping_window)
+        self.ws = None
+
+    async def connect(self, session, url):
+        self.ws = await session.ws_connect(url, heartbeat=None, max_msg_size=0)
+
+    async def receive_loop(self, measuring):
+        """Read frames, timing broadcasts against their snapshot timestamp and matching responses by id"""
+        async for message in self.ws:
+            received = time.time()
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            self.stats.messages += 1
+            self.stats.bytes += len(message.data)
+            data = json.loads(message.data)
+            request_id = data.get("id")
+            if request_id is not None:
+                sent = self.pending.pop(request_id, None)
+                if sent is not None and sent[0] == 'ping':
+                    self.window.release()
+                if data.get("type") == "error":
+                    # Rate-limited and shed requests are refused early, timing them would flatter the RTT
+                    if data.get("code") in ("rate_limited", "busy"):
+                        self.stats.rejected += 1
+                    else:
+                        self.stats.errors += 1
+                elif sent is not None and measuring():
+                    self.stats.record_rtt(sent[0], time.perf_counter() - sent[1])
+            elif measuring() and data.get("type") in ("sensor_update", "sensor_delta"):
+                # Server and clients share a clock when benchmarking locally
+                self.stats.fanout.append(received - datetime.fromisoformat(data["timestamp"]).timestamp())
+        self.stats.disconnects += 1
+
+    async def send_request(self, request_type, **fields):
+        self.request_counter += 1
+        request_id = f"{self.index}-{self.request_counter}"
+        self.pending[request_id] = (request_type, time.perf_counter())
+        await self.ws.send_str(json.dumps({"type": request_type, "id": request_id, **fields}))
+
+    async def drive(self, deadline):
+        """Generate this client's workload until the deadline"""
+        loop = asyncio.get_running_loop()
+        if self.role == 'history':
+            while loop.time() < deadline:
+                for _ in range(self.args.history_burst):
+                    await self.send_request('get_history', limit=self.args.history_limit)
+                await asyncio.sleep(self.args.history_interval)
+        elif self.role == 'ping':
+            while loop.time() < deadline:
+                # Keep a bounded number of pings in flight
+                try:
+                    await asyncio.wait_for(self.window.acquire(), timeout=max(deadline - loop.time(), 0.01))
+                except asyncio.TimeoutError:
+                    break
+                await self.send_request('ping')
+
+async def wait_for_server(http_url, timeout=30.0):
+    """Poll /health until the server answers"""
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - started < timeout:
+            try:
+                async with session.get(http_url + '/health') as response:
+                    if response.status == 200:
+                        return await response.json()
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {http_url} did not become healthy within {timeout:g}s")
+
+async def start_in_process(args):
+    """Run the simulator on this event loop, sharing the CPU with the clients"""
+    from websocket_app import M300WebSocketSimulator
+    simulator = M300WebSocketSimulator(sample_period=args.sample_period)
+    task = asyncio.create_task(simulator.start_server('127.0.0.1', args.port))
+    return simulator, task
+
+def start_subprocess(args):
+    """Start the simulator as a separate process so its CPU and memory can be measured alone"""
+    env = dict(os.environ, PORT=str(args.port), HOST='127.0.0.1', MODE='production',
+               SAMPLE_PERIOD=str(args.sample_period))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'websocket_app.py')
+    return subprocess.Popen([sys.executable, script], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def assign_roles(args):
+    """Split the client count between idle subscribers, history bursts and ping storms"""
+    history = int(args.clients * args.history_ratio)
+    ping = int(args.clients * args.ping_ratio)
+    return ['history'] * history + ['ping'] * ping + ['idle'] * (args.clients - history - ping)
+
+async def run_benchmark(args):
+    """Connect the clients, drive the workload and return the results dict"""
+    server_process = None
+    simulator = None
+    server_task = None
+    if args.url:
+        ws_url = args.url
+        server_pid = args.server_pid
+    elif args.in_process:
+        simulator, server_task = await start_in_process(args)
+        ws_url = f"ws://127.0.0.1:{args.port}/ws"
+        server_pid = os.getpid()
+    else:
+        server_process = start_subprocess(args)
+        ws_url = f"ws://127.0.0.1:{args.port}/ws"
+        server_pid = server_process.pid
+    http_url = ws_url.replace('ws://', 'http://', 1).replace('wss://', 'https://', 1).rsplit('/', 1)[0]
+
+    try:
+        await wait_for_server(http_url)
+        cpu_idle, rss_idle = process_usage(server_pid) if server_pid else (None, None)
+
+        stats = BenchmarkStats()
+        clients = [BenchmarkClient(index, role, args, stats) for index, role in enumerate(assign_roles(args))]
+        measuring = False
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            print(f"🔌 Connecting {len(clients)} clients to {ws_url}")
+            started = time.perf_counter()
+            gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+            async def connect(client):
+                async with gate:
+                    try:
+                        await client.connect(session, ws_url)
+                    except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                        stats.connect_failures += 1
+
+            await asyncio.gather(*(connect(client) for client in clients))
+            connect_seconds = time.perf_counter() - started
+            connected = [client for client in clients if client.ws is not None]
+            print(f"✅ {len(connected)} connected in {connect_seconds:.2f}s ({stats.connect_failures} failed)")
+
+            receivers = [asyncio.create_task(client.receive_loop(lambda: measuring)) for client in connected]
+            await asyncio.sleep(args.warmup)
+            cpu_start, rss_loaded = process_usage(server_pid) if server_pid else (None, None)
+
+            # Measurement window
+            measuring = True
+            messages_start, bytes_start = stats.messages, stats.bytes
+            loop = asyncio.get_running_loop()
+            window_started = time.perf_counter()
+            print(f"🏁 Measuring for {args.duration:g}s")
+            drivers = [asyncio.create_task(client.drive(loop.time() + args.duration)) for client in connected]
+            await asyncio.sleep(args.duration)
+            measuring = False
+            elapsed = time.perf_counter() - window_started
+            cpu_end, rss_end = process_usage(server_pid) if server_pid else (None, None)
+
+            for task in drivers:
+                task.cancel()
+            dropped = stats.disconnects
+            health = None
+            try:
+                async with session.get(http_url + '/health') as response:
+                    health = await response.json()
+            except aiohttp.ClientError:
+                pass
+            for client in connected:
+                await client.ws.close()
+            for task in receivers:
+                task.cancel()
+            await asyncio.gather(*drivers, *receivers, return_exceptions=True)
+
+        cpu_seconds = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+        memory_per_connection = None
+        if rss_idle is not None and rss_loaded is not None and connected:
+            memory_per_connection = round((rss_loaded - rss_idle) / len(connected))
+
+        return {
+            "meta": {
+                "timestamp": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "target": ws_url,
+                "server": "url" if args.url else "in-process" if args.in_process else "subprocess",
+                "parameters": {
+                    "clients": args.clients,
+                    "duration": args.duration,
+                    "warmup": args.warmup,
+                    "sample_period": args.sample_period,
+                    "history_ratio": args.history_ratio,
+                    "ping_ratio": args.ping_ratio,
+                    "history_burst": args.history_burst,
+                    "history_interval": args.history_interval,
+                    "history_limit": args.history_limit,
+                    "ping_window": args.ping_window
+                }
+            },
+            "connections": {
+                "requested": len(clients),
+                "connected": len(connected),
+                "failed": stats.connect_failures,
+                "dropped": dropped,
+                "connect_seconds": round(connect_seconds, 3),
+                "roles": {role: sum(1 for c in connected if c.role == role) for role in ('idle', 'history', 'ping')}
+            },
+            "fanout_latency_ms": percentiles(stats.fanout),
+            "rtt_ms": {request_type: percentiles(samples) for request_type, samples in stats.rtt.items()},
+            "throughput": {
+                "seconds": round(elapsed, 3),
+                "messages_per_second": round((stats.messages - messages_start) / elapsed, 1),
+                "bytes_per_second": round((stats.bytes - bytes_start) / elapsed, 1),
+                "requests_per_second": round(stats.requests / elapsed, 1),
+                "errors": stats.errors,
+                "rejected": stats.rejected
+            },
+            "server": {
+                "pid": server_pid,
+                "rss_idle_bytes": rss_idle,
+                "rss_loaded_bytes": rss_loaded,
+                "rss_end_bytes": rss_end,
+                "memory_per_connection_bytes": memory_per_connection,
+                "cpu_seconds": round(cpu_seconds, 3) if cpu_seconds is not None else None,
+                "cpu_percent": round(cpu_seconds / elapsed * 100, 1) if cpu_seconds is not None else None,
+                "shares_process_with_clients": bool(args.in_process)
+            },
+            "health": health
+        }
+    finally:
+        if simulator is not None:
+            simulator.running = False
+            await asyncio.gather(server_task, return_exceptions=True)
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the M300 WebSocket simulator")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help="benchmark a running server, e.g. ws://127.0.0.1:8765/ws")
+    target.add_argument('--in-process', action='store_true', help="run the server on the benchmark's event loop")
+    parser.add_argument('--server-pid', type=int, help="pid of the --url server, for CPU and memory figures")
+    parser.add_argument('--port', type=int, default=int(os.environ.get('BENCHMARK_PORT', 18765)))
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30.0, help="measurement window in seconds")
+    parser.add_argument('--warmup', type=float, default=3.0, help="seconds between connecting and measuring")
+    parser.add_argument('--sample-period', type=float, default=1.0)
+    parser.add_argument('--history-ratio', type=float, default=0.1, help="share of clients sending get_history bursts")
+    parser.add_argument('--ping-ratio', type=float, default=0.1, help="share of clients running a ping storm")
+    parser.add_argument('--history-burst', type=int, default=10)
+    parser.add_argument('--history-interval', type=float, default=2.0)
+    parser.add_argument('--history-limit', type=int, default=100)
+    parser.add_argument('--ping-window', type=int, default=4, help="pings in flight per ping client")
+    parser.add_argument('--output', default='benchmark-results.json')
+    return parser.parse_args(argv)
+
+def main():
+    """Run the benchmark and write the results as JSON"""
+    args = parse_args()
+    results = asyncio.run(run_benchmark(args))
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    fanout = results["fanout_latency_ms"]
+    print(f"📊 Fan-out latency p50/p95/p99: {fanout['p50']}/{fanout['p95']}/{fanout['p99']} ms ({fanout['count']} samples)")
+    for request_type, rtt in results["rtt_ms"].items():
+        print(f"📨 {request_type} RTT p50/p95/p99: {rtt['p50']}/{rtt['p95']}/{rtt['p99']} ms ({rtt['count']} requests)")
+    throughput = results["throughput"]
+    print(f"🚀 {throughput['messages_per_second']} msg/s, {throughput['requests_per_second']} req/s")
+    if throughput["rejected"]:
+        print(f"🚦 {throughput['rejected']} requests rejected by server rate limits or load shedding")
+    server = results["server"]
+    if server["memory_per_connection_bytes"] is not None:
+        print(f"💾 ~{server['memory_per_connection_bytes']} bytes per connection, server CPU {server['cpu_percent']}%")
+    print(f"📝 Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,26 @@
 import os
-import threading
-import time
 import socket
 import random
 import json
 import asyncio
-import websockets
+import gzip
+import time
+from websockets.exceptions import ConnectionClosed, InvalidMessage
 import logging
-from datetime import datetime
-from pyModbusTCP.server import ModbusServer
+import math
+import mmap
+import multiprocessing
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from urllib.parse import urlsplit, parse_qs
+from pyModbusTCP.server import ModbusServer, DataBank
 from aiohttp import web, WSMsgType
 import aiohttp_cors
 
@@ -16,312 +28,4075 @@ import aiohttp_cors
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# MessagePack is optional, binary clients fall back to tagged JSON without it
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# NumPy is optional, fleet mode falls back to a flat typed array without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Use orjson for encoding when it is installed, stdlib json otherwise
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    JSON_BACKEND = 'json'
+
+def build_frame(fields, **encoded_fields):
+    """Encode fields as a JSON object, splicing in values that are already encoded"""
+    frame = json_dumps(fields)
+    if not encoded_fields:
+        return frame
+    spliced = ','.join(f'"{key}":{value}' for key, value in encoded_fields.items())
+    if frame == '{}':
+        return '{' + spliced + '}'
+    return frame[:-1] + ',' + spliced + '}'
+
+def add_fields(frame, fields):
+    """Add fields to an already encoded JSON object"""
+    extra = json_dumps(fields)
+    if frame == '{}':
+        return extra
+    return frame[:-1] + ',' + extra[1:]
+
+def frame_size(frame):
+    """Payload bytes of a frame, text frames go out UTF-8 encoded"""
+    if not isinstance(frame, str) or frame.isascii():
+        return len(frame)
+    return len(frame.encode('utf-8'))
+
+# Largest number of requests accepted in one batch envelope
+MAX_BATCH_REQUESTS = 32
+
+# /metrics histogram buckets in seconds, and how often event-loop lag is sampled
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOOP_LAG_INTERVAL = 0.5
+
+# Per-client token buckets: message type -> (tokens per second, burst). A request costs one token
+# plus one per RATE_LIMIT_TOKEN_BYTES of response, so large history reads drain the bucket faster
+RATE_LIMITS = {
+    'default': (20.0, 40.0),
+    'get_history': (2.0, 10.0),
+    'clear_history': (0.1, 2.0),
+    'get_fleet': (1.0, 5.0),
+    'batch': (5.0, 10.0)
+}
+RATE_LIMIT_TOKEN_BYTES = 16384
+
+# Requests that run through the bounded expensive-request pool
+EXPENSIVE_REQUEST_TYPES = frozenset(('get_history', 'clear_history', 'get_fleet'))
+
+# Seconds a client refused at the connection limit is told to wait
+ADMISSION_RETRY_AFTER = 5
+
+# Actuator commands: device -> accepted values, AUTO hands the device back to the simulation
+COMMAND_PUMP_VALUES = {'ON': 'ON', 'START': 'ON', 'TRUE': 'ON', '1': 'ON',
+                       'OFF': 'OFF', 'STOP': 'OFF', 'FALSE': 'OFF', '0': 'OFF'}
+COMMAND_DEVICES = ('PUMP', 'ACTUATOR')
+COMMAND_RELEASE = 'AUTO'
+
+# Overflow policies for the per-client outbound queue
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE, OVERFLOW_DISCONNECT)
+
+# Frame kinds that make up the sensor stream of a delta-mode client
+SNAPSHOT_FRAME_KINDS = ('sensor_update', 'sensor_delta')
+
+def monotonic_to_datetime(timestamp):
+    """Convert a time.monotonic() reading to wall-clock time"""
+    return datetime.now() - timedelta(seconds=time.monotonic() - timestamp)
+
+def decode_message(message):
+    """Decode an inbound frame: text frames are JSON, binary frames a message tag and the message"""
+    if isinstance(message, str):
+        return json.loads(message)
+    tag = message[:1]
+    if tag == bytes((BINARY_TAG_JSON,)):
+        return json.loads(message[1:])
+    if tag == bytes((BINARY_TAG_MSGPACK,)):
+        if msgpack is None:
+            raise ValueError("MessagePack is not installed, send tag 0x11 (JSON) instead")
+        return msgpack.unpackb(message[1:])
+    raise ValueError(f"Unsupported binary frame tag: {'0x' + tag.hex() if tag else 'empty frame'} (expected 0x10 or 0x11)")
+
+def query_flag(query, name):
+    """Return True if a handshake query parameter is set to a truthy value"""
+    value = query.get(name)
+    if isinstance(value, list):
+        value = value[-1] if value else None
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def env_flag(name, default):
+    """Return an environment flag, default when the variable is unset"""
+    if name not in os.environ:
+        return default
+    return query_flag(os.environ, name)
+
+# Channel groups clients can subscribe to, "all" restores the full stream
+CHANNEL_GROUPS = {
+    'modbus': ('pH', 'TSS', 'COD', 'Ammonia', 'Flow_Modbus', 'Pressure'),
+    'digital': ('FLOW', 'ACTUATOR', 'STATUS', 'PUMP', 'ALARM', 'TIMESTAMP'),
+    'alarms': ('ALARM', 'STATUS'),
+    'all': None
+}
+
+# Modbus register map: channel -> (register address, scale), register = round(value * scale)
+# The same words are served as holding registers (read/write) and input registers (read-only)
+MODBUS_REGISTER_MAP = {
+    'pH': (0, 100),
+    'TSS': (10, 10),
+    'COD': (20, 10),
+    'Ammonia': (30, 100),
+    'Flow_Modbus': (40, 10),
+    'Pressure': (50, 100)
+}
+MODBUS_REGISTER_COUNT = max(address for address, _ in MODBUS_REGISTER_MAP.values()) + 1
+MODBUS_CHANNEL_BY_REGISTER = {address: (channel, scale) for channel, (address, scale) in MODBUS_REGISTER_MAP.items()}
+# A written holding register keeps its value until rewritten, writing this hands it back to the simulation
+MODBUS_RELEASE_VALUE = 0xffff
+
+# TCP gateway framing: DIGITAL|FLOW:35.7L/min|...|TS:1674567890 and MODBUS|pH:7.25|...
+GATEWAY_DIGITAL_FIELDS = ('FLOW', 'ACTUATOR', 'STATUS', 'PUMP', 'ALARM')
+GATEWAY_MODBUS_ALIASES = {'Flow': 'Flow_Modbus'}
+GATEWAY_READ_LIMIT = 64 * 1024
+GATEWAY_MAX_BUFFER = 256 * 1024
+GATEWAY_UPLINK_PENDING = 10000
+GATEWAY_RETRY_MIN = 0.5
+GATEWAY_RETRY_MAX = 30.0
+
+# Local snapshot feed between the producer and worker processes
+FEED_MAX_BUFFER = 1024 * 1024
+FEED_RETRY_MIN = 0.5
+FEED_RETRY_MAX = 5.0
+
+# Bounds for the sampling period in seconds
+MIN_SAMPLE_PERIOD = 0.05
+MAX_SAMPLE_PERIOD = 10.0
+
+# permessage-deflate strips this trailer from every compressed message (RFC 7692)
+DEFLATE_TRAILER = b'\x00\x00\xff\xff'
+
+# Payloads above this size are compressed in the default executor
+DEFLATE_EXECUTOR_SIZE = 64 * 1024
+
+class FrameCompressor:
+    """Per-message deflate with a size threshold and a cache for shared broadcast frames"""
+    def __init__(self, threshold=512, level=1):
+        self.threshold = threshold
+        self.level = level
+        self.cache = {}
+        self.raw_frames = 0
+        self.compressed_frames = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def reset(self):
+        """Drop cached frames once a new snapshot replaces the old broadcasts"""
+        self.cache = {}
+
+    def deflate(self, payload, wbits):
+        """Compress one message with a fresh context so it can be sent to any client"""
+        started = time.thread_time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -wbits)
+        compressed = (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)).removesuffix(DEFLATE_TRAILER)
+        self.cpu_seconds += time.thread_time() - started
+        self.compressed_frames += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def shared(self, payload, wbits):
+        """Compress a broadcast frame once per window size and reuse it for every client"""
+        key = (wbits, payload)
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = self.deflate(payload, wbits)
+            self.cache[key] = compressed
+        else:
+            self.cache_hits += 1
+        return compressed
+
+    def stats(self):
+        """Return compression counters"""
+        return {
+            "threshold": self.threshold,
+            "level": self.level,
+            "raw_frames": self.raw_frames,
+            "compressed_frames": self.compressed_frames,
+            "shared_cache_hits": self.cache_hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            "cpu_ms": round(self.cpu_seconds * 1000, 3)
+        }
+
+class Histogram:
+    """Fixed-bucket latency histogram, observing only updates preallocated counters"""
+    def __init__(self, bounds=METRICS_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = array('q', bytes(8 * (len(bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, lines, name, labels=''):
+        """Append Prometheus bucket, sum and count lines"""
+        separator = ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum:.9g}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+
+class Metrics:
+    """Hot-path counters and histograms, all allocated up front"""
+    def __init__(self, message_types):
+        self.tick_seconds = Histogram()
+        self.encode_seconds = Histogram()
+        self.fanout_seconds = Histogram()
+        self.loop_lag_seconds = Histogram()
+        # One histogram per known message type, unknown types share one so labels stay bounded
+        self.handler_seconds = {message_type: Histogram() for message_type in message_types}
+        self.handler_seconds['unknown'] = Histogram()
+        self.send_failures = 0
+        self.response_bytes = 0
+        self.closed_client_bytes = 0
+        self.closed_client_frames = 0
+        self.loop_lag_last = 0.0
+
+class LatencyStats:
+    """Running count, mean and max of a latency in seconds"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def stats(self):
+        """Summary in milliseconds"""
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count * 1000, 3) if self.count else None,
+            "max": round(self.max * 1000, 3),
+            "last": round(self.last * 1000, 3)
+        }
+
+class CommandQueue:
+    """Serialized command queue for one device, commands queued behind a write are coalesced"""
+    def __init__(self, device):
+        self.device = device
+        self.pending = deque()
+        self.worker = None
+        self.applied = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "applied": self.applied,
+            "coalesced": self.coalesced
+        }
+
+class SensorDataBank(DataBank):
+    """Modbus data bank refreshed from each snapshot, reporting client register writes"""
+    def __init__(self, on_write):
+        super().__init__(coils_size=0, d_inputs_size=0,
+                         h_regs_size=MODBUS_REGISTER_COUNT, i_regs_size=MODBUS_REGISTER_COUNT)
+        self.on_write = on_write
+        self.updates = 0
+        self.writes = 0
+        self.clamped = 0
+
+    def publish(self, snapshot):
+        """Write one snapshot into the register block, one atomic update per space"""
+        words = [0] * MODBUS_REGISTER_COUNT
+        for channel, (address, scale) in MODBUS_REGISTER_MAP.items():
+            value = snapshot.get(channel)
+            if isinstance(value, (int, float)):
+                # Registers are unsigned 16-bit, saturate instead of wrapping to a plausible wrong value
+                word = int(round(value * scale))
+                if not 0 <= word <= 0xffff:
+                    word = min(max(word, 0), 0xffff)
+                    self.clamped += 1
+                words[address] = word
+        self.set_holding_registers(0, words)
+        self.set_input_registers(0, words)
+        self.updates += 1
+
+    def on_holding_registers_change(self, address, from_value, to_value, srv_info):
+        """Called from the Modbus server thread when a client writes a holding register"""
+        self.writes += 1
+        if address in MODBUS_CHANNEL_BY_REGISTER:
+            self.on_write(address, to_value)
+
+class MessageError(Exception):
+    """Raised by a message handler to reply with an error message"""
+
+class RequestRejected(MessageError):
+    """Raised when a request is refused to protect the server, with a hint when to retry"""
+    def __init__(self, message, code, retry_after):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Continuously refilled token bucket; the balance may go negative after an expensive request"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1.0):
+        """Take a request's cost once a token is available, returning 0 on success or the seconds
+        until one is. The cost may exceed the balance, later requests then wait it off"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.rate
+        self.tokens -= cost
+        return 0.0
+
+class WebsocketsTransport:
+    """Transport for connections accepted by the websockets library"""
+    name = "WS"
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.remote_address = websocket.remote_address[:2]
+
+        # Handshake query string, e.g. /ws?delta=1
+        request = getattr(websocket, 'request', None)
+        path = getattr(request, 'path', None) or getattr(websocket, 'path', '') or ''
+        self.query = parse_qs(urlsplit(path).query)
+        self.subprotocol = getattr(websocket, 'subprotocol', None)
+        self.last_seen = time.monotonic()  # Last frame or pong received
+
+        # Fleet device stream, e.g. /ws/m300-00042
+        parts = urlsplit(path).path.strip('/').split('/')
+        self.device_id = parts[1] if len(parts) == 2 and parts[0] == 'ws' else None
+
+    async def send(self, frame, shared=False):
+        await self.websocket.send(frame)
+
+    async def close(self):
+        await self.websocket.close()
+
+    async def ping(self):
+        pong = await self.websocket.ping()
+        pong.add_done_callback(self._on_pong)
+
+    def _on_pong(self, pong):
+        if not pong.cancelled() and pong.exception() is None:
+            self.last_seen = time.monotonic()
+
+    async def messages(self):
+        """Yield incoming text messages until the connection closes"""
+        async for message in self.websocket:
+            self.last_seen = time.monotonic()
+            yield message
+
+class AiohttpTransport:
+    """Transport for aiohttp WebSocket responses upgraded from HTTP"""
+    name = "HTTP-WS"
+
+    def __init__(self, ws, request, compressor=None):
+        self.ws = ws
+        self.remote_address = (request.remote, 0)
+        self.query = request.query
+        self.subprotocol = ws.ws_protocol
+        self.device_id = request.match_info.get('device_id')
+        self.last_seen = time.monotonic()  # Last frame or pong received
+
+        # Compress frames ourselves when deflate was negotiated, so small frames can go out
+        # raw and broadcast frames are compressed once for everyone
+        writer = getattr(ws, '_writer', None)
+        self.compressor = compressor
+        self.deflate_wbits = ws.compress if compressor and isinstance(ws.compress, int) else 0
+        if self.deflate_wbits and not hasattr(writer, '_write_websocket_frame'):
+            logger.warning("aiohttp writer does not support pre-compressed frames, using default compression")
+            self.deflate_wbits = 0
+        self.writer = writer
+
+    async def send(self, frame, shared=False):
+        if not self.deflate_wbits:
+            if isinstance(frame, bytes):
+                await self.ws.send_bytes(frame)
+            else:
+                await self.ws.send_str(frame)
+            return
+
+        if isinstance(frame, bytes):
+            payload = frame
+            opcode = WSMsgType.BINARY
+        else:
+            payload = frame.encode('utf-8')
+            opcode = WSMsgType.TEXT
+
+        compressor = self.compressor
+        if len(payload) < compressor.threshold:
+            compressor.raw_frames += 1
+            rsv = 0
+        elif shared:
+            payload = compressor.shared(payload, self.deflate_wbits)
+            rsv = 0x40
+        elif len(payload) > DEFLATE_EXECUTOR_SIZE:
+            payload = await asyncio.get_running_loop().run_in_executor(
+                None, compressor.deflate, payload, self.deflate_wbits)
+            rsv = 0x40
+        else:
+            payload = compressor.deflate(payload, self.deflate_wbits)
+            rsv = 0x40
+
+        writer = self.writer
+        if writer._closing or self.ws.closed:
+            raise ConnectionResetError("Cannot write to closing transport")
+        # RSV1 marks the frame as compressed
+        writer._write_websocket_frame(payload, opcode, rsv)
+
+        # Same flow control as aiohttp's own send_frame
+        if writer._output_size > writer._limit:
+            writer._output_size = 0
+            if writer.protocol._paused:
+                await writer.protocol._drain_helper()
+
+    async def close(self):
+        await self.ws.close()
+
+    async def ping(self):
+        await self.ws.ping()
+
+    async def messages(self):
+        """Yield incoming text and binary messages until the connection closes"""
+        # autoping is off so pongs reach us and count as activity
+        async for msg in self.ws:
+            self.last_seen = time.monotonic()
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                yield msg.data
+            elif msg.type == WSMsgType.PING:
+                await self.ws.pong(msg.data)
+            elif msg.type == WSMsgType.ERROR:
+                logger.error(f"WebSocket error from {self.remote_address[0]}: {self.ws.exception()}")
+                break
+            elif msg.type == WSMsgType.CLOSE:
+                break
+
+class SseTransport:
+    """Transport for Server-Sent Events streams, which only carry frames to the client"""
+    name = "SSE"
+
+    # Last broadcast frame and its event encoding, shared by every stream
+    _shared_frame = None
+    _shared_event = b''
+
+    def __init__(self, response, request):
+        self.response = response
+        self.remote_address = (request.remote, 0)
+        self.query = request.query
+        self.subprotocol = None
+        self.device_id = None
+        self.last_seen = time.monotonic()
+        self.closed = asyncio.Event()
+
+    async def send(self, frame, shared=False):
+        if shared and frame is SseTransport._shared_frame:
+            event = SseTransport._shared_event
+        else:
+            event = b'data: ' + frame.encode('utf-8') + b'\n\n'
+            if shared:
+                SseTransport._shared_frame = frame
+                SseTransport._shared_event = event
+        await self.write(event)
+
+    async def write(self, data):
+        try:
+            await self.response.write(data)
+        except Exception:
+            self.closed.set()
+            raise
+
+    async def ping(self):
+        # There are no pongs in SSE, a comment that reaches the socket is the best sign of life we get
+        await self.write(b': ping\n\n')
+        self.last_seen = time.monotonic()
+
+    async def close(self):
+        self.closed.set()
+
+    async def messages(self):
+        """SSE clients cannot send, so only wait for the stream to close"""
+        await self.closed.wait()
+        return
+        yield
+
 class ClientConnection:
     """Class to track individual client connections"""
-    def __init__(self, websocket, client_id):
-        self.websocket = websocket
+    __slots__ = ('transport', 'client_id', 'connected_at', 'ping_sent', 'message_count',
+                 'outbound', 'queue_size', 'overflow_policy', 'outbound_ready', 'writer_task',
+                 'sent_count', 'bytes_sent', 'dropped_count', 'coalesced_count', 'max_queue_depth',
+                 'pending_requests', 'binary', 'delta', 'needs_keyframe', 'subscription',
+                 'min_interval', 'last_sent', 'device_id', 'fleet_keys', 'buckets')
+
+    def __init__(self, transport, client_id, queue_size=32, overflow_policy=OVERFLOW_DROP_OLDEST):
+        self.transport = transport
         self.client_id = client_id
-        self.connected_at = datetime.now()
-        self.last_ping = datetime.now()
+        self.connected_at = time.monotonic()
+        self.ping_sent = 0.0  # When the outstanding liveness ping went out, 0 if none
         self.message_count = 0
-        
+
+        # Bounded outbound queue drained by a dedicated writer task
+        self.outbound = deque()
+        self.queue_size = max(1, queue_size)
+        self.overflow_policy = overflow_policy
+        self.outbound_ready = asyncio.Event()
+        self.writer_task = None
+        self.sent_count = 0
+        self.bytes_sent = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.max_queue_depth = 0
+
+        # Pipelined requests still being processed
+        self.pending_requests = set()
+
+        # Wire format and delta delivery state, negotiated in the handshake
+        self.binary = False
+        self.delta = False
+        self.needs_keyframe = True
+
+        # Channel subscription and optional rate cap
+        self.subscription = None
+        self.min_interval = 0.0
+        self.last_sent = 0.0
+
+        # Fleet mode: the device this connection streams, and its device/group subscriptions
+        self.device_id = None
+        self.fleet_keys = set()
+
+        # Rate-limit buckets by message type, None when the client is not rate limited
+        self.buckets = None
+
+    @property
+    def last_seen(self):
+        """Monotonic time of the last frame or pong received from the client"""
+        if self.transport is None:
+            # Detached replay connections have no transport to hear from
+            return self.connected_at
+        return self.transport.last_seen
+
     def update_activity(self):
-        self.last_ping = datetime.now()
         self.message_count += 1
 
+    def start_writer(self, on_error):
+        """Start the writer task that drains the outbound queue"""
+        self.writer_task = asyncio.create_task(self._writer_loop(on_error))
+
+    def stop_writer(self):
+        """Cancel the writer task and pipelined requests, discarding any queued frames"""
+        current = asyncio.current_task()
+        if self.writer_task and self.writer_task is not current:
+            self.writer_task.cancel()
+        for task in self.pending_requests:
+            if task is not current:
+                task.cancel()
+        self.pending_requests.clear()
+        self.outbound.clear()
+
+    def enqueue(self, frame, kind=None):
+        """Queue a frame without blocking. Returns False if the client should be disconnected"""
+        if len(self.outbound) >= self.queue_size:
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                return False
+
+            if self.overflow_policy == OVERFLOW_COALESCE and kind is not None:
+                # Replace the oldest pending frame of the same kind with the latest one
+                for index, (queued_kind, _) in enumerate(self.outbound):
+                    if queued_kind == kind:
+                        del self.outbound[index]
+                        self.coalesced_count += 1
+                        self._discarded(queued_kind)
+                        break
+                else:
+                    self._discarded(self.outbound.popleft()[0])
+                    self.dropped_count += 1
+            else:
+                self._discarded(self.outbound.popleft()[0])
+                self.dropped_count += 1
+
+        self.outbound.append((kind, frame))
+        if len(self.outbound) > self.max_queue_depth:
+            self.max_queue_depth = len(self.outbound)
+        self.outbound_ready.set()
+        return True
+
+    def discard_queued(self, kind):
+        """Drop every queued frame of one kind"""
+        kept = [item for item in self.outbound if item[0] != kind]
+        self.outbound.clear()
+        self.outbound.extend(kept)
+
+    def _discarded(self, kind):
+        """A queued frame was thrown away, so a delta chain can no longer be trusted"""
+        if kind == 'sensor_delta':
+            self.needs_keyframe = True
+
+    def queue_stats(self):
+        """Return outbound queue counters for this client"""
+        return {
+            "queue_depth": len(self.outbound),
+            "max_queue_depth": self.max_queue_depth,
+            "queue_size": self.queue_size,
+            "overflow_policy": self.overflow_policy,
+            "sent_frames": self.sent_count,
+            "dropped_frames": self.dropped_count,
+            "coalesced_frames": self.coalesced_count
+        }
+
+    async def _writer_loop(self, on_error):
+        """Send queued frames one at a time so a slow client only delays itself"""
+        try:
+            while True:
+                while not self.outbound:
+                    self.outbound_ready.clear()
+                    await self.outbound_ready.wait()
+
+                _, frame = self.outbound.popleft()
+                await self.transport.send(frame, shared=True)
+                self.sent_count += 1
+                self.bytes_sent += frame_size(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await on_error(self.client_id, e)
+
+class LivenessMonitor:
+    """Deadline heap of pending liveness checks, so idle clients are found without scanning everyone"""
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.timeout = timeout
+        self.deadlines = []  # (monotonic deadline, client_id), entries of removed clients are skipped
+        self.wakeup = asyncio.Event()
+        self.pings_sent = 0
+        self.reaped = 0
+
+    def schedule(self, deadline, client_id):
+        heappush(self.deadlines, (deadline, client_id))
+        if self.deadlines[0][0] == deadline:
+            self.wakeup.set()
+
+    def pop_due(self, now):
+        """Pop the client ids whose check is due"""
+        deadlines = self.deadlines
+        due = []
+        while deadlines and deadlines[0][0] <= now:
+            due.append(heappop(deadlines)[1])
+        return due
+
+    async def wait(self, now):
+        """Sleep until the earliest deadline or until an earlier one is scheduled"""
+        self.wakeup.clear()
+        delay = self.deadlines[0][0] - now if self.deadlines else self.interval
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), max(delay, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self):
+        return {
+            "ping_interval": self.interval,
+            "ping_timeout": self.timeout,
+            "scheduled_checks": len(self.deadlines),
+            "pings_sent": self.pings_sent,
+            "reaped_clients": self.reaped
+        }
+
+class SubscriptionGroup:
+    """Clients sharing one channel selection, so each update is encoded once for all of them"""
+    def __init__(self, keys):
+        self.keys = keys  # frozenset of sensor keys, None for the full stream
+        self.client_ids = set()
+        self.seq = 0  # Bumped whenever one of the keys changes
+
+    def __len__(self):
+        return len(self.client_ids)
+
+# Columns kept by the history ring buffer: channel -> decimal places
+HISTORY_NUMERIC_CHANNELS = {
+    'pH': 2,
+    'TSS': 1,
+    'COD': 1,
+    'Ammonia': 2,
+    'Flow_Modbus': 1,
+    'Pressure': 2,
+    'FLOW': 1,
+    'ACTUATOR': 1
+}
+
+# Unit suffixes of digital channels that are reported as strings
+HISTORY_UNIT_SUFFIXES = {
+    'FLOW': 'L/min',
+    'ACTUATOR': '%'
+}
+
+# Categorical channels stored as small-int codes
+HISTORY_STATE_CHANNELS = {
+    'STATUS': ('OK', 'WARN', 'FAULT'),
+    'PUMP': ('ON', 'OFF'),
+    'ALARM': ('NORMAL', 'ALARM')
+}
+
+# WebSocket subprotocols offered on /ws, JSON text stays the default
+WS_PROTOCOL_JSON = 'm300.json.v1'
+WS_PROTOCOL_BINARY = 'm300.binary.v1'
+
+# First byte of every binary frame
+BINARY_TAG_SENSOR = 0x01   # Packed sensor snapshot
+BINARY_TAG_HISTORY = 0x02  # Packed history rows
+BINARY_TAG_MSGPACK = 0x10  # Any other message as MessagePack
+BINARY_TAG_JSON = 0x11     # Any other message as UTF-8 JSON
+
+# Packed sensor frame kinds
+BINARY_KIND_SENSOR_UPDATE = 0
+BINARY_KIND_SENSOR_DATA = 1
+
+# One packed row: epoch timestamp, sensor TIMESTAMP, float32 numeric channels, int8 state codes
+SENSOR_ROW = struct.Struct('<dq' + 'f' * len(HISTORY_NUMERIC_CHANNELS) + 'b' * len(HISTORY_STATE_CHANNELS))
+SENSOR_FRAME_HEADER = struct.Struct('<BBI')    # tag, kind, seq
+HISTORY_FRAME_HEADER = struct.Struct('<BBI')   # tag, id length, row count
+
+# Downsampling options for get_history
+HISTORY_DOWNSAMPLE_METHODS = ('minmax', 'mean', 'lttb')
+MAX_HISTORY_POINTS = 5000
+# Most raw records one get_history returns, and the JSON size assumed per record when charging
+# the rate limit up front
+MAX_HISTORY_RECORDS = 10000
+HISTORY_RECORD_JSON_BYTES = 300
+
+# On-disk history segments (HISTORY_DIR), one SENSOR_ROW per record
+SEGMENT_PREFIX = 'history-'
+SEGMENT_SUFFIX = '.seg'
+SEGMENT_SCHEMA_FILE = 'schema.json'
+SEGMENT_TIME = struct.Struct('<d')
+
+# Capture files (RECORD_FILE/REPLAY_FILE): magic, then (kind, offset seconds, length) + payload records
+CAPTURE_MAGIC = b'M300CAP1'
+CAPTURE_RECORD = struct.Struct('<BdI')
+CAPTURE_SNAPSHOT = 1
+CAPTURE_CLIENT_MESSAGE = 2
+# Recorded records are buffered on the event loop and handed to the writer thread this often,
+# or sooner once this many bytes are waiting
+CAPTURE_FLUSH_INTERVAL = 1.0
+CAPTURE_FLUSH_BYTES = 256 * 1024
+
+# Replayed client messages that only read state, their responses are discarded
+REPLAY_REQUEST_TYPES = ('get_sensors', 'get_status', 'get_history', 'get_client_info', 'ping',
+                        'get_schema', 'get_fleet', 'get_device')
+
+def parse_time_bound(value):
+    """Parse a from/to bound given as epoch seconds, epoch milliseconds or ISO 8601"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+    value = float(value)
+    # Values this large can only be milliseconds
+    if value > 1e11:
+        value /= 1000.0
+    return value
+
+def parse_channel_number(channel, value):
+    """Convert a channel value to a float, stripping its unit suffix"""
+    if value is None:
+        return math.nan
+    if isinstance(value, str):
+        suffix = HISTORY_UNIT_SUFFIXES.get(channel)
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            return float(value)
+        except ValueError:
+            return math.nan
+    return float(value)
+
+class HistoryStore:
+    """Fixed-capacity ring buffer of sensor snapshots stored as typed columns"""
+    def __init__(self, capacity=1000):
+        self.capacity = max(1, capacity)
+        self.start = 0  # Slot of the oldest record
+        self.count = 0
+
+        # Epoch timestamps plus one typed array per channel
+        self.timestamps = array('d', bytes(8 * self.capacity))
+        self.sensor_timestamps = array('q', bytes(8 * self.capacity))
+        self.numeric = {
+            channel: array('f', [math.nan]) * self.capacity
+            for channel in HISTORY_NUMERIC_CHANNELS
+        }
+        self.states = {
+            channel: array('b', [-1]) * self.capacity
+            for channel in HISTORY_STATE_CHANNELS
+        }
+        self.state_labels = {channel: list(labels) for channel, labels in HISTORY_STATE_CHANNELS.items()}
+        self.state_codes = {
+            channel: {label: code for code, label in enumerate(labels)}
+            for channel, labels in self.state_labels.items()
+        }
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        """Forget all records without releasing the preallocated columns"""
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, snapshot):
+        """Store a snapshot taken at the given epoch timestamp, overwriting the oldest when full"""
+        if self.count < self.capacity:
+            slot = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+
+        self.timestamps[slot] = timestamp
+        self.sensor_timestamps[slot] = int(snapshot.get('TIMESTAMP', timestamp))
+
+        for channel, column in self.numeric.items():
+            column[slot] = self._to_number(channel, snapshot.get(channel))
+
+        for channel, column in self.states.items():
+            column[slot] = self._state_code(channel, snapshot.get(channel))
+
+    def _to_number(self, channel, value):
+        return parse_channel_number(channel, value)
+
+    def _state_code(self, channel, label):
+        """Map a categorical value to its code, registering unseen labels"""
+        if label is None:
+            return -1
+        codes = self.state_codes[channel]
+        code = codes.get(label)
+        if code is None:
+            labels = self.state_labels[channel]
+            if len(labels) >= 127:
+                return -1
+            code = len(labels)
+            labels.append(label)
+            codes[label] = code
+        return code
+
+    def slot(self, position):
+        """Translate a logical position (0 is the oldest record) into a buffer slot"""
+        return (self.start + position) % self.capacity
+
+    def record(self, position, channels=None):
+        """Rebuild the snapshot dict stored at a logical position"""
+        slot = self.slot(position)
+        return self.row_record((
+            self.timestamps[slot],
+            self.sensor_timestamps[slot],
+            *[column[slot] for column in self.numeric.values()],
+            *[column[slot] for column in self.states.values()]
+        ), channels)
+
+    def row_record(self, row, channels=None):
+        """Rebuild a snapshot dict from the values of one SENSOR_ROW"""
+        data = {}
+        offset = 2
+        for channel, decimals in HISTORY_NUMERIC_CHANNELS.items():
+            value = row[offset]
+            offset += 1
+            if (channels is not None and channel not in channels) or math.isnan(value):
+                continue
+            value = round(value, decimals)
+            suffix = HISTORY_UNIT_SUFFIXES.get(channel)
+            data[channel] = f"{value:.{decimals}f}{suffix}" if suffix else value
+        for channel in HISTORY_STATE_CHANNELS:
+            code = row[offset]
+            offset += 1
+            if (channels is not None and channel not in channels) or code < 0:
+                continue
+            data[channel] = self.state_labels[channel][code]
+        if channels is None or 'TIMESTAMP' in channels:
+            data['TIMESTAMP'] = row[1]
+
+        return {
+            "timestamp": datetime.fromtimestamp(row[0]).isoformat(),
+            "type": "sensor_update",
+            "data": data
+        }
+
+    def copy(self):
+        """Point-in-time copy for readers on another thread, the columns are copied in C"""
+        store = HistoryStore.__new__(HistoryStore)
+        store.capacity = self.capacity
+        store.start = self.start
+        store.count = self.count
+        store.timestamps = self.timestamps[:]
+        store.sensor_timestamps = self.sensor_timestamps[:]
+        store.numeric = {channel: column[:] for channel, column in self.numeric.items()}
+        store.states = {channel: column[:] for channel, column in self.states.items()}
+        store.state_labels = {channel: list(labels) for channel, labels in self.state_labels.items()}
+        store.state_codes = {channel: dict(codes) for channel, codes in self.state_codes.items()}
+        return store
+
+    def oldest_timestamp(self):
+        """Epoch timestamp of the oldest record, None when empty"""
+        return self.timestamps[self.start] if self.count else None
+
+    def set_state_labels(self, state_labels):
+        """Adopt persisted state labels so stored codes keep their meaning"""
+        for channel, labels in state_labels.items():
+            if channel in self.state_labels:
+                self.state_labels[channel] = list(labels)
+                self.state_codes[channel] = {label: code for code, label in enumerate(labels)}
+
+    def load_rows(self, rows):
+        """Append packed SENSOR_ROW records, oldest first"""
+        numeric = list(self.numeric.values())
+        states = list(self.states.values())
+        for row in SENSOR_ROW.iter_unpack(rows):
+            if self.count < self.capacity:
+                slot = (self.start + self.count) % self.capacity
+                self.count += 1
+            else:
+                slot = self.start
+                self.start = (self.start + 1) % self.capacity
+            self.timestamps[slot] = row[0]
+            self.sensor_timestamps[slot] = row[1]
+            for offset, column in enumerate(numeric, 2):
+                column[slot] = row[offset]
+            for offset, column in enumerate(states, 2 + len(numeric)):
+                column[slot] = row[offset]
+
+    def tail(self, limit):
+        """Return the most recent records, oldest first"""
+        limit = min(max(int(limit), 0), self.count)
+        return [self.record(position) for position in range(self.count - limit, self.count)]
+
+    def schema(self):
+        """Describe the packed row layout for binary clients"""
+        return {
+            "row_format": SENSOR_ROW.format,
+            "row_size": SENSOR_ROW.size,
+            "numeric": list(HISTORY_NUMERIC_CHANNELS),
+            "decimals": list(HISTORY_NUMERIC_CHANNELS.values()),
+            "units": HISTORY_UNIT_SUFFIXES,
+            "states": {channel: list(labels) for channel, labels in self.state_labels.items()}
+        }
+
+    def pack_snapshot(self, timestamp, snapshot):
+        """Pack a snapshot into one binary row using the store's state codes"""
+        return SENSOR_ROW.pack(
+            timestamp,
+            int(snapshot.get('TIMESTAMP', timestamp)),
+            *[self._to_number(channel, snapshot.get(channel)) for channel in HISTORY_NUMERIC_CHANNELS],
+            *[self._state_code(channel, snapshot.get(channel)) for channel in HISTORY_STATE_CHANNELS]
+        )
+
+    def pack_range(self, lo, hi):
+        """Pack the records between two logical positions straight from the columns"""
+        rows = bytearray(SENSOR_ROW.size * (hi - lo))
+        numeric = list(self.numeric.values())
+        states = list(self.states.values())
+        offset = 0
+        for position in range(lo, hi):
+            slot = self.slot(position)
+            SENSOR_ROW.pack_into(
+                rows, offset,
+                self.timestamps[slot],
+                self.sensor_timestamps[slot],
+                *[column[slot] for column in numeric],
+                *[column[slot] for column in states]
+            )
+            offset += SENSOR_ROW.size
+        return bytes(rows)
+
+    def bisect_time(self, timestamp, lo=0, hi=None):
+        """Return the first logical position whose timestamp is >= timestamp"""
+        if hi is None:
+            hi = self.count
+        timestamps = self.timestamps
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamps[self.slot(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def time_range(self, start=None, end=None):
+        """Return the [lo, hi) logical positions covering start <= timestamp <= end"""
+        lo = 0 if start is None else self.bisect_time(start)
+        if end is None:
+            hi = self.count
+        else:
+            # First position strictly after end
+            hi = self.bisect_time(math.nextafter(end, math.inf), lo)
+        return lo, hi
+
+    def column_range(self, column, lo, hi):
+        """Return the values of a column between two logical positions as one array"""
+        first = self.slot(lo)
+        length = hi - lo
+        if first + length <= self.capacity:
+            return column[first:first + length]
+        return column[first:] + column[:first + length - self.capacity]
+
+    def query(self, start=None, end=None, channels=None, limit=None):
+        """Return raw records in a time range, keeping the newest `limit` of them"""
+        lo, hi = self.time_range(start, end)
+        if limit is not None:
+            lo = max(lo, hi - max(int(limit), 0))
+        return [self.record(position, channels) for position in range(lo, hi)]
+
+    def downsample(self, start=None, end=None, channels=None, max_points=500, method='minmax'):
+        """Reduce a time range to at most max_points points per channel"""
+        lo, hi = self.time_range(start, end)
+        max_points = max(int(max_points), 1)
+        numeric_channels = [c for c in HISTORY_NUMERIC_CHANNELS if channels is None or c in channels]
+        state_channels = [c for c in HISTORY_STATE_CHANNELS if channels is None or c in channels]
+
+        series = {}
+        if hi > lo:
+            if method == 'lttb':
+                timestamps = self.column_range(self.timestamps, lo, hi)
+                for channel in numeric_channels:
+                    series[channel] = self._lttb(timestamps, self.column_range(self.numeric[channel], lo, hi),
+                                                 max_points, HISTORY_NUMERIC_CHANNELS[channel])
+            else:
+                series.update(self._bucketize(lo, hi, numeric_channels, max_points, method == 'mean'))
+            for channel in state_channels:
+                series[channel] = self._transitions(channel, lo, hi, max_points)
+
+        return {
+            "method": method,
+            "max_points": max_points,
+            "source_records": hi - lo,
+            "series": series
+        }
+
+    def _bucketize(self, lo, hi, channels, max_points, mean_only=False):
+        """Aggregate equal-time buckets into min/max/mean per channel, or just the mean"""
+        first_time = self.timestamps[self.slot(lo)]
+        last_time = self.timestamps[self.slot(hi - 1)]
+        width = (last_time - first_time) / max_points
+
+        # Bucket edges are found by binary search instead of scanning timestamps
+        if hi - lo <= max_points or width <= 0:
+            edges = list(range(lo, hi + 1))
+        else:
+            edges = [lo]
+            for bucket in range(1, max_points):
+                edges.append(self.bisect_time(first_time + width * bucket, edges[-1], hi))
+            edges.append(hi)
+
+        times = []
+        result = {channel: {"min": [], "max": [], "mean": []} for channel in channels}
+        for bucket_lo, bucket_hi in zip(edges, edges[1:]):
+            if bucket_hi <= bucket_lo:
+                continue
+            times.append(self.timestamps[self.slot(bucket_lo)])
+            for channel in channels:
+                values = [v for v in self.column_range(self.numeric[channel], bucket_lo, bucket_hi) if v == v]
+                decimals = HISTORY_NUMERIC_CHANNELS[channel]
+                aggregate = result[channel]
+                if values:
+                    aggregate["min"].append(round(min(values), decimals))
+                    aggregate["max"].append(round(max(values), decimals))
+                    aggregate["mean"].append(round(sum(values) / len(values), decimals))
+                else:
+                    aggregate["min"].append(None)
+                    aggregate["max"].append(None)
+                    aggregate["mean"].append(None)
+
+        for aggregate in result.values():
+            aggregate["t"] = times
+            if mean_only:
+                del aggregate["min"], aggregate["max"]
+        return result
+
+    def _lttb(self, timestamps, values, max_points, decimals):
+        """Largest-Triangle-Three-Buckets selection of visually significant points"""
+        points = [(t, v) for t, v in zip(timestamps, values) if v == v]
+        if len(points) <= max_points or max_points < 3:
+            selected = points if len(points) <= max_points else points[-max_points:]
+        else:
+            selected = [points[0]]
+            bucket_size = (len(points) - 2) / (max_points - 2)
+            previous = points[0]
+            for bucket in range(max_points - 2):
+                bucket_start = int(bucket * bucket_size) + 1
+                bucket_end = int((bucket + 1) * bucket_size) + 1
+                next_end = min(int((bucket + 2) * bucket_size) + 1, len(points))
+
+                # Average of the next bucket is the third triangle vertex
+                next_points = points[bucket_end:next_end] or [points[-1]]
+                avg_t = sum(p[0] for p in next_points) / len(next_points)
+                avg_v = sum(p[1] for p in next_points) / len(next_points)
+
+                best = None
+                best_area = -1.0
+                for point in points[bucket_start:bucket_end]:
+                    area = abs((previous[0] - avg_t) * (point[1] - previous[1])
+                               - (previous[0] - point[0]) * (avg_v - previous[1]))
+                    if area > best_area:
+                        best_area = area
+                        best = point
+                selected.append(best)
+                previous = best
+            selected.append(points[-1])
+
+        return {
+            "t": [p[0] for p in selected],
+            "v": [round(p[1], decimals) for p in selected]
+        }
+
+    def _transitions(self, channel, lo, hi, max_points):
+        """Return the points where a categorical channel changed value"""
+        labels = self.state_labels[channel]
+        codes = self.column_range(self.states[channel], lo, hi)
+        times = []
+        values = []
+        previous = None
+        for position, code in enumerate(codes):
+            if code == previous:
+                continue
+            previous = code
+            times.append(self.timestamps[self.slot(lo + position)])
+            values.append(labels[code] if code >= 0 else None)
+        # Keep the most recent transitions when there are too many
+        return {"t": times[-max_points:], "v": values[-max_points:]}
+
+class SegmentStore:
+    """Append-only history segments of fixed-size SENSOR_ROW records, queried through mmap.
+
+    Segments rotate every segment_records rows and only the newest `retention` are kept.
+    State labels are kept in schema.json so stored codes decode the same after a restart.
+    Writes run on one writer thread; queries run on the event loop and only read the files.
+    """
+    def __init__(self, directory, segment_records=10000, retention=48, fsync_interval=5.0, readonly=False):
+        self.directory = directory
+        self.segment_records = max(1, segment_records)
+        self.retention = max(1, retention)
+        self.fsync_interval = fsync_interval
+        self.readonly = readonly
+        self.file = None
+        self.active_path = None
+        self.active_records = 0
+        self.last_sync = time.monotonic()
+        self.label_counts = None
+        self.records_written = 0
+        self.fsyncs = 0
+        self.rotations = 0
+        self.deleted_segments = 0
+        self.bounds_cache = {}  # path -> ((inode, mtime, rows), first time, last time)
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+
+    def segment_paths(self):
+        """Segment files, oldest first"""
+        try:
+            names = sorted(name for name in os.listdir(self.directory)
+                           if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names]
+
+    def load_state_labels(self):
+        """Return the persisted state labels, None if there are none. Raises ValueError on a layout change"""
+        try:
+            with open(os.path.join(self.directory, SEGMENT_SCHEMA_FILE)) as schema_file:
+                schema = json.load(schema_file)
+        except FileNotFoundError:
+            return None
+        if schema.get("row_format") != SENSOR_ROW.format:
+            raise ValueError(f"segments use row format {schema.get('row_format')}, expected {SENSOR_ROW.format}")
+        return schema["states"]
+
+    def save_state_labels(self, state_labels):
+        """Persist the row layout and state labels, replacing the file atomically"""
+        path = os.path.join(self.directory, SEGMENT_SCHEMA_FILE)
+        with open(path + '.tmp', 'w') as schema_file:
+            json.dump({"row_format": SENSOR_ROW.format, "states": state_labels}, schema_file)
+        os.replace(path + '.tmp', path)
+
+    def append(self, row, state_labels):
+        """Append one packed row, rotating and syncing as configured"""
+        label_counts = tuple(len(labels) for labels in state_labels.values())
+        if label_counts != self.label_counts:
+            # New state labels are rare, rewrite the schema before rows use their codes
+            self.save_state_labels(state_labels)
+            self.label_counts = label_counts
+        if self.file is None or self.active_records >= self.segment_records:
+            self.rotate()
+        self.file.write(row)
+        # Readers map the files, so rows have to reach the page cache right away
+        self.file.flush()
+        self.active_records += 1
+        self.records_written += 1
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Flush buffered rows and fsync the active segment"""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+        self.last_sync = time.monotonic()
+
+    def rotate(self):
+        """Close the active segment and start a new one, dropping segments past retention"""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.rotations += 1
+        paths = self.segment_paths()
+        number = int(os.path.basename(paths[-1])[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 if paths else 0
+        self.active_path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:08d}{SEGMENT_SUFFIX}")
+        self.file = open(self.active_path, 'ab')
+        self.active_records = 0
+        paths.append(self.active_path)
+        for path in paths[:-self.retention]:
+            os.remove(path)
+            self.deleted_segments += 1
+
+    def close(self):
+        """Sync and close the active segment"""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def clear(self):
+        """Delete every segment"""
+        self.close()
+        for path in self.segment_paths():
+            os.remove(path)
+            self.deleted_segments += 1
+
+    def _row_time(self, mapped, index):
+        return SEGMENT_TIME.unpack_from(mapped, index * SENSOR_ROW.size)[0]
+
+    def _bisect(self, mapped, rows, timestamp):
+        """First row index whose timestamp is >= timestamp"""
+        lo, hi = 0, rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._row_time(mapped, mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def segment_bounds(self):
+        """(path, rows, first time, last time) of every non-empty segment, oldest first.
+
+        Bounds are cached per file and only re-read when a segment changes.
+        """
+        bounds = []
+        cache = {}
+        size = SENSOR_ROW.size
+        for path in self.segment_paths():
+            try:
+                info = os.stat(path)
+                # A torn trailing row from a crash is ignored
+                rows = info.st_size // size
+                if not rows:
+                    continue
+                key = (info.st_ino, info.st_mtime_ns, rows)
+                cached = self.bounds_cache.get(path)
+                if cached is None or cached[0] != key:
+                    with open(path, 'rb') as segment:
+                        first = SEGMENT_TIME.unpack(os.pread(segment.fileno(), SEGMENT_TIME.size, 0))[0]
+                        last = SEGMENT_TIME.unpack(os.pread(segment.fileno(), SEGMENT_TIME.size, (rows - 1) * size))[0]
+                    cached = (key, first, last)
+            except FileNotFoundError:
+                # Dropped by retention since the directory was listed
+                continue
+            cache[path] = cached
+            bounds.append((path, rows, cached[1], cached[2]))
+        self.bounds_cache = cache
+        return bounds
+
+    @contextmanager
+    def window(self, start=None, end=None, limit=None):
+        """Map the segments covering a time range and yield (mmap, lo, hi) row chunks, oldest first"""
+        segments = [(path, rows, first, last) for path, rows, first, last in self.segment_bounds()
+                    if (start is None or last >= start) and (end is None or first <= end)]
+        remaining = None if limit is None else max(int(limit), 0)
+        chunks = []
+        try:
+            # Newest first, so a limited query stops before mapping older segments
+            for path, rows, first, last in reversed(segments):
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    with open(path, 'rb') as segment:
+                        mapped = mmap.mmap(segment.fileno(), rows * SENSOR_ROW.size, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    continue
+                lo = 0 if start is None or first >= start else self._bisect(mapped, rows, start)
+                hi = rows if end is None or last <= end else self._bisect(mapped, rows, math.nextafter(end, math.inf))
+                if remaining is not None:
+                    lo = max(lo, hi - remaining)
+                    remaining -= max(hi - lo, 0)
+                if hi > lo:
+                    chunks.append((mapped, lo, hi))
+                else:
+                    mapped.close()
+            chunks.reverse()
+            yield chunks
+        finally:
+            for mapped, _, _ in chunks:
+                mapped.close()
+
+    def count(self, start=None, end=None):
+        """Number of stored rows in a time range"""
+        with self.window(start, end) as chunks:
+            return sum(hi - lo for _, lo, hi in chunks)
+
+    def pack(self, start=None, end=None, limit=None):
+        """Packed rows of a time range, copied straight out of the mappings"""
+        size = SENSOR_ROW.size
+        with self.window(start, end, limit) as chunks:
+            return b''.join(mapped[lo * size:hi * size] for mapped, lo, hi in chunks)
+
+    def rows(self, start=None, end=None, limit=None):
+        """Yield unpacked rows of a time range one at a time"""
+        size = SENSOR_ROW.size
+        with self.window(start, end, limit) as chunks:
+            for mapped, lo, hi in chunks:
+                for index in range(lo, hi):
+                    yield SENSOR_ROW.unpack_from(mapped, index * size)
+
+    def downsample(self, history, start=None, end=None, channels=None, max_points=500, method='minmax'):
+        """Stream min/max/mean buckets and state transitions over a range without loading it.
+
+        "mean" keeps only the mean of each bucket, any other method gets min/max/mean.
+        """
+        mean_only = method == 'mean'
+        max_points = max(int(max_points), 1)
+        numeric_channels = [c for c in HISTORY_NUMERIC_CHANNELS if channels is None or c in channels]
+        state_channels = [c for c in HISTORY_STATE_CHANNELS if channels is None or c in channels]
+        numeric_offsets = {channel: offset for offset, channel in enumerate(HISTORY_NUMERIC_CHANNELS, 2)}
+        state_offsets = {channel: offset for offset, channel in enumerate(HISTORY_STATE_CHANNELS, 2 + len(HISTORY_NUMERIC_CHANNELS))}
+
+        with self.window(start, end) as chunks:
+            source_records = sum(hi - lo for _, lo, hi in chunks)
+            series = {}
+            if source_records:
+                first_time = self._row_time(chunks[0][0], chunks[0][1])
+                last_time = self._row_time(chunks[-1][0], chunks[-1][2] - 1)
+                width = (last_time - first_time) / max_points
+
+                buckets = {}  # bucket -> [first time, {channel: [min, max, total, count]}]
+                transitions = {channel: ([], []) for channel in state_channels}
+                previous = {channel: None for channel in state_channels}
+                size = SENSOR_ROW.size
+                for mapped, lo, hi in chunks:
+                    for index in range(lo, hi):
+                        row = SENSOR_ROW.unpack_from(mapped, index * size)
+                        bucket = min(int((row[0] - first_time) / width), max_points - 1) if width > 0 else 0
+                        entry = buckets.get(bucket)
+                        if entry is None:
+                            entry = buckets[bucket] = [row[0], {}]
+                        for channel in numeric_channels:
+                            value = row[numeric_offsets[channel]]
+                            if value != value:
+                                continue
+                            aggregate = entry[1].get(channel)
+                            if aggregate is None:
+                                entry[1][channel] = [value, value, value, 1]
+                            else:
+                                if value < aggregate[0]:
+                                    aggregate[0] = value
+                                if value > aggregate[1]:
+                                    aggregate[1] = value
+                                aggregate[2] += value
+                                aggregate[3] += 1
+                        for channel in state_channels:
+                            code = row[state_offsets[channel]]
+                            if code != previous[channel]:
+                                previous[channel] = code
+                                transitions[channel][0].append(row[0])
+                                transitions[channel][1].append(history.state_labels[channel][code] if code >= 0 else None)
+
+                ordered = [buckets[bucket] for bucket in sorted(buckets)]
+                times = [entry[0] for entry in ordered]
+                for channel in numeric_channels:
+                    decimals = HISTORY_NUMERIC_CHANNELS[channel]
+                    result = {"min": [], "max": [], "mean": [], "t": times}
+                    for _, aggregates in ordered:
+                        aggregate = aggregates.get(channel)
+                        result["min"].append(round(aggregate[0], decimals) if aggregate else None)
+                        result["max"].append(round(aggregate[1], decimals) if aggregate else None)
+                        result["mean"].append(round(aggregate[2] / aggregate[3], decimals) if aggregate else None)
+                    if mean_only:
+                        del result["min"], result["max"]
+                    series[channel] = result
+                for channel in state_channels:
+                    times_list, values = transitions[channel]
+                    series[channel] = {"t": times_list[-max_points:], "v": values[-max_points:]}
+
+        return {
+            "method": "mean" if mean_only else "minmax",
+            "max_points": max_points,
+            "source_records": source_records,
+            "series": series
+        }
+
+    def stats(self):
+        segments = 0
+        total_bytes = 0
+        for path in self.segment_paths():
+            try:
+                total_bytes += os.path.getsize(path)
+            except FileNotFoundError:
+                # Dropped by retention since the directory was listed
+                continue
+            segments += 1
+        return {
+            "directory": self.directory,
+            "readonly": self.readonly,
+            "segments": segments,
+            "bytes": total_bytes,
+            "segment_records": self.segment_records,
+            "retention_segments": self.retention,
+            "records_written": self.records_written,
+            "fsyncs": self.fsyncs,
+            "rotations": self.rotations,
+            "deleted_segments": self.deleted_segments
+        }
+
+class CaptureWriter:
+    """Append snapshots and inbound client messages to a capture file with their time offsets.
+
+    Records are buffered in memory and written, and gzip-compressed, by a writer thread so
+    recording does not add to the latencies it captures.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='capture-writer')
+        self.pending = []
+        self.pending_bytes = 0
+        self.started = time.monotonic()
+        self.last_flush = self.started
+        self.records = 0
+        self.bytes = len(CAPTURE_MAGIC)
+        self.flushes = 0
+
+    def write(self, kind, payload):
+        now = time.monotonic()
+        self.pending.append(CAPTURE_RECORD.pack(kind, now - self.started, len(payload)))
+        self.pending.append(payload)
+        self.pending_bytes += CAPTURE_RECORD.size + len(payload)
+        self.records += 1
+        self.bytes += CAPTURE_RECORD.size + len(payload)
+        if now - self.last_flush >= CAPTURE_FLUSH_INTERVAL or self.pending_bytes >= CAPTURE_FLUSH_BYTES:
+            self.flush()
+            self.last_flush = now
+
+    def flush(self):
+        """Hand the buffered records to the writer thread"""
+        if not self.pending:
+            return
+        chunk = b''.join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.flushes += 1
+        self.executor.submit(self.write_chunk, chunk).add_done_callback(self.log_write_error)
+
+    def write_chunk(self, chunk):
+        """Runs on the writer thread"""
+        self.file.write(chunk)
+        self.file.flush()
+
+    def log_write_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Error writing capture {self.path}: {future.exception()!r}")
+
+    def write_message(self, client_id, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self.write(CAPTURE_CLIENT_MESSAGE, client_id.encode('utf-8') + b'\0' + message)
+
+    def close(self):
+        """Write what is still buffered, then close the file once the writer thread is done"""
+        self.flush()
+        self.executor.shutdown(wait=True)
+        self.file.close()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "records": self.records,
+            "bytes": self.bytes,
+            "pending_bytes": self.pending_bytes,
+            "flushes": self.flushes
+        }
+
+def read_capture(path):
+    """Yield (kind, offset, payload) records from a capture file, reading one record at a time"""
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            try:
+                header = capture.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    return
+                kind, offset, length = CAPTURE_RECORD.unpack(header)
+                payload = capture.read(length)
+            except EOFError:
+                # A gzip capture whose recorder was killed has no end-of-stream marker
+                return
+            if len(payload) < length:
+                # Truncated by a crash while recording
+                return
+            yield kind, offset, payload
+
+async def paced(records, speed):
+    """Release records at their recorded offsets divided by speed, or as fast as possible for speed 0"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for kind, offset, payload in records:
+        if speed > 0:
+            delay = started + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Still let clients' writer tasks run between records
+            await asyncio.sleep(0)
+        yield kind, offset, payload
+
+class RandomWalk:
+    """Bounded random walk, reflecting off the limits"""
+    def __init__(self, low, high, step, decimals=2, start=None):
+        self.low = low
+        self.high = high
+        self.step = step
+        self.decimals = decimals
+        self.value = start
+
+    def next(self, rng, t, values):
+        if self.value is None:
+            self.value = rng.uniform(self.low, self.high)
+        value = self.value + rng.gauss(0.0, self.step)
+        if value < self.low:
+            value = 2 * self.low - value
+        elif value > self.high:
+            value = 2 * self.high - value
+        self.value = min(max(value, self.low), self.high)
+        return round(self.value, self.decimals)
+
+class Diurnal:
+    """Sinusoidal daily cycle with Gaussian noise, clamped to the sensor range"""
+    def __init__(self, mean, amplitude, low, high, noise=0.0, phase=0.0, decimals=1):
+        self.mean = mean
+        self.amplitude = amplitude
+        self.low = low
+        self.high = high
+        self.noise = noise
+        self.phase = phase
+        self.decimals = decimals
+
+    def next(self, rng, t, values):
+        value = self.mean + self.amplitude * math.sin(2 * math.pi * (t.day_fraction + self.phase))
+        if self.noise:
+            value += rng.gauss(0.0, self.noise)
+        return round(min(max(value, self.low), self.high), self.decimals)
+
+class MarkovChain:
+    """Discrete state that changes according to a transition table"""
+    def __init__(self, transitions, start):
+        # transitions: state -> {next_state: probability}, rows are normalised
+        self.table = {}
+        for state, row in transitions.items():
+            total = sum(row.values())
+            cumulative = 0.0
+            self.table[state] = []
+            for next_state, probability in row.items():
+                cumulative += probability / total
+                self.table[state].append((cumulative, next_state))
+        self.state = start
+
+    def next(self, rng, t, values):
+        draw = rng.random()
+        for threshold, next_state in self.table[self.state]:
+            if draw < threshold:
+                self.state = next_state
+                break
+        return self.state
+
+class Correlated:
+    """Linear function of another channel plus noise, e.g. pressure following flow"""
+    def __init__(self, source, gain, offset, low, high, noise=0.0, decimals=2):
+        self.source = source
+        self.gain = gain
+        self.offset = offset
+        self.low = low
+        self.high = high
+        self.noise = noise
+        self.decimals = decimals
+
+    def next(self, rng, t, values):
+        value = self.offset + self.gain * values[self.source]
+        if self.noise:
+            value += rng.gauss(0.0, self.noise)
+        return round(min(max(value, self.low), self.high), self.decimals)
+
+class Uniform:
+    """Independent uniform samples, the original simulator behaviour"""
+    def __init__(self, low, high, decimals=2):
+        self.low = low
+        self.high = high
+        self.decimals = decimals
+
+    def next(self, rng, t, values):
+        return round(rng.uniform(self.low, self.high), self.decimals)
+
+class Choice:
+    """Independent choice from a list of states"""
+    def __init__(self, options):
+        self.options = options
+
+    def next(self, rng, t, values):
+        return rng.choice(self.options)
+
+class SignalClock:
+    """Simulated time passed to signal models"""
+    def __init__(self, seconds, day_length):
+        self.seconds = seconds
+        self.day_fraction = (seconds % day_length) / day_length
+
+def plausible_signal_models():
+    """Default models: slow drifts, daily load cycle, sticky states and flow-driven pressure"""
+    return {
+        'pH': RandomWalk(6.5, 8.5, 0.03, decimals=2, start=7.2),
+        'TSS': Diurnal(70, 30, 20, 120, noise=2.0, phase=0.0, decimals=1),
+        'COD': Diurnal(150, 60, 50, 250, noise=4.0, phase=0.05, decimals=1),
+        'Ammonia': RandomWalk(0.5, 8.0, 0.08, decimals=2, start=2.5),
+        'Flow_Modbus': Diurnal(250, 100, 100, 400, noise=5.0, phase=-0.1, decimals=1),
+        # Line pressure and the digital flow meter follow the main flow
+        'Pressure': Correlated('Flow_Modbus', 0.005, 0.5, 1.0, 2.5, noise=0.03, decimals=2),
+        'FLOW': Correlated('Flow_Modbus', 0.0667, 18.3, 25, 45, noise=0.4, decimals=1),
+        'ACTUATOR': RandomWalk(30, 80, 1.0, decimals=1, start=55.0),
+        'STATUS': MarkovChain({
+            'OK': {'OK': 0.97, 'WARN': 0.03},
+            'WARN': {'OK': 0.2, 'WARN': 0.72, 'FAULT': 0.08},
+            'FAULT': {'FAULT': 0.85, 'OK': 0.15}
+        }, start='OK'),
+        'PUMP': MarkovChain({
+            'ON': {'ON': 0.98, 'OFF': 0.02},
+            'OFF': {'OFF': 0.95, 'ON': 0.05}
+        }, start='ON'),
+        'ALARM': MarkovChain({
+            'NORMAL': {'NORMAL': 0.99, 'ALARM': 0.01},
+            'ALARM': {'ALARM': 0.9, 'NORMAL': 0.1}
+        }, start='NORMAL')
+    }
+
+def uniform_signal_models():
+    """Independent samples per tick, as the simulator behaved originally"""
+    return {
+        'pH': Uniform(6.5, 8.5, 2),
+        'TSS': Uniform(20, 120, 1),
+        'COD': Uniform(50, 250, 1),
+        'Ammonia': Uniform(0.5, 8.0, 2),
+        'Flow_Modbus': Uniform(100, 400, 1),
+        'Pressure': Uniform(1.0, 2.5, 2),
+        'FLOW': Uniform(25, 45, 1),
+        'ACTUATOR': Uniform(30, 80, 1),
+        'STATUS': Choice(['OK', 'OK', 'OK', 'WARN', 'FAULT']),
+        'PUMP': Choice(['ON', 'OFF']),
+        'ALARM': Choice(['NORMAL', 'NORMAL', 'NORMAL', 'ALARM'])
+    }
+
+SIGNAL_PRESETS = {
+    'plausible': plausible_signal_models,
+    'uniform': uniform_signal_models
+}
+
+class SignalGenerator:
+    """Per-channel signal models stepped together once per tick from one seeded RNG"""
+    def __init__(self, models, seed=None, sample_period=3.0, day_length=86400.0):
+        self.models = models
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.sample_period = sample_period
+        self.day_length = day_length
+        # Seeded runs always start at midnight so they replay identically
+        if seed is None:
+            now = datetime.now()
+            self.start_offset = now.hour * 3600 + now.minute * 60 + now.second
+        else:
+            self.start_offset = 0.0
+        self.tick = 0
+        # Correlated channels are computed after the channel they follow
+        self.order = sorted(models, key=lambda channel: isinstance(models[channel], Correlated))
+
+    def step(self):
+        """Advance every model one tick and return the new channel values"""
+        clock = SignalClock(self.start_offset + self.tick * self.sample_period, self.day_length)
+        self.tick += 1
+        values = {}
+        for channel in self.order:
+            values[channel] = self.models[channel].next(self.rng, clock, values)
+        return {channel: values[channel] for channel in self.models}
+
+# Fleet mode channel ranges: (channel, low, high, decimals), plus state channels and their choices
+FLEET_NUMERIC_CHANNELS = (
+    ('pH', 6.5, 8.5, 2),
+    ('TSS', 20, 120, 1),
+    ('COD', 50, 250, 1),
+    ('Ammonia', 0.5, 8.0, 2),
+    ('Flow_Modbus', 100, 400, 1),
+    ('Pressure', 1.0, 2.5, 2),
+    ('FLOW', 25, 45, 1),
+    ('ACTUATOR', 30, 80, 1)
+)
+FLEET_STATE_CHANNELS = (
+    ('STATUS', ('OK', 'OK', 'OK', 'WARN', 'FAULT')),
+    ('PUMP', ('ON', 'OFF')),
+    ('ALARM', ('NORMAL', 'NORMAL', 'NORMAL', 'ALARM'))
+)
+
+class DeviceFleet:
+    """Many virtual M300 gateways generated with one random draw per tick.
+
+    Values live in a devices x channels matrix, uses NumPy when it is installed and
+    a flat typed array otherwise. Devices are encoded on demand, only when someone listens.
+    Each tick draws from its own generator seeded with (seed, tick), so fleets sharing a seed
+    agree on every tick they step to, even after skipping some.
+    """
+    def __init__(self, size, group_size=100, seed=None):
+        self.size = size
+        self.device_ids = [f"m300-{index:05d}" for index in range(size)]
+        self.index = {device_id: index for index, device_id in enumerate(self.device_ids)}
+        group_size = max(1, group_size)
+        self.groups = {
+            f"group_{start // group_size}": range(start, min(start + group_size, size))
+            for start in range(0, size, group_size)
+        }
+        self.numeric_count = len(FLEET_NUMERIC_CHANNELS)
+        self.state_count = len(FLEET_STATE_CHANNELS)
+        self.width = self.numeric_count + self.state_count
+        lows = [low for _, low, _, _ in FLEET_NUMERIC_CHANNELS]
+        spans = [high - low for _, low, high, _ in FLEET_NUMERIC_CHANNELS]
+        choices = [len(options) for _, options in FLEET_STATE_CHANNELS]
+
+        if seed is None:
+            seed = random.SystemRandom().randrange(2 ** 63)
+        self.seed = seed
+        if np is not None:
+            self.backend = 'numpy'
+            self.scale = np.array(spans + choices, dtype=np.float64)
+            self.offset = np.array(lows + [0] * self.state_count, dtype=np.float64)
+        else:
+            self.backend = 'python'
+            self.scale = spans + choices
+            self.offset = lows + [0] * self.state_count
+        self.values = None
+        self.tick = 0
+        self.timestamp = None
+        self.step_latency = LatencyStats()
+        self._encoded = {}
+
+    def step(self, tick=None, epoch=None):
+        """Draw every channel of every device for a tick in one pass, the next one by default"""
+        started = time.perf_counter()
+        if tick is None:
+            tick = self.tick + 1
+        if np is not None:
+            # One draw for all devices and channels, state columns floor to a choice index
+            rng = np.random.default_rng((self.seed % 2 ** 64, tick))
+            self.values = rng.random((self.size, self.width)) * self.scale + self.offset
+        else:
+            draw = random.Random(f"{self.seed}:{tick}").random
+            self.values = array('d', [
+                draw() * scale + offset
+                for _ in range(self.size)
+                for scale, offset in zip(self.scale, self.offset)
+            ])
+        self.tick = tick
+        self.timestamp = datetime.now() if epoch is None else datetime.fromtimestamp(epoch)
+        self._encoded = {}
+        self.step_latency.record(time.perf_counter() - started)
+
+    def row(self, index):
+        """Raw channel values of one device"""
+        if np is not None:
+            return self.values[index].tolist()
+        start = index * self.width
+        return self.values[start:start + self.width]
+
+    def sensors(self, index):
+        """Sensor dict of one device, in the same shape as the single-gateway snapshot"""
+        row = self.row(index)
+        sensors = {}
+        for column, (channel, _, _, decimals) in enumerate(FLEET_NUMERIC_CHANNELS):
+            value = round(row[column], decimals)
+            suffix = HISTORY_UNIT_SUFFIXES.get(channel)
+            sensors[channel] = f"{value:.{decimals}f}{suffix}" if suffix else value
+        for column, (channel, options) in enumerate(FLEET_STATE_CHANNELS, self.numeric_count):
+            sensors[channel] = options[int(row[column])]
+        sensors['TIMESTAMP'] = int(self.timestamp.timestamp())
+        return sensors
+
+    def encoded_sensors(self, index):
+        """JSON-encoded sensors of one device, encoded at most once per tick"""
+        encoded = self._encoded.get(index)
+        if encoded is None:
+            encoded = self._encoded[index] = json_dumps(self.sensors(index))
+        return encoded
+
+    def stats(self):
+        return {
+            "devices": self.size,
+            "groups": len(self.groups),
+            "backend": self.backend,
+            "seed": self.seed,
+            "tick": self.tick,
+            "step_ms": self.step_latency.stats(),
+            "devices_encoded_last_tick": len(self._encoded)
+        }
+
+# Alarm rules used when ALARM_RULES does not name a rules file. Rates are in units per second over
+# the window, "for" holds a condition that many seconds before the alarm is raised
+DEFAULT_ALARM_RULES = [
+    {"id": "ph_high", "channel": "pH", "above": 8.5, "hysteresis": 0.1, "severity": "critical"},
+    {"id": "ph_low", "channel": "pH", "below": 6.5, "hysteresis": 0.1, "severity": "critical"},
+    {"id": "ammonia_high", "channel": "Ammonia", "above": 6.0, "hysteresis": 0.3, "for": 30, "severity": "warning"},
+    {"id": "flow_surge", "channel": "Flow_Modbus", "rate_above": 2.0, "window": 30, "severity": "warning"},
+    {"id": "status_fault", "channel": "STATUS", "equals": "FAULT", "severity": "critical"},
+    {"id": "pump_stopped", "channel": "PUMP", "equals": "OFF", "for": 30, "severity": "warning"}
+]
+ALARM_CONDITIONS = ('above', 'below', 'rate_above', 'rate_below', 'equals')
+ALARM_DEFAULT_RATE_WINDOW = 60.0
+
+class AlarmRule:
+    """One alarm rule and its evaluation state"""
+    __slots__ = ('rule_id', 'channel', 'condition', 'level', 'hysteresis', 'window', 'duration',
+                 'severity', 'met', 'met_since', 'active', 'raised_at', 'value')
+
+    def __init__(self, spec):
+        conditions = [condition for condition in ALARM_CONDITIONS if condition in spec]
+        if 'channel' not in spec or len(conditions) != 1:
+            raise ValueError(f"Rule {spec.get('id')} needs a channel and exactly one of {', '.join(ALARM_CONDITIONS)}")
+        self.channel = spec['channel']
+        self.condition = conditions[0]
+        self.level = spec[self.condition] if self.condition == 'equals' else float(spec[self.condition])
+        self.rule_id = str(spec.get('id') or f"{self.channel}_{self.condition}_{self.level}")
+        self.hysteresis = float(spec.get('hysteresis', 0.0))
+        self.window = float(spec.get('window', ALARM_DEFAULT_RATE_WINDOW)) if self.condition.startswith('rate_') else None
+        self.duration = float(spec.get('for', 0.0))
+        self.severity = spec.get('severity', 'warning')
+        if self.hysteresis < 0 or self.duration < 0 or (self.window is not None and self.window <= 0):
+            raise ValueError(f"Rule {self.rule_id}: hysteresis and for must be >= 0, window > 0")
+
+        self.met = False  # Condition holds, with hysteresis applied
+        self.met_since = None
+        self.active = False  # Alarm raised and not yet cleared
+        self.raised_at = None
+        self.value = None
+
+    @property
+    def signal(self):
+        """Key of the signal the rule watches: the channel, or its rate over a window"""
+        return (self.channel, self.window)
+
+    def describe(self):
+        return {
+            "rule_id": self.rule_id,
+            "channel": self.channel,
+            "severity": self.severity,
+            "condition": self.condition,
+            "threshold": self.level,
+            "hysteresis": self.hysteresis or None,
+            "window": self.window,
+            "for": self.duration or None,
+            "value": self.value,
+            "raised_at": None if self.raised_at is None else datetime.fromtimestamp(self.raised_at).isoformat()
+        }
+
+class ThresholdSet:
+    """Threshold rules over one signal, sorted by level so a new value only visits the rules it crossed"""
+    def __init__(self, rules):
+        above = [rule for rule in rules if rule.condition in ('above', 'rate_above')]
+        below = [rule for rule in rules if rule.condition in ('below', 'rate_below')]
+        # Above rules are met once value > level and stay met until value <= level - hysteresis,
+        # below rules mirror that
+        self.above_rules, self.above_levels = self._sorted(above, lambda rule: rule.level)
+        self.above_clear_rules, self.above_clear_levels = self._sorted(above, lambda rule: rule.level - rule.hysteresis)
+        self.below_rules, self.below_levels = self._sorted(below, lambda rule: rule.level)
+        self.below_clear_rules, self.below_clear_levels = self._sorted(below, lambda rule: rule.level + rule.hysteresis)
+        self.value = None
+
+    @staticmethod
+    def _sorted(rules, level):
+        rules = sorted(rules, key=level)
+        return rules, [level(rule) for rule in rules]
+
+    def update(self, value, changes):
+        """Take a new value and append (rule, met, value) for every rule whose condition flipped"""
+        previous = self.value
+        self.value = value
+        if previous is None:
+            candidates = self.above_rules[:bisect_left(self.above_levels, value)] \
+                + self.below_rules[bisect_right(self.below_levels, value):]
+            changes.extend((rule, True, value) for rule in candidates)
+            return len(candidates)
+
+        if value > previous:
+            raised = self.above_rules[bisect_left(self.above_levels, previous):bisect_left(self.above_levels, value)]
+            cleared = self.below_clear_rules[bisect_right(self.below_clear_levels, previous):bisect_right(self.below_clear_levels, value)]
+        elif value < previous:
+            raised = self.below_rules[bisect_right(self.below_levels, value):bisect_right(self.below_levels, previous)]
+            cleared = self.above_clear_rules[bisect_left(self.above_clear_levels, value):bisect_left(self.above_clear_levels, previous)]
+        else:
+            return 0
+        changes.extend((rule, True, value) for rule in raised if not rule.met)
+        changes.extend((rule, False, value) for rule in cleared if rule.met)
+        return len(raised) + len(cleared)
+
+class RollingRate:
+    """Rate of change of a channel over a sliding time window"""
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+
+    def update(self, timestamp, value):
+        samples = self.samples
+        samples.append((timestamp, value))
+        while timestamp - samples[0][0] > self.window:
+            samples.popleft()
+        first_timestamp, first_value = samples[0]
+        if timestamp <= first_timestamp:
+            return 0.0
+        return (value - first_value) / (timestamp - first_timestamp)
+
+class AlarmEngine:
+    """Incremental alarm evaluation: per-tick cost follows the signals and crossings, not the rule count"""
+    def __init__(self, specs):
+        self.rules = {}
+        for spec in specs:
+            rule = AlarmRule(spec)
+            if rule.rule_id in self.rules:
+                raise ValueError(f"Duplicate alarm rule id: {rule.rule_id}")
+            self.rules[rule.rule_id] = rule
+
+        by_signal = {}
+        self.state_rules = {}  # channel -> {value: [rules]}
+        for rule in self.rules.values():
+            if rule.condition == 'equals':
+                self.state_rules.setdefault(rule.channel, {}).setdefault(rule.level, []).append(rule)
+            else:
+                by_signal.setdefault(rule.signal, []).append(rule)
+        self.thresholds = {signal: ThresholdSet(rules) for signal, rules in by_signal.items()}
+        self.rates = {signal: RollingRate(signal[1]) for signal in self.thresholds if signal[1] is not None}
+        self.state_values = {}
+
+        # Sustained rules waiting out their duration: (deadline, seq, rule, met_since)
+        self.pending = []
+        self.pending_seq = 0
+        self.active = {}
+
+        self.ticks = 0
+        self.rules_visited = 0
+        self.raised = 0
+        self.cleared = 0
+
+    def evaluate(self, snapshot, changed, now):
+        """Evaluate one snapshot and return the (event_type, rule) alarm transitions"""
+        self.ticks += 1
+        changes = []
+        for signal, thresholds in self.thresholds.items():
+            channel, window = signal
+            # Rates move as the window slides, plain thresholds only when the reading changed
+            if window is None and channel not in changed and thresholds.value is not None:
+                continue
+            value = parse_channel_number(channel, snapshot.get(channel))
+            if math.isnan(value):
+                continue
+            if window is not None:
+                value = self.rates[signal].update(now, value)
+            self.rules_visited += thresholds.update(value, changes)
+
+        for channel, rules_by_value in self.state_rules.items():
+            if channel not in changed and channel in self.state_values:
+                continue
+            previous = self.state_values.get(channel)
+            value = snapshot.get(channel)
+            self.state_values[channel] = value
+            for rule in rules_by_value.get(previous, ()):
+                changes.append((rule, False, value))
+            for rule in rules_by_value.get(value, ()):
+                changes.append((rule, True, value))
+
+        events = []
+        for rule, met, value in changes:
+            self.rules_visited += 1
+            rule.value = value
+            rule.met = met
+            if met:
+                rule.met_since = now
+                if rule.duration:
+                    self.pending_seq += 1
+                    heappush(self.pending, (now + rule.duration, self.pending_seq, rule, now))
+                else:
+                    self.raise_alarm(rule, now, events)
+            else:
+                rule.met_since = None
+                if rule.active:
+                    self.clear_alarm(rule, events)
+
+        # Sustained rules whose condition held for the whole duration; entries for conditions
+        # that cleared in between no longer match met_since and are dropped
+        while self.pending and self.pending[0][0] <= now:
+            _, _, rule, met_since = heappop(self.pending)
+            if rule.met and rule.met_since == met_since and not rule.active:
+                self.raise_alarm(rule, now, events)
+        return events
+
+    def raise_alarm(self, rule, now, events):
+        rule.active = True
+        rule.raised_at = now
+        self.active[rule.rule_id] = rule
+        self.raised += 1
+        events.append(("alarm_raised", rule))
+
+    def clear_alarm(self, rule, events):
+        rule.active = False
+        del self.active[rule.rule_id]
+        self.cleared += 1
+        events.append(("alarm_cleared", rule))
+
+    def stats(self):
+        return {
+            "rules": len(self.rules),
+            "signals": len(self.thresholds) + len(self.state_rules),
+            "active": len(self.active),
+            "pending": len(self.pending),
+            "raised": self.raised,
+            "cleared": self.cleared,
+            "avg_rules_visited": round(self.rules_visited / self.ticks, 2) if self.ticks else 0
+        }
+
 class M300WebSocketSimulator:
     """WebSocket-based M300 IoT Gateway Simulator for Flutter App"""
     
-    def __init__(self):
+    def __init__(self, queue_size=None, overflow_policy=None, sample_period=None, history_capacity=None,
+                 keyframe_interval=None, compression=None, signal_models=None, signal_seed=None):
         self.running = True
         self.sensor_data = {}
-        self.data_history = []
+        if history_capacity is None:
+            history_capacity = int(os.environ.get('HISTORY_CAPACITY', 1000))
+        self.data_history = HistoryStore(history_capacity)
+
+        # Optional on-disk history segments, opened when the server starts
+        self.history_dir = os.environ.get('HISTORY_DIR')
+        self.history_segments = None
+        self.history_executor = None  # Single writer thread for segment appends, fsync and rotation
+
+        # Traffic capture: RECORD_FILE writes one, REPLAY_FILE replaces the generator with one
+        self.record_file = os.environ.get('RECORD_FILE')
+        self.capture = None
+        self.replay_file = os.environ.get('REPLAY_FILE')
+        self.replay_speed = float(os.environ.get('REPLAY_SPEED', 1.0))
+        self.replay_loop = query_flag(os.environ, 'REPLAY_LOOP')
+        self.replay_stats = {"passes": 0, "snapshots": 0, "messages": 0, "responses": 0, "seconds": 0.0}
+
+        # Encoded-frame cache, rebuilt once per snapshot version
+        self.snapshot_version = 0
+        self.snapshot_epoch = datetime.now().timestamp()
+        self.snapshot_timestamp = datetime.fromtimestamp(self.snapshot_epoch).isoformat()
+        self.snapshot_second_shared = False  # An earlier snapshot had the same Last-Modified second
+        self._frame_cache = {}
+        self.frames_encoded = 0
+        self.history_generation = 0  # Bumped when history is cleared, part of the /history ETag
         self.connected_clients = {}  # Changed to dict for better tracking
         self.loop = None
         self.client_counter = 0
         self.app = None  # HTTP app instance
+
+        # Per-client outbound queue settings
+        self.queue_size = queue_size or int(os.environ.get('CLIENT_QUEUE_SIZE', 32))
+        self.overflow_policy = overflow_policy or os.environ.get('CLIENT_OVERFLOW_POLICY', OVERFLOW_DROP_OLDEST)
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            logger.warning(f"Unknown overflow policy '{self.overflow_policy}', using {OVERFLOW_DROP_OLDEST}")
+            self.overflow_policy = OVERFLOW_DROP_OLDEST
+        self.dropped_clients = 0
+
+        # Protocol-level liveness: ping clients quiet for PING_INTERVAL seconds and close the ones
+        # that stay silent for PING_TIMEOUT more, PING_INTERVAL=0 turns it off
+        ping_interval = float(os.environ.get('PING_INTERVAL', 20))
+        ping_timeout = float(os.environ.get('PING_TIMEOUT', 10))
+        self.liveness = LivenessMonitor(ping_interval, ping_timeout) if ping_interval > 0 else None
+        self.liveness_task = None
+        self.liveness_tasks = set()
+
+        # Admission control is opt-in: MAX_CONNECTIONS caps connected clients (unset or 0 =
+        # unlimited) and new connections beyond it get a 503
+        self.max_connections = int(os.environ.get('MAX_CONNECTIONS', 0))
+        self.admitting = 0
+        self.rejected_connections = 0
+
+        # Per-client rate limits, off unless RATE_LIMITING=1. RATE_LIMITS overrides entries
+        # as {"type": [rate, burst]}
+        self.rate_limiting_enabled = env_flag('RATE_LIMITING', False)
+        self.rate_limits = None
+        if self.rate_limiting_enabled:
+            self.rate_limits = dict(RATE_LIMITS)
+            overrides = json.loads(os.environ.get('RATE_LIMITS') or '{}')
+            for message_type, (rate, burst) in overrides.items():
+                if float(rate) <= 0 or float(burst) < 1:
+                    raise ValueError(f"Rate limit for {message_type} needs rate > 0 and burst >= 1")
+                self.rate_limits[message_type] = (float(rate), float(burst))
+        self.rate_limited_requests = 0
+
+        # Expensive requests run a few at a time so they cannot crowd out the broadcast loop
+        self.expensive_concurrency = max(1, int(os.environ.get('EXPENSIVE_REQUEST_CONCURRENCY', 2)))
+        self.expensive_slots = asyncio.Semaphore(self.expensive_concurrency)
+        # How many may wait for a slot before new ones are answered "busy" (unset or 0 = no limit)
+        self.expensive_queue_limit = int(os.environ.get('EXPENSIVE_QUEUE_LIMIT', 0))
+        self.expensive_waiting = 0
+        self.expensive_rejected = 0
         
-        # Setup mock data generation
-        self.setup_mock_data()
-        
+        # Sampling scheduler settings
+        if sample_period is None:
+            sample_period = float(os.environ.get('SAMPLE_PERIOD', 3.0))
+        self.sample_period = min(max(sample_period, MIN_SAMPLE_PERIOD), MAX_SAMPLE_PERIOD)
+        self.generator_task = None
+        self.missed_ticks = 0
+
+        # Per-channel signal models, SIGNAL_SEED makes the sample stream reproducible
+        if signal_models is None:
+            preset = os.environ.get('SIGNAL_MODELS', 'plausible')
+            if preset not in SIGNAL_PRESETS:
+                logger.warning(f"Unknown SIGNAL_MODELS preset {preset}, using plausible")
+                preset = 'plausible'
+            signal_models = SIGNAL_PRESETS[preset]()
+        if signal_seed is None and os.environ.get('SIGNAL_SEED'):
+            signal_seed = int(os.environ['SIGNAL_SEED'])
+        self.signals = SignalGenerator(signal_models, signal_seed, self.sample_period,
+                                       float(os.environ.get('SIGNAL_DAY_LENGTH', 86400)))
+
+        # Delta-encoded broadcasts send a full keyframe every N snapshots
+        if keyframe_interval is None:
+            keyframe_interval = int(os.environ.get('DELTA_KEYFRAME_INTERVAL', 20))
+        self.keyframe_interval = max(1, keyframe_interval)
+        self._previous_snapshot = {}
+        self.keyframes_sent = 0
+        self.deltas_sent = 0
+
+        # Subscription index: channel selection -> clients sharing it
+        self.subscription_index = {None: SubscriptionGroup(None)}
+
+        # Multi-process mode: the producer serves a snapshot feed, workers consume it
+        self.worker_index = None
+        self.client_counts = None  # Shared array of per-worker client counts
+        self.feed_port = None
+        self.feed_writers = set()
+
+        # Embedded Modbus TCP server, opt-in: only started when MODBUS_PORT is set (0 = off)
+        self.modbus_port = int(os.environ.get('MODBUS_PORT') or 0)
+        self.modbus_host = os.environ.get('MODBUS_HOST', '0.0.0.0')
+        self.modbus_server = None
+        self.modbus_bank = None
+        self.modbus_writes = {}  # Register writes, held like actuator commands until released
+
+        # Raw TCP gateway: sensors on DIGITAL_PORT, actuators on ACTUATOR_PORT, uplink to the controller
+        self.gateway_enabled = query_flag(os.environ, 'GATEWAY')
+        self.gateway_host = os.environ.get('GATEWAY_HOST', '0.0.0.0')
+        self.digital_port = int(os.environ.get('DIGITAL_PORT', 5000))
+        self.actuator_port = int(os.environ.get('ACTUATOR_PORT', 5001))
+        self.controller_host = os.environ.get('CONTROLLER_HOST', '127.0.0.1')
+        self.controller_port = int(os.environ.get('CONTROLLER_PORT', 6000))
+        self.gateway_servers = []
+        self.gateway_tasks = []
+        self.gateway_values = {}  # Latest values from gateway sensors, these win over generated ones
+        self.actuator_writers = set()
+        self.uplink_queue = deque(maxlen=GATEWAY_UPLINK_PENDING)
+        self.uplink_ready = asyncio.Event()
+        self.uplink_connected = False
+        self.uplink_batches = 0
+        self.uplink_lines = 0
+        self.uplink_reconnects = 0
+        self.commands_forwarded = 0
+        self.gateway_frames = 0
+        self.gateway_errors = 0
+        self.gateway_latency = LatencyStats()
+
+        # Actuator commands from WebSocket clients, applied through one queue per device
+        self.actuator_state = {}  # Commanded values, these win over generated ones
+        self.generated_values = {}  # Newest model output, restored when a command is released
+        self.command_queues = {}
+        self.command_counter = 0
+        self.command_latency = LatencyStats()
+
+        # Fleet mode: FLEET_SIZE virtual gateways next to the main one, streamed on /ws/{device_id}
+        fleet_size = int(os.environ.get('FLEET_SIZE', 0))
+        self.fleet = None
+        if fleet_size > 0:
+            seed = os.environ.get('FLEET_SEED')
+            self.fleet = DeviceFleet(fleet_size, int(os.environ.get('FLEET_GROUP_SIZE', 100)),
+                                     int(seed) if seed is not None else None)
+            self.fleet.step()
+        self.fleet_subscribers = {}  # ('device', id) or ('group', name) -> client ids
+        # Producer process only: the fleet workers step to, published with every feed snapshot
+        self.feed_fleet_seed = None
+        self.feed_fleet_tick = 0
+        self.fleet_frames = 0
+
+        # Per-message deflate settings for /ws
+        if compression is None:
+            compression = env_flag('WS_COMPRESSION', True)
+        self.compression = compression
+        self.compressor = FrameCompressor(
+            threshold=int(os.environ.get('WS_COMPRESSION_THRESHOLD', 512)),
+            level=int(os.environ.get('WS_COMPRESSION_LEVEL', 1))
+        )
+
+        # Encode cost and payload size per wire format
+        self.encoding_stats = {}
+
+        # Derived system status block, cached per snapshot version
+        self._system_status = None
+        self._system_status_key = None
+
+        # Message type -> handler, shared by every transport
+        self.message_handlers = {
+            "get_sensors": self.handle_get_sensors,
+            "get_status": self.handle_get_status,
+            "get_history": self.handle_get_history,
+            "resync": self.handle_resync,
+            "subscribe": self.handle_subscribe,
+            "unsubscribe": self.handle_subscribe,
+            "clear_history": self.handle_clear_history,
+            "ping": self.handle_ping,
+            "get_client_info": self.handle_get_client_info,
+            "batch": self.handle_batch,
+            "get_schema": self.handle_get_schema,
+            "set_actuator": self.handle_command,
+            "command": self.handle_command,
+            "subscribe_devices": self.handle_device_subscription,
+            "unsubscribe_devices": self.handle_device_subscription,
+            "get_fleet": self.handle_get_fleet,
+            "get_device": self.handle_get_device,
+            "subscribe_alarms": self.handle_alarm_subscription,
+            "unsubscribe_alarms": self.handle_alarm_subscription,
+            "get_alarms": self.handle_get_alarms
+        }
+
+        # Alarm rules from the JSON file named by ALARM_RULES, built-in defaults otherwise
+        self.alarm_engine = self.load_alarm_rules(os.environ.get('ALARM_RULES'))
+        self.alarm_subscribers = set()
+
+        # Hot-path metrics served on /metrics, METRICS=0 turns them off
+        self.metrics = Metrics(self.message_handlers) if env_flag('METRICS', True) else None
+        self.loop_lag_task = None
+
+    def load_alarm_rules(self, path):
+        """Build the alarm engine, None when the rules are unusable or empty"""
+        try:
+            if path:
+                with open(path) as f:
+                    specs = json.load(f)
+            else:
+                specs = DEFAULT_ALARM_RULES
+            engine = AlarmEngine(specs)
+        except (OSError, TypeError, ValueError, KeyError) as e:
+            logger.error(f"Alarm rules {path or '(defaults)'} are unusable ({e}), alarms disabled")
+            return None
+        if not engine.rules:
+            return None
+        logger.info(f"Loaded {len(engine.rules)} alarm rules{f' from {path}' if path else ''}")
+        return engine
+
     def setup_mock_data(self):
-        """Setup mock data generation in background thread"""
-        data_thread = threading.Thread(target=self.generate_mock_data)
-        data_thread.daemon = True
-        data_thread.start()
-    
-    def generate_mock_data(self):
-        """Generate realistic mock sensor data and broadcast to clients"""
+        """Setup mock data generation as a task on the running event loop"""
+        if self.record_file:
+            self.capture = CaptureWriter(self.record_file)
+            logger.info(f"Recording snapshots and client messages to {self.record_file}")
+        if self.replay_file:
+            self.generator_task = asyncio.create_task(self.replay_capture())
+        else:
+            self.generator_task = asyncio.create_task(self.generate_mock_data())
+
+    def close_capture(self):
+        """Flush and close the capture being recorded"""
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+
+    async def replay_capture(self):
+        """Replay a capture file instead of generating samples, streaming it from disk"""
+        replay_clients = {}
         while self.running:
+            started = time.perf_counter()
             try:
-                # Generate Modbus sensor data (Water Quality)
-                modbus_data = {
-                    'pH': round(random.uniform(6.5, 8.5), 2),
-                    'TSS': round(random.uniform(20, 120), 1),
-                    'COD': round(random.uniform(50, 250), 1),
-                    'Ammonia': round(random.uniform(0.5, 8.0), 2),
-                    'Flow_Modbus': round(random.uniform(100, 400), 1),
-                    'Pressure': round(random.uniform(1.0, 2.5), 2)
-                }
-                
-                # Generate Digital sensor data (Operational)
-                digital_data = {
-                    'FLOW': f"{random.uniform(25, 45):.1f}L/min",
-                    'ACTUATOR': f"{random.uniform(30, 80):.1f}%",
-                    'STATUS': random.choice(['OK', 'OK', 'OK', 'WARN', 'FAULT']),
-                    'PUMP': random.choice(['ON', 'OFF']),
-                    'ALARM': random.choice(['NORMAL', 'NORMAL', 'NORMAL', 'ALARM']),
-                    'TIMESTAMP': int(datetime.now().timestamp())
-                }
-                
-                # Update sensor data
-                self.sensor_data.update(modbus_data)
-                self.sensor_data.update(digital_data)
-                
-                # Create message for WebSocket clients
-                message = {
-                    "type": "sensor_update",
-                    "timestamp": datetime.now().isoformat(),
-                    "sensors": self.sensor_data,
-                    "status": "active"
-                }
-                
-                # Add to history
-                history_entry = {
-                    "timestamp": datetime.now().isoformat(),
-                    "type": "sensor_update",
-                    "data": dict(self.sensor_data)
-                }
-                
-                self.data_history.append(history_entry)
-                
-                # Keep only last 1000 records
-                if len(self.data_history) > 1000:
-                    self.data_history.pop(0)
-                
-                # Broadcast to all connected WebSocket clients
-                if self.connected_clients and self.loop:
-                    try:
-                        asyncio.run_coroutine_threadsafe(
-                            self.broadcast_to_http_ws_clients(message), 
-                            self.loop
-                        ).result(timeout=1.0)
-                    except Exception as e:
-                        logger.error(f"Error broadcasting: {e}")
-                
-                # Sleep for 3 seconds
-                time.sleep(3)
-                
+                async for kind, offset, payload in paced(read_capture(self.replay_file), self.replay_speed):
+                    if kind == CAPTURE_SNAPSHOT:
+                        # Replayed snapshots are stamped with the current time so history stays ordered
+                        await self.apply_snapshot(json.loads(payload)["sensors"])
+                        if self.fleet:
+                            await self.broadcast_fleet()
+                        self.replay_stats["snapshots"] += 1
+                    elif kind == CAPTURE_CLIENT_MESSAGE:
+                        await self.replay_message(replay_clients, payload)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error replaying {self.replay_file}: {e}")
+                return
+            self.replay_stats["passes"] += 1
+            self.replay_stats["seconds"] += time.perf_counter() - started
+            logger.info(f"Replay of {self.replay_file} finished ({self.replay_stats['snapshots']} snapshots so far)")
+            if not self.replay_loop:
+                return
+
+    async def replay_message(self, replay_clients, payload):
+        """Run a recorded read-only request through the handler table, discarding the response"""
+        client_id, _, message = payload.partition(b'\0')
+        try:
+            # Text frames are recorded as UTF-8, binary frames as received, tag byte first
+            if message[:1] in (bytes((BINARY_TAG_MSGPACK,)), bytes((BINARY_TAG_JSON,))):
+                data = decode_message(message)
+            else:
+                data = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(data, dict) or data.get("type") not in REPLAY_REQUEST_TYPES:
+            return
+        self.replay_stats["messages"] += 1
+        client_id = client_id.decode('utf-8', 'replace')
+        client_conn = replay_clients.get(client_id)
+        if client_conn is None:
+            # Detached connection, never registered for broadcasts
+            client_conn = replay_clients[client_id] = ClientConnection(None, f"replay-{client_id}")
+        if await self.build_response(client_conn, data) is not None:
+            self.replay_stats["responses"] += 1
+
+    def capture_stats(self):
+        """Recording and replay state for the health endpoint"""
+        if not self.capture and not self.replay_file:
+            return None
+        replay = None
+        if self.replay_file:
+            replay = dict(self.replay_stats, file=self.replay_file, speed=self.replay_speed, loop=self.replay_loop)
+        return {
+            "recording": self.capture.stats() if self.capture else None,
+            "replay": replay
+        }
+
+    def generate_sample(self):
+        """Generate one coherent snapshot of realistic mock sensor data"""
+        # Step every channel model together for this tick
+        values = self.signals.step()
+
+        # Digital sensors report some readings with their unit attached
+        for channel, suffix in HISTORY_UNIT_SUFFIXES.items():
+            if channel in values:
+                values[channel] = f"{values[channel]:.1f}{suffix}"
+        values['TIMESTAMP'] = int(datetime.now().timestamp())
+        self.generated_values = values
+
+        # Build a new dict so readers never see a half-updated snapshot
+        snapshot = dict(self.sensor_data)
+        snapshot.update(values)
+
+        # Commanded actuators hold their value until released
+        if self.actuator_state:
+            snapshot.update(self.actuator_state)
+
+        # Channels fed by a connected gateway sensor keep their ingested values
+        if self.gateway_values:
+            snapshot.update(self.gateway_values)
+
+        # Values written by Modbus clients hold until rewritten or released
+        if self.modbus_writes:
+            snapshot.update(self.modbus_writes)
+        return snapshot
+
+    async def generate_mock_data(self):
+        """Generate mock sensor data on a drift-free schedule and broadcast to clients"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+
+        while self.running:
+            try:
+                started = time.perf_counter()
+                if self.feed_fleet_seed is not None:
+                    self.feed_fleet_tick += 1
+                await self.apply_snapshot(self.generate_sample())
+                if self.fleet:
+                    await self.broadcast_fleet()
+                if self.metrics:
+                    self.metrics.tick_seconds.observe(time.perf_counter() - started)
+
             except Exception as e:
                 logger.error(f"Error generating mock data: {e}")
-                time.sleep(5)
-    
-    async def broadcast_to_clients(self, message):
-        """Broadcast message to all connected WebSocket clients"""
-        if not self.connected_clients:
+
+            # Schedule against absolute deadlines so send time never adds drift
+            next_tick += self.sample_period
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # Skip ticks we are too late for instead of bursting to catch up
+                missed = int(-delay // self.sample_period) + 1
+                self.missed_ticks += missed
+                next_tick += missed * self.sample_period
+                delay = next_tick - loop.time()
+                logger.warning(f"Sampling fell behind, skipped {missed} tick(s)")
+            await asyncio.sleep(delay)
+
+    async def apply_snapshot(self, snapshot, epoch=None):
+        """Make a snapshot current, record it and fan it out to clients and feed subscribers"""
+        previous = self.sensor_data
+        self.sensor_data = snapshot
+
+        # Encode the update once for every WebSocket client
+        self.publish_snapshot(previous, epoch)
+
+        if self.capture:
+            self.capture.write(CAPTURE_SNAPSHOT, build_frame({"epoch": self.snapshot_epoch}, sensors=self.encoded_sensors()).encode('utf-8'))
+
+        # Add to history, the ring buffer overwrites the oldest record when full
+        self.data_history.append(self.snapshot_epoch, self.sensor_data)
+        if self.history_segments and not self.history_segments.readonly:
+            self.persist_history()
+
+        # Queue the update on every client without waiting for delivery
+        started = time.perf_counter()
+        await self.broadcast_snapshot()
+        if self.metrics:
+            self.metrics.fanout_seconds.observe(time.perf_counter() - started)
+
+        if self.alarm_engine:
+            events = self.alarm_engine.evaluate(self.sensor_data, self.changed_keys(), self.snapshot_epoch)
+            if events:
+                await self.push_alarm_events(events)
+
+        if self.feed_writers:
+            self.publish_to_feed()
+
+        if self.modbus_bank:
+            self.modbus_bank.publish(self.sensor_data)
+
+        if self.gateway_tasks:
+            self.queue_snapshot_uplink(previous)
+
+    def open_history_segments(self, readonly=False):
+        """Open the on-disk history and warm-start the ring buffer from its newest records"""
+        if not self.history_dir:
             return
-            
-        message_str = json.dumps(message)
-        disconnected_clients = []
-        
-        for client_id, client_conn in list(self.connected_clients.items()):
+        store = SegmentStore(
+            self.history_dir,
+            segment_records=int(os.environ.get('HISTORY_SEGMENT_RECORDS', 10000)),
+            retention=int(os.environ.get('HISTORY_RETENTION_SEGMENTS', 48)),
+            fsync_interval=float(os.environ.get('HISTORY_FSYNC_INTERVAL', 5.0)),
+            readonly=readonly
+        )
+        try:
+            state_labels = store.load_state_labels()
+        except (ValueError, KeyError, OSError) as e:
+            logger.error(f"History segments in {self.history_dir} are unusable ({e}), persistence disabled")
+            return
+        if state_labels:
+            self.data_history.set_state_labels(state_labels)
+        self.data_history.load_rows(store.pack(limit=self.data_history.capacity))
+        self.history_segments = store
+        if not readonly:
+            self.history_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-writer')
+        logger.info(f"History segments in {self.history_dir}, warm-started {len(self.data_history)} records")
+
+    def close_history_segments(self):
+        """Finish queued writes, then sync and close the active history segment"""
+        if self.history_executor:
+            self.history_executor.shutdown(wait=True)
+            self.history_executor = None
+        if self.history_segments:
+            self.history_segments.close()
+
+    def persist_history(self):
+        """Queue the newest ring record for the history writer thread"""
+        if self.history_executor is None:
+            return
+        count = len(self.data_history)
+        row = self.data_history.pack_range(count - 1, count)
+        # The writer thread gets its own copy, the ring keeps registering labels meanwhile
+        state_labels = {channel: list(labels) for channel, labels in self.data_history.state_labels.items()}
+        future = asyncio.get_running_loop().run_in_executor(self.history_executor, self.write_history_row, row, state_labels)
+        future.add_done_callback(self.log_history_write_error)
+
+    def log_history_write_error(self, future):
+        """Log writer thread failures that write_history_row does not handle itself"""
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Error persisting history row: {future.exception()!r}")
+
+    def write_history_row(self, row, state_labels):
+        """Runs on the history writer thread, so fsync and rotation never stall the event loop"""
+        try:
+            self.history_segments.append(row, state_labels)
+        except OSError as e:
+            logger.error(f"Error writing history segment: {e}")
+
+    def history_from_disk(self, start, limit, history=None):
+        """True when a query reaches past what the in-memory ring holds"""
+        if self.history_segments is None:
+            return False
+        history = self.data_history if history is None else history
+        oldest = history.oldest_timestamp()
+        if oldest is None:
+            return True
+        if start is not None:
+            return start < oldest
+        return float(limit) > len(history)
+
+    def start_modbus_server(self):
+        """Start the Modbus TCP server in its own thread, serving registers from the data bank"""
+        if not self.modbus_port:
+            return
+        self.modbus_bank = SensorDataBank(self.on_modbus_write)
+        if self.sensor_data:
+            self.modbus_bank.publish(self.sensor_data)
+        self.modbus_server = ModbusServer(host=self.modbus_host, port=self.modbus_port,
+                                          no_block=True, data_bank=self.modbus_bank)
+        try:
+            self.modbus_server.start()
+            logger.info(f"Modbus TCP server listening on {self.modbus_host}:{self.modbus_port}")
+        except Exception as e:
+            logger.error(f"Modbus TCP server failed to start on port {self.modbus_port}: {e}")
+            self.modbus_server = None
+            self.modbus_bank = None
+
+    def stop_modbus_server(self):
+        """Stop the Modbus TCP server thread"""
+        if self.modbus_server:
+            self.modbus_server.stop()
+            self.modbus_server = None
+
+    def on_modbus_write(self, address, value):
+        """Hand a holding register write from the Modbus thread to the event loop"""
+        channel, scale = MODBUS_CHANNEL_BY_REGISTER[address]
+        if value == MODBUS_RELEASE_VALUE:
+            self.loop.call_soon_threadsafe(self.modbus_writes.pop, channel, None)
+        else:
+            self.loop.call_soon_threadsafe(self.modbus_writes.__setitem__, channel, value / scale)
+
+    def modbus_stats(self):
+        """Modbus server state for the health endpoint"""
+        if not self.modbus_bank:
+            return None
+        return {
+            "port": self.modbus_port,
+            "registers": {channel: {"address": address, "scale": scale}
+                          for channel, (address, scale) in MODBUS_REGISTER_MAP.items()},
+            "updates": self.modbus_bank.updates,
+            "client_writes": self.modbus_bank.writes,
+            "held_writes": dict(self.modbus_writes),
+            "clamped_values": self.modbus_bank.clamped
+        }
+
+    async def start_gateway(self):
+        """Start the digital sensor and actuator listeners and the controller uplink"""
+        if not self.gateway_enabled:
+            return
+        limit = GATEWAY_READ_LIMIT
+        try:
+            # Track each listener as soon as it binds so a failure on the second closes the first
+            for handler, port in ((self.handle_digital_sensor, self.digital_port),
+                                  (self.handle_actuator, self.actuator_port)):
+                self.gateway_servers.append(await asyncio.start_server(handler, self.gateway_host, port, limit=limit))
+        except OSError as e:
+            logger.error(f"Gateway failed to start on ports {self.digital_port}/{self.actuator_port}: {e}")
+            for server in self.gateway_servers:
+                server.close()
+            self.gateway_servers = []
+            return
+        self.gateway_tasks = [asyncio.create_task(self.controller_uplink())]
+        logger.info(f"Gateway listening on {self.digital_port} (sensors) and {self.actuator_port} (actuators), "
+                    f"uplink to {self.controller_host}:{self.controller_port}")
+
+    async def stop_gateway(self):
+        """Close gateway listeners and the controller uplink"""
+        for task in self.gateway_tasks:
+            task.cancel()
+        for server in self.gateway_servers:
+            server.close()
+        for writer in list(self.actuator_writers):
+            writer.close()
+        self.gateway_tasks = []
+        self.gateway_servers = []
+
+    async def read_lines(self, reader):
+        """Yield newline-framed lines from a stream, dropping frames longer than the read limit"""
+        while True:
             try:
-                await client_conn.websocket.send(message_str)
-                client_conn.update_activity()
-            except websockets.exceptions.ConnectionClosed:
-                logger.info(f"Client {client_id} connection closed during broadcast")
-                disconnected_clients.append(client_id)
-            except Exception as e:
-                logger.error(f"Error sending to client {client_id}: {e}")
-                disconnected_clients.append(client_id)
-        
-        # Remove disconnected clients
-        for client_id in disconnected_clients:
-            await self.remove_client(client_id)
-    
-    async def broadcast_to_http_ws_clients(self, message):
-        """Broadcast to HTTP WebSocket clients"""
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                # Connection closed, a trailing unterminated frame is still a message
+                if e.partial.strip():
+                    yield e.partial.strip()
+                return
+            except asyncio.LimitOverrunError as e:
+                logger.warning("Gateway frame exceeds read limit, discarding")
+                await reader.readexactly(e.consumed)
+                continue
+            line = line.strip()
+            if line:
+                yield line
+
+    def parse_gateway_line(self, line):
+        """Parse a DIGITAL|... or MODBUS|... frame into snapshot values"""
+        fields = line.split(b'|')
+        if fields[0] == b'TCP':
+            fields = fields[1:]
+        if not fields:
+            raise ValueError("Empty gateway frame")
+        source = fields[0]
+        if source == b'DIGITAL':
+            values = {}
+            for field in fields[1:]:
+                key, sep, value = field.partition(b':')
+                key = key.decode('ascii', 'replace')
+                if not sep:
+                    continue
+                if key == 'TS':
+                    values['TIMESTAMP'] = int(float(value))
+                elif key in GATEWAY_DIGITAL_FIELDS:
+                    values[key] = value.decode('utf-8', 'replace')
+            return values
+        if source == b'MODBUS':
+            values = {}
+            for field in fields[1:]:
+                key, sep, value = field.partition(b':')
+                key = GATEWAY_MODBUS_ALIASES.get(key.decode('ascii', 'replace'), key.decode('ascii', 'replace'))
+                if sep and key in MODBUS_REGISTER_MAP:
+                    number = float(value)
+                    # Registers hold scaled integers, inf or nan cannot be published
+                    if not math.isfinite(number):
+                        raise ValueError(f"Non-finite value for {key}")
+                    values[key] = number
+            return values
+        raise ValueError(f"Unknown gateway frame source: {source[:32]!r}")
+
+    async def ingest_gateway_values(self, values, received_at):
+        """Merge values from a gateway sensor into a new snapshot and publish it right away"""
+        self.gateway_values.update(values)
+        snapshot = dict(self.sensor_data)
+        snapshot.update(values)
+        await self.apply_snapshot(snapshot)
+        self.gateway_latency.record(time.perf_counter() - received_at)
+        self.gateway_frames += 1
+
+    async def handle_digital_sensor(self, reader, writer):
+        """Serve one sensor connection on the digital port, acknowledging every frame"""
+        peer = writer.get_extra_info('peername')
+        logger.info(f"Gateway sensor connected from {peer}")
+        supplied = set()
+        try:
+            async for line in self.read_lines(reader):
+                received_at = time.perf_counter()
+                try:
+                    values = self.parse_gateway_line(line)
+                except (IndexError, OverflowError, ValueError) as e:
+                    self.gateway_errors += 1
+                    logger.warning(f"Invalid gateway frame from {peer}: {e}")
+                    writer.write(b'NACK\n')
+                    continue
+                if values:
+                    supplied.update(values)
+                    await self.ingest_gateway_values(values, received_at)
+                writer.write(b'ACK\n')
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # The generator takes these channels back once their sensor is gone
+            for key in supplied:
+                self.gateway_values.pop(key, None)
+            writer.close()
+            logger.info(f"Gateway sensor disconnected from {peer}")
+
+    async def handle_actuator(self, reader, writer):
+        """Serve one actuator connection, forwarding its status reports to the controller"""
+        peer = writer.get_extra_info('peername')
+        logger.info(f"Actuator connected from {peer}")
+        self.actuator_writers.add(writer)
+        try:
+            async for line in self.read_lines(reader):
+                if line.startswith(b'STATUS|'):
+                    self.queue_uplink(line)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.actuator_writers.discard(writer)
+            writer.close()
+            logger.info(f"Actuator disconnected from {peer}")
+
+    def forward_to_actuators(self, line):
+        """Send a controller command to every connected actuator"""
+        frame = line + b'\n'
+        for writer in list(self.actuator_writers):
+            if writer.is_closing():
+                self.actuator_writers.discard(writer)
+            elif writer.transport.get_write_buffer_size() > GATEWAY_MAX_BUFFER:
+                logger.warning("Actuator is not reading commands, skipping")
+            else:
+                writer.write(frame)
+        self.commands_forwarded += 1
+
+    def queue_uplink(self, line):
+        """Queue a line for the controller, the uplink task flushes queued lines in one write"""
+        self.uplink_queue.append(line + b'\n')
+        self.uplink_ready.set()
+
+    def queue_snapshot_uplink(self, previous):
+        """Forward changed Modbus and digital values to the controller in the README framing"""
+        snapshot = self.sensor_data
+        if any(snapshot.get(key) != previous.get(key) for key in MODBUS_REGISTER_MAP):
+            self.queue_uplink(b'MODBUS|' + '|'.join(
+                f"{key}:{snapshot[key]}" for key in MODBUS_REGISTER_MAP if key in snapshot).encode('utf-8'))
+        if any(snapshot.get(key) != previous.get(key) for key in GATEWAY_DIGITAL_FIELDS):
+            fields = [f"{key}:{snapshot[key]}" for key in GATEWAY_DIGITAL_FIELDS if key in snapshot]
+            fields.append(f"TS:{snapshot.get('TIMESTAMP', int(time.time()))}")
+            self.queue_uplink(b'TCP|DIGITAL|' + '|'.join(fields).encode('utf-8'))
+
+    async def controller_uplink(self):
+        """Keep a connection to the controller, batching writes and reconnecting with backoff"""
+        retry_delay = GATEWAY_RETRY_MIN
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_connection(self.controller_host, self.controller_port)
+            except (ConnectionError, OSError) as e:
+                self.uplink_reconnects += 1
+                logger.warning(f"Controller {self.controller_host}:{self.controller_port} unavailable: {e}, "
+                               f"retrying in {retry_delay:g}s")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, GATEWAY_RETRY_MAX)
+                continue
+
+            logger.info(f"Connected to controller at {self.controller_host}:{self.controller_port}")
+            self.uplink_connected = True
+            retry_delay = GATEWAY_RETRY_MIN
+            commands_task = asyncio.create_task(self.read_controller_commands(reader))
+            try:
+                while self.running and not commands_task.done():
+                    if not self.uplink_queue:
+                        self.uplink_ready.clear()
+                        waiter = asyncio.create_task(self.uplink_ready.wait())
+                        await asyncio.wait({waiter, commands_task}, return_when=asyncio.FIRST_COMPLETED)
+                        waiter.cancel()
+                        continue
+                    # Everything queued since the last flush goes out in one write
+                    batch = list(self.uplink_queue)
+                    self.uplink_queue.clear()
+                    writer.writelines(batch)
+                    await writer.drain()
+                    self.uplink_batches += 1
+                    self.uplink_lines += len(batch)
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Controller connection lost: {e}")
+            finally:
+                self.uplink_connected = False
+                commands_task.cancel()
+                writer.close()
+
+    async def read_controller_commands(self, reader):
+        """Forward ACTUATOR_CMD lines from the controller to the actuators"""
+        async for line in self.read_lines(reader):
+            if line.startswith(b'ACTUATOR_CMD|'):
+                self.forward_to_actuators(line)
+
+    def gateway_stats(self):
+        """Gateway listener and uplink state for the health endpoint"""
+        if not self.gateway_enabled:
+            return None
+        return {
+            "digital_port": self.digital_port,
+            "actuator_port": self.actuator_port,
+            "controller": f"{self.controller_host}:{self.controller_port}",
+            "uplink_connected": self.uplink_connected,
+            "uplink_pending": len(self.uplink_queue),
+            "uplink_batches": self.uplink_batches,
+            "uplink_lines": self.uplink_lines,
+            "uplink_reconnects": self.uplink_reconnects,
+            "actuators": len(self.actuator_writers),
+            "commands_forwarded": self.commands_forwarded,
+            "frames_ingested": self.gateway_frames,
+            "frame_errors": self.gateway_errors,
+            "ingest_to_broadcast_ms": self.gateway_latency.stats()
+        }
+
+    def publish_snapshot(self, previous=None, epoch=None):
+        """Start a new snapshot version and return its encoded sensor_update frame"""
+        now = datetime.now() if epoch is None else datetime.fromtimestamp(epoch)
+        self._previous_snapshot = previous if previous is not None else {}
+        self.snapshot_version += 1
+        self.snapshot_second_shared = self.snapshot_version > 1 and math.ceil(now.timestamp()) == math.ceil(self.snapshot_epoch)
+        self.snapshot_epoch = now.timestamp()
+        self.snapshot_timestamp = now.isoformat()
+        # Swap in a fresh cache so readers of the previous version keep a consistent view
+        self._frame_cache = {}
+        self.compressor.reset()
+        return self.get_snapshot_frame("sensor_update")
+
+    def encoded_sensors(self):
+        """Return the JSON encoding of the current sensor snapshot"""
+        cache = self._frame_cache
+        sensors = cache.get("sensors")
+        if sensors is None:
+            sensors = json_dumps(self.sensor_data)
+            cache["sensors"] = sensors
+            self.frames_encoded += 1
+        return sensors
+
+    def get_snapshot_frame(self, frame_type):
+        """Return the encoded sensor frame of the given type for the current snapshot"""
+        cache = self._frame_cache
+        frame = cache.get(frame_type)
+        if frame is None:
+            started = time.perf_counter()
+            frame = build_frame({
+                "type": frame_type,
+                "timestamp": self.snapshot_timestamp,
+                "seq": self.snapshot_version,
+                "status": "active"
+            }, sensors=self.encoded_sensors())
+            self.record_encoding("json", len(frame), time.perf_counter() - started)
+            cache[frame_type] = frame
+        return frame
+
+    def get_packed_sensor_frame(self, kind=BINARY_KIND_SENSOR_UPDATE):
+        """Return the packed binary sensor frame for the current snapshot"""
+        cache = self._frame_cache
+        cache_key = ("packed", kind)
+        frame = cache.get(cache_key)
+        if frame is None:
+            started = time.perf_counter()
+            frame = SENSOR_FRAME_HEADER.pack(BINARY_TAG_SENSOR, kind, self.snapshot_version & 0xFFFFFFFF) \
+                + self.data_history.pack_snapshot(self.snapshot_epoch, self.sensor_data)
+            self.record_encoding("packed", len(frame), time.perf_counter() - started)
+            cache[cache_key] = frame
+        return frame
+
+    def encode_binary(self, message):
+        """Encode a message for a binary client, keeping pre-encoded JSON as is"""
+        started = time.perf_counter()
+        if isinstance(message, str):
+            frame = bytes((BINARY_TAG_JSON,)) + message.encode('utf-8')
+            self.record_encoding("binary_json", len(frame), time.perf_counter() - started)
+        elif msgpack is not None:
+            frame = bytes((BINARY_TAG_MSGPACK,)) + msgpack.packb(message)
+            self.record_encoding("msgpack", len(frame), time.perf_counter() - started)
+        else:
+            frame = bytes((BINARY_TAG_JSON,)) + json_dumps(message).encode('utf-8')
+            self.record_encoding("binary_json", len(frame), time.perf_counter() - started)
+        return frame
+
+    def record_encoding(self, wire_format, size, seconds):
+        """Accumulate encode count, bytes and time for a wire format"""
+        stats = self.encoding_stats.get(wire_format)
+        if stats is None:
+            stats = self.encoding_stats[wire_format] = [0, 0, 0.0]
+        stats[0] += 1
+        stats[1] += size
+        stats[2] += seconds
+        if self.metrics:
+            self.metrics.encode_seconds.observe(seconds)
+
+    def encoding_report(self):
+        """Summarize encode cost and payload size per wire format"""
+        return {
+            wire_format: {
+                "frames": frames,
+                "bytes": size,
+                "avg_bytes": round(size / frames, 1) if frames else 0,
+                "avg_encode_us": round(seconds / frames * 1e6, 2) if frames else 0
+            }
+            for wire_format, (frames, size, seconds) in self.encoding_stats.items()
+        }
+
+    def changed_keys(self):
+        """Return the keys that changed or disappeared since the previous snapshot"""
+        cache = self._frame_cache
+        changed = cache.get("changed_keys")
+        if changed is None:
+            previous = self._previous_snapshot
+            changed = {key for key, value in self.sensor_data.items()
+                       if key not in previous or previous[key] != value}
+            changed.update(key for key in previous if key not in self.sensor_data)
+            cache["changed_keys"] = changed
+        return changed
+
+    def get_delta_frame(self):
+        """Return the sensor_delta frame holding only the keys changed since the previous snapshot"""
+        cache = self._frame_cache
+        frame = cache.get("sensor_delta")
+        if frame is None:
+            changed_keys = self.changed_keys()
+            message = {
+                "type": "sensor_delta",
+                "timestamp": self.snapshot_timestamp,
+                "seq": self.snapshot_version,
+                "base_seq": self.snapshot_version - 1,
+                "changed": {key: value for key, value in self.sensor_data.items() if key in changed_keys}
+            }
+            removed = [key for key in changed_keys if key not in self.sensor_data]
+            if removed:
+                message["removed"] = removed
+            frame = json_dumps(message)
+            cache["sensor_delta"] = frame
+            self.frames_encoded += 1
+        return frame
+
+    def encode_filtered_keyframe(self, group):
+        """Encode a sensor_update holding only the keys of a subscription group"""
+        self.frames_encoded += 1
+        return json_dumps({
+            "type": "sensor_update",
+            "timestamp": self.snapshot_timestamp,
+            "seq": group.seq,
+            "sensors": {key: value for key, value in self.sensor_data.items() if key in group.keys},
+            "status": "active"
+        })
+
+    def encode_filtered_delta(self, group, relevant_keys):
+        """Encode a sensor_delta for a subscription group, sequenced per group"""
+        self.frames_encoded += 1
+        message = {
+            "type": "sensor_delta",
+            "timestamp": self.snapshot_timestamp,
+            "seq": group.seq,
+            "base_seq": group.seq - 1,
+            "changed": {key: value for key, value in self.sensor_data.items() if key in relevant_keys}
+        }
+        removed = [key for key in relevant_keys if key not in self.sensor_data]
+        if removed:
+            message["removed"] = removed
+        return json_dumps(message)
+
+    async def broadcast_snapshot(self):
+        """Queue the current snapshot on every client, once-encoded per subscription group"""
         if not self.connected_clients:
             return
-            
-        message_str = json.dumps(message)
-        disconnected_clients = []
-        
-        for client_id, client_conn in list(self.connected_clients.items()):
-            try:
-                if hasattr(client_conn.websocket, 'send'):
-                    await client_conn.websocket.send(message_str)
+
+        keyframe_tick = self.snapshot_version % self.keyframe_interval == 0
+        now = asyncio.get_running_loop().time()
+        overflowed_clients = []
+
+        for group in list(self.subscription_index.values()):
+            if group.keys is None:
+                relevant_keys = None
+            else:
+                relevant_keys = self.changed_keys() & group.keys
+                if relevant_keys:
+                    group.seq += 1
+            keyframe = None
+            delta = None
+            binary_frames = {}
+
+            for client_id in list(group.client_ids):
+                client_conn = self.connected_clients.get(client_id)
+                if client_conn is None:
+                    continue
+
+                # Skipped updates are made up for with a keyframe once the rate allows
+                if client_conn.min_interval and now - client_conn.last_sent < client_conn.min_interval:
+                    if relevant_keys is None or relevant_keys:
+                        client_conn.needs_keyframe = True
+                    continue
+
+                send_keyframe = client_conn.needs_keyframe or (client_conn.delta and keyframe_tick)
+                if not send_keyframe and relevant_keys is not None and not relevant_keys:
+                    # Nothing this client subscribed to has changed
+                    continue
+
+                if client_conn.delta and not send_keyframe:
+                    if delta is None:
+                        delta = self.get_delta_frame() if group.keys is None else self.encode_filtered_delta(group, relevant_keys)
+                    frame = delta
+                    kind = "sensor_delta"
+                    self.deltas_sent += 1
+                else:
+                    if keyframe is None:
+                        keyframe = self.get_snapshot_frame("sensor_update") if group.keys is None else self.encode_filtered_keyframe(group)
+                    frame = keyframe
+                    kind = "sensor_update"
+                    if client_conn.delta:
+                        self.keyframes_sent += 1
+
+                if client_conn.binary:
+                    frame = binary_frames.get(kind)
+                    if frame is None:
+                        if kind == "sensor_update" and group.keys is None:
+                            frame = self.get_packed_sensor_frame()
+                        else:
+                            frame = self.encode_binary(keyframe if kind == "sensor_update" else delta)
+                        binary_frames[kind] = frame
+
+                if not client_conn.enqueue(frame, kind):
+                    overflowed_clients.append(client_id)
+                    continue
+                client_conn.last_sent = now
+                if kind == "sensor_update":
+                    client_conn.needs_keyframe = False
+
+        await self.disconnect_slow_clients(overflowed_clients)
+
+    def register_client(self, client_conn):
+        """Start tracking a client and place it in the full-stream subscription group"""
+        self.connected_clients[client_conn.client_id] = client_conn
+        if client_conn.device_id is None:
+            self.subscription_index[None].client_ids.add(client_conn.client_id)
+        else:
+            # Device connections only receive their device's stream
+            self.add_fleet_subscription(client_conn, ('device', client_conn.device_id))
+        self.update_cluster_count()
+
+    def add_fleet_subscription(self, client_conn, key):
+        """Subscribe a client to a fleet device or group"""
+        self.fleet_subscribers.setdefault(key, set()).add(client_conn.client_id)
+        client_conn.fleet_keys.add(key)
+
+    def remove_fleet_subscription(self, client_conn, key):
+        """Unsubscribe a client from a fleet device or group"""
+        client_ids = self.fleet_subscribers.get(key)
+        if client_ids is not None:
+            client_ids.discard(client_conn.client_id)
+            if not client_ids:
+                del self.fleet_subscribers[key]
+        client_conn.fleet_keys.discard(key)
+
+    def encode_fleet_frame(self, key):
+        """Encode the current tick for one device or group subscription"""
+        fleet = self.fleet
+        kind, name = key
+        fields = {
+            "type": "device_update" if kind == 'device' else "fleet_update",
+            kind: name,
+            "timestamp": fleet.timestamp.isoformat(),
+            "seq": fleet.tick
+        }
+        if kind == 'device':
+            return build_frame(fields, sensors=fleet.encoded_sensors(fleet.index[name]))
+        # Device payloads are encoded once per tick and shared by every group they appear in
+        devices = ','.join(f'"{fleet.device_ids[index]}":{fleet.encoded_sensors(index)}'
+                           for index in fleet.groups[name])
+        return build_frame(fields, devices='{' + devices + '}')
+
+    async def broadcast_fleet(self, tick=None, epoch=None):
+        """Advance the fleet a tick and queue a frame for every device or group with listeners"""
+        self.fleet.step(tick, epoch)
+        overflowed_clients = []
+        for key, client_ids in list(self.fleet_subscribers.items()):
+            frame = self.encode_fleet_frame(key)
+            kind = f"{key[0]}_update:{key[1]}"
+            binary_frame = None
+            for client_id in list(client_ids):
+                client_conn = self.connected_clients.get(client_id)
+                if client_conn is None:
+                    continue
+                if client_conn.binary:
+                    if binary_frame is None:
+                        binary_frame = self.encode_binary(frame)
+                    outgoing = binary_frame
+                else:
+                    outgoing = frame
+                if not client_conn.enqueue(outgoing, kind):
+                    overflowed_clients.append(client_id)
+                    continue
+                self.fleet_frames += 1
+        await self.disconnect_slow_clients(overflowed_clients)
+
+    def update_cluster_count(self):
+        """Publish this worker's client count to the shared array"""
+        if self.client_counts is not None:
+            self.client_counts[self.worker_index] = len(self.connected_clients)
+
+    def set_subscription(self, client_conn, keys):
+        """Move a client to the subscription group for the given key set"""
+        old_group = self.subscription_index.get(client_conn.subscription)
+        if old_group is not None:
+            old_group.client_ids.discard(client_conn.client_id)
+            if not old_group.client_ids and old_group.keys is not None:
+                del self.subscription_index[old_group.keys]
+
+        group = self.subscription_index.get(keys)
+        if group is None:
+            group = SubscriptionGroup(keys)
+            self.subscription_index[keys] = group
+        group.client_ids.add(client_conn.client_id)
+        client_conn.subscription = keys
+        # Start the new selection from a full picture
+        client_conn.needs_keyframe = True
+
+    def handle_subscription(self, client_conn, data, subscribe=True):
+        """Apply a subscribe/unsubscribe request and return the subscription_ack response"""
+        groups = data.get("groups", [])
+        keys = data.get("keys", [])
+        if not isinstance(groups, list) or not isinstance(keys, list):
+            raise ValueError("groups and keys must be lists")
+        for group_name in groups:
+            if group_name not in CHANNEL_GROUPS:
+                raise ValueError(f"Unknown channel group: {group_name}")
+        known_keys = set(self.sensor_data).union(*(channels for channels in CHANNEL_GROUPS.values() if channels))
+        unknown_keys = [key for key in keys if key not in known_keys]
+        if unknown_keys:
+            raise ValueError(f"Unknown sensor key(s): {', '.join(map(str, unknown_keys))}")
+        keys = set(keys)
+
+        max_rate = None
+        if "max_rate" in data:
+            max_rate = float(data["max_rate"] or 0)
+            if not max_rate >= 0:
+                raise ValueError("max_rate must be >= 0")
+
+        selects_all = 'all' in groups
+        for group_name in groups:
+            if CHANNEL_GROUPS[group_name] is not None:
+                keys.update(CHANNEL_GROUPS[group_name])
+
+        current = client_conn.subscription
+        if not keys and not selects_all:
+            # Nothing selected, only the rate cap may change
+            new_keys = current
+        elif subscribe:
+            if selects_all:
+                new_keys = None
+            elif current is None:
+                # A client on the full stream narrows to what it asked for
+                new_keys = frozenset(keys)
+            else:
+                new_keys = current | keys
+        else:
+            if selects_all:
+                new_keys = frozenset()
+            else:
+                subscribed = set(self.sensor_data) if current is None else current
+                new_keys = frozenset(subscribed - keys)
+        if new_keys is not None and not new_keys:
+            raise ValueError("it would leave no channels, subscribe to others first")
+
+        if new_keys != current:
+            self.set_subscription(client_conn, new_keys)
+
+        if max_rate is not None:
+            client_conn.min_interval = 1.0 / max_rate if max_rate else 0.0
+
+        return {
+            "type": "subscription_ack",
+            "timestamp": datetime.now().isoformat(),
+            "keys": None if new_keys is None else sorted(new_keys),
+            "max_rate": 1.0 / client_conn.min_interval if client_conn.min_interval else None
+        }
+
+    def parse_history_query(self, data):
+        """Validate the get_history parameters"""
+        start = parse_time_bound(data.get("from"))
+        end = parse_time_bound(data.get("to"))
+        channels = data.get("channels")
+        if channels is not None:
+            if not isinstance(channels, (list, tuple)) or not all(isinstance(channel, str) for channel in channels):
+                raise ValueError("channels must be a list of channel names")
+            channels = set(channels)
+        limit = int(data.get("limit", 100))
+        if limit < 0:
+            raise ValueError("limit must be >= 0")
+        return min(limit, MAX_HISTORY_RECORDS), start, end, channels
+
+    async def read_history(self, data, packed=False):
+        """Answer a get_history on a worker thread from a copy of the ring, so long reads and
+        disk scans never stall the event loop"""
+        history = self.data_history.copy()
+        if not packed:
+            return await asyncio.to_thread(self.build_history_response, data, history)
+        started = time.perf_counter()
+        frame = await asyncio.to_thread(self.build_packed_history, data, history)
+        self.record_encoding("packed_history", len(frame), time.perf_counter() - started)
+        return frame
+
+    def build_history_response(self, data, history=None):
+        """Build a history_data response for a get_history request"""
+        history = self.data_history if history is None else history
+        limit, start, end, channels = self.parse_history_query(data)
+        max_points = data.get("max_points")
+
+        response = {
+            "type": "history_data",
+            "timestamp": datetime.now().isoformat(),
+            "total_records": len(history),
+            "limit": limit
+        }
+        if start is not None:
+            response["from"] = datetime.fromtimestamp(start).isoformat()
+        if end is not None:
+            response["to"] = datetime.fromtimestamp(end).isoformat()
+
+        if max_points is not None:
+            method = data.get("method", "minmax")
+            if method not in HISTORY_DOWNSAMPLE_METHODS:
+                raise ValueError(f"Unknown downsample method: {method}")
+            max_points = min(int(max_points), MAX_HISTORY_POINTS)
+            # The ring serves every window it covers, only a start older than its oldest record
+            # goes to disk, where buckets are streamed from the mapped segments and LTTB falls
+            # back to min/max
+            if self.history_from_disk(start, 0, history):
+                response.update(self.history_segments.downsample(history, start, end, channels, max_points, method))
+                response["source"] = "disk"
+            else:
+                response.update(history.downsample(start, end, channels, max_points, method))
+        elif self.history_from_disk(start, limit, history):
+            response["history"] = [history.row_record(row, channels)
+                                   for row in self.history_segments.rows(start, end, limit)]
+            response["source"] = "disk"
+        elif start is None and end is None and channels is None:
+            response["history"] = history.tail(limit)
+        else:
+            response["history"] = history.query(start, end, channels, limit)
+        return response
+
+    def build_packed_history(self, data, history=None):
+        """Build a packed history frame; rows always carry every channel"""
+        history = self.data_history if history is None else history
+        limit, start, end, _ = self.parse_history_query(data)
+        if self.history_from_disk(start, limit, history):
+            rows = self.history_segments.pack(start, end, limit)
+        else:
+            lo, hi = history.time_range(start, end)
+            lo = max(lo, hi - limit)
+            rows = history.pack_range(lo, hi)
+
+        request_id = data.get("id")
+        request_id = b'' if request_id is None else str(request_id).encode('utf-8')[:255]
+        return HISTORY_FRAME_HEADER.pack(BINARY_TAG_HISTORY, len(request_id), len(rows) // SENSOR_ROW.size) \
+            + request_id + rows
+
+    def alarm_frame(self, event_type, rule):
+        return json_dumps({
+            "type": event_type,
+            "timestamp": self.snapshot_timestamp,
+            "seq": self.snapshot_version,
+            "alarm": rule.describe()
+        })
+
+    async def push_alarm_events(self, events):
+        """Queue alarm transitions on subscribed clients, each encoded once"""
+        for event_type, rule in events:
+            logger.info(f"{event_type}: {rule.rule_id} ({rule.channel} {rule.condition} {rule.level}, value {rule.value})")
+        if not self.alarm_subscribers:
+            return
+
+        overflowed_clients = []
+        for event_type, rule in events:
+            frame = self.alarm_frame(event_type, rule)
+            binary_frame = None
+            for client_id in self.alarm_subscribers:
+                client_conn = self.connected_clients.get(client_id)
+                if client_conn is None:
+                    continue
+                if client_conn.binary:
+                    if binary_frame is None:
+                        binary_frame = self.encode_binary(frame)
+                    queued = client_conn.enqueue(binary_frame)
                 else:
-                    await client_conn.websocket.send_str(message_str)
-                client_conn.update_activity()
-            except Exception as e:
-                logger.error(f"Error sending to HTTP-WS client {client_id}: {e}")
-                disconnected_clients.append(client_id)
-        
-        # Remove disconnected clients
-        for client_id in disconnected_clients:
+                    queued = client_conn.enqueue(frame)
+                if not queued:
+                    overflowed_clients.append(client_id)
+
+        await self.disconnect_slow_clients(overflowed_clients)
+
+    async def disconnect_slow_clients(self, overflowed_clients):
+        """Disconnect clients that could not keep up with their outbound queue"""
+        for client_id in overflowed_clients:
+            logger.warning(f"Disconnecting slow client {client_id} - outbound queue full")
+            self.dropped_clients += 1
+            client_conn = self.connected_clients.get(client_id)
             await self.remove_client(client_id)
-    
+            if client_conn:
+                asyncio.create_task(client_conn.transport.close())
+
+    async def on_client_send_error(self, client_id, error):
+        """Called by a client's writer task when a send fails"""
+        logger.error(f"Error sending to client {client_id}: {error}")
+        if self.metrics:
+            self.metrics.send_failures += 1
+        await self.remove_client(client_id)
+
     async def remove_client(self, client_id):
         """Safely remove a client from tracking"""
         if client_id in self.connected_clients:
             client_conn = self.connected_clients[client_id]
-            connection_duration = datetime.now() - client_conn.connected_at
-            logger.info(f"Removing client {client_id} - Duration: {connection_duration}, Messages: {client_conn.message_count}")
+            connection_duration = time.monotonic() - client_conn.connected_at
+            logger.info(f"Removing client {client_id} - Duration: {connection_duration:.1f}s, Messages: {client_conn.message_count}, Dropped frames: {client_conn.dropped_count}")
+            client_conn.stop_writer()
+            group = self.subscription_index.get(client_conn.subscription)
+            if group is not None:
+                group.client_ids.discard(client_id)
+                if not group.client_ids and group.keys is not None:
+                    del self.subscription_index[group.keys]
+            for key in list(client_conn.fleet_keys):
+                self.remove_fleet_subscription(client_conn, key)
+            self.alarm_subscribers.discard(client_id)
+            if self.metrics:
+                self.metrics.closed_client_bytes += client_conn.bytes_sent
+                self.metrics.closed_client_frames += client_conn.sent_count
             del self.connected_clients[client_id]
-    
-    async def add_client(self, websocket):
-        """Add a new client to tracking"""
+            self.update_cluster_count()
+
+    def add_client(self, transport):
+        """Create a tracked connection for a transport with its outbound writer running"""
         self.client_counter += 1
-        client_id = f"client_{self.client_counter}"
-        client_address = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
-        
-        client_conn = ClientConnection(websocket, client_id)
-        self.connected_clients[client_id] = client_conn
-        
-        logger.info(f"New client connected: {client_id} from {client_address} - Total clients: {len(self.connected_clients)}")
-        return client_id, client_conn
-    
-    async def handle_client(self, websocket):
-        """Handle new WebSocket client connection"""
-        client_id = None
+        if self.worker_index is None:
+            client_id = f"client_{self.client_counter}"
+        else:
+            client_id = f"w{self.worker_index}-client_{self.client_counter}"
+
+        client_conn = ClientConnection(transport, client_id, self.queue_size, self.overflow_policy)
+        client_conn.delta = query_flag(transport.query, 'delta')
+        client_conn.binary = transport.subprotocol == WS_PROTOCOL_BINARY
+        client_conn.device_id = transport.device_id
+        if self.rate_limiting_enabled:
+            client_conn.buckets = {}
+        client_conn.start_writer(self.on_client_send_error)
+        self.register_client(client_conn)
+        if self.alarm_engine and query_flag(transport.query, 'alarms'):
+            self.alarm_subscribers.add(client_id)
+        if self.liveness:
+            self.liveness.schedule(client_conn.last_seen + self.liveness.interval, client_id)
+
+        client_address = f"{transport.remote_address[0]}:{transport.remote_address[1]}"
+        logger.info(f"New {transport.name} client connected: {client_id} from {client_address} - Total clients: {len(self.connected_clients)}")
+        return client_conn
+
+    def encoded_system_status(self):
+        """Return the encoded system block, rebuilt only when its inputs change"""
+        key = (self.snapshot_version, len(self.connected_clients), len(self.data_history))
+        if self._system_status_key != key:
+            self._system_status = json_dumps({
+                "gateway": "online",
+                "sensors": {
+                    "digital": "active" if 'FLOW' in self.sensor_data else "inactive",
+                    "modbus": "active" if 'pH' in self.sensor_data else "inactive"
+                },
+                "data_points": len(self.sensor_data),
+                "history_records": len(self.data_history),
+                "connected_clients": len(self.connected_clients)
+            })
+            self._system_status_key = key
+        return self._system_status
+
+    def error_response(self, message, **fields):
+        """Build an error response"""
+        response = {
+            "type": "error",
+            "message": message,
+            "timestamp": datetime.now().isoformat()
+        }
+        response.update(fields)
+        return response
+
+    async def serve_client(self, transport):
+        """Serve one WebSocket client over any transport until it disconnects"""
         client_conn = None
-        
+
         try:
+            if transport.device_id is not None and (self.fleet is None or transport.device_id not in self.fleet.index):
+                await transport.send(json_dumps(self.error_response(f"Unknown device: {transport.device_id}")))
+                await transport.close()
+                return
+
             # Add client to tracking
-            client_id, client_conn = await self.add_client(websocket)
-            
+            client_conn = self.add_client(transport)
+            client_id = client_conn.client_id
+
             # Send initial data to new client
-            initial_message = {
+            initial_fields = {
                 "type": "initial_data",
                 "timestamp": datetime.now().isoformat(),
                 "client_id": client_id,
-                "sensors": self.sensor_data,
-                "system": {
-                    "gateway": "online",
-                    "sensors": {
-                        "digital": "active" if 'FLOW' in self.sensor_data else "inactive",
-                        "modbus": "active" if 'pH' in self.sensor_data else "inactive"
-                    },
-                    "data_points": len(self.sensor_data),
-                    "history_records": len(self.data_history),
-                    "connected_clients": len(self.connected_clients)
-                },
+                "seq": self.snapshot_version,
+                "delta": client_conn.delta,
+                "keyframe_interval": self.keyframe_interval,
+                "protocol": WS_PROTOCOL_BINARY if client_conn.binary else WS_PROTOCOL_JSON,
                 "status": "connected"
             }
-            
-            await websocket.send(json.dumps(initial_message))
+            if client_conn.binary:
+                initial_fields["schema"] = self.data_history.schema()
+            if client_conn.device_id is None:
+                sensors = self.encoded_sensors()
+            else:
+                initial_fields["device_id"] = client_conn.device_id
+                initial_fields["seq"] = self.fleet.tick
+                sensors = self.fleet.encoded_sensors(self.fleet.index[client_conn.device_id])
+            initial_message = build_frame(initial_fields, system=self.encoded_system_status(), sensors=sensors)
+
+            await transport.send(self.encode_binary(initial_message) if client_conn.binary else initial_message)
             logger.info(f"Sent initial data to {client_id}")
-            
+
             # Listen for messages from client
-            async for message in websocket:
+            async for message in transport.messages():
+                if self.capture:
+                    self.capture.write_message(client_id, message)
                 try:
-                    data = json.loads(message)
-                    await self.handle_client_message(websocket, data, client_conn)
+                    data = decode_message(message)
                 except json.JSONDecodeError as e:
                     logger.error(f"JSON decode error from {client_id}: {e}")
-                    error_response = {
-                        "type": "error",
-                        "message": "Invalid JSON format",
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    await websocket.send(json.dumps(error_response))
-                except Exception as e:
-                    logger.error(f"Error handling message from {client_id}: {e}")
-                
-        except websockets.exceptions.ConnectionClosed:
-            logger.info(f"Client {client_id} disconnected normally")
-        except websockets.exceptions.InvalidMessage as e:
-            logger.error(f"Invalid message from {client_id}: {e}")
+                    await self.send_response(client_conn, self.error_response("Invalid JSON format"))
+                    continue
+                except ValueError as e:
+                    logger.error(f"Undecodable binary frame from {client_id}: {e}")
+                    await self.send_response(client_conn, self.error_response(f"Invalid binary frame: {e}"))
+                    continue
+
+                if isinstance(data, dict) and data.get("id") is not None:
+                    # Requests with a correlation id are pipelined and may complete out of order
+                    task = asyncio.create_task(self.dispatch_message(client_conn, data))
+                    client_conn.pending_requests.add(task)
+                    task.add_done_callback(client_conn.pending_requests.discard)
+                else:
+                    await self.dispatch_message(client_conn, data)
+
+        except ConnectionClosed:
+            logger.info(f"Client {client_conn and client_conn.client_id} disconnected normally")
+        except InvalidMessage as e:
+            logger.error(f"Invalid message from {client_conn and client_conn.client_id}: {e}")
         except Exception as e:
-            logger.error(f"Unexpected error with client {client_id}: {e}")
+            logger.error(f"Unexpected error with client {client_conn and client_conn.client_id}: {e}")
         finally:
             # Always cleanup the client
-            if client_id:
-                await self.remove_client(client_id)
-    
-    async def handle_client_message(self, websocket, data, client_conn):
-        """Handle messages from WebSocket clients"""
+            if client_conn:
+                await self.remove_client(client_conn.client_id)
+
+    async def handle_client(self, websocket):
+        """Handle new client connection accepted by the websockets library"""
+        if not self.has_capacity():
+            self.rejected_connections += 1
+            await websocket.close(1013, "Server at connection limit, retry later")
+            return
+        await self.serve_client(WebsocketsTransport(websocket))
+
+    def has_capacity(self):
+        """True while another client fits under MAX_CONNECTIONS"""
+        if not self.max_connections:
+            return True
+        connected = len(self.connected_clients) if self.client_counts is None else sum(self.client_counts)
+        return connected + self.admitting < self.max_connections
+
+    def admit_connection(self):
+        """Refuse an HTTP upgrade or stream with a 503 when the server is full"""
+        if not self.has_capacity():
+            self.rejected_connections += 1
+            raise web.HTTPServiceUnavailable(text="Server at connection limit, retry later",
+                                             headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+
+    async def dispatch_message(self, client_conn, data):
+        """Route a client message through the handler table and send the response"""
+        response = await self.build_response(client_conn, data, client_conn.binary)
+        if response is not None:
+            await self.send_response(client_conn, response)
+
+    async def send_response(self, client_conn, response):
+        """Send a direct response in the client's negotiated wire format"""
+        if isinstance(response, dict):
+            response = self.encode_binary(response) if client_conn.binary else json_dumps(response)
+        elif client_conn.binary and isinstance(response, str):
+            response = self.encode_binary(response)
+        try:
+            await client_conn.transport.send(response)
+        except Exception:
+            if self.metrics:
+                self.metrics.send_failures += 1
+            raise
+        if self.metrics:
+            self.metrics.response_bytes += frame_size(response)
+
+    async def build_response(self, client_conn, data, binary=False):
+        """Run the registered handler for a message and return its encoded response.
+
+        Handlers may return packed bytes when binary is set, otherwise responses are JSON text.
+        """
+        if not isinstance(data, dict):
+            return json_dumps(self.error_response("Message must be a JSON object"))
         message_type = data.get("type", "unknown")
         client_conn.update_activity()
-        
+        handler = self.message_handlers.get(message_type)
+
+        started = time.perf_counter()
+        bucket = None
         try:
-            if message_type == "get_sensors":
-                response = {
-                    "type": "sensor_data",
-                    "timestamp": datetime.now().isoformat(),
-                    "sensors": self.sensor_data,
-                    "status": "active"
-                }
-                await websocket.send(json.dumps(response))
-                
-            elif message_type == "get_status":
-                response = {
-                    "type": "system_status",
-                    "timestamp": datetime.now().isoformat(),
-                    "system": {
-                        "gateway": "online",
-                        "sensors": {
-                            "digital": "active" if 'FLOW' in self.sensor_data else "inactive",
-                            "modbus": "active" if 'pH' in self.sensor_data else "inactive"
-                        },
-                        "data_points": len(self.sensor_data),
-                        "history_records": len(self.data_history),
-                        "connected_clients": len(self.connected_clients)
-                    }
-                }
-                await websocket.send(json.dumps(response))
-                
-            elif message_type == "get_history":
-                limit = data.get("limit", 100)
-                response = {
-                    "type": "history_data",
-                    "timestamp": datetime.now().isoformat(),
-                    "history": self.data_history[-limit:],
-                    "total_records": len(self.data_history),
-                    "limit": limit
-                }
-                await websocket.send(json.dumps(response))
-                
-            elif message_type == "clear_history":
-                self.data_history.clear()
-                response = {
-                    "type": "history_cleared",
-                    "message": "History cleared successfully",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await websocket.send(json.dumps(response))
-                
-            elif message_type == "ping":
-                response = {
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat(),
-                    "client_id": client_conn.client_id
-                }
-                await websocket.send(json.dumps(response))
-                
-            elif message_type == "get_client_info":
-                response = {
-                    "type": "client_info",
-                    "timestamp": datetime.now().isoformat(),
-                    "client_id": client_conn.client_id,
-                    "connected_since": client_conn.connected_at.isoformat(),
-                    "message_count": client_conn.message_count,
-                    "last_activity": client_conn.last_ping.isoformat()
-                }
-                await websocket.send(json.dumps(response))
-                
+            if client_conn.buckets is not None:
+                bucket = self.client_bucket(client_conn, message_type if handler is not None else 'unknown')
+                retry_after = bucket.take(self.request_cost(message_type, data, binary))
+                if retry_after:
+                    self.rate_limited_requests += 1
+                    raise RequestRejected(f"Rate limit exceeded for {message_type}", "rate_limited", retry_after)
+            if handler is None:
+                raise MessageError(f"Unknown message type: {message_type}")
+            if message_type in EXPENSIVE_REQUEST_TYPES:
+                async with self.expensive_request():
+                    response = await handler(client_conn, data, binary)
             else:
-                error_response = {
-                    "type": "error",
-                    "message": f"Unknown message type: {message_type}",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await websocket.send(json.dumps(error_response))
-                
+                response = await handler(client_conn, data, binary)
+        except RequestRejected as e:
+            response = self.error_response(str(e), code=e.code, retry_after=round(e.retry_after, 3))
+        except MessageError as e:
+            response = self.error_response(str(e))
         except Exception as e:
             logger.error(f"Error handling message type {message_type}: {e}")
-    
+            return None
+        finally:
+            if self.metrics:
+                histogram = self.metrics.handler_seconds['unknown' if handler is None else message_type]
+                histogram.observe(time.perf_counter() - started)
+
+        if response is None:
+            return response
+        # Echo the correlation id so clients can match out-of-order responses
+        request_id = data.get("id")
+        if isinstance(response, dict):
+            if request_id is not None:
+                response = dict(response, id=request_id)
+            # Binary clients get MessagePack when it is installed
+            response = self.encode_binary(response) if binary else json_dumps(response)
+        elif isinstance(response, str) and request_id is not None:
+            response = add_fields(response, {"id": request_id})
+        return response
+
+    def request_cost(self, message_type, data, binary):
+        """Tokens a request is charged before it runs: one, plus one per RATE_LIMIT_TOKEN_BYTES
+        of the response it asks for. Batch members are charged on their own buckets"""
+        if message_type != "get_history":
+            return 1.0
+        try:
+            max_points = data.get("max_points")
+            if max_points is not None:
+                # min/max/mean and a time per point for every numeric channel
+                size = min(int(max_points), MAX_HISTORY_POINTS) * len(HISTORY_NUMERIC_CHANNELS) * 4 * 8
+            else:
+                records = min(int(data.get("limit", 100)), MAX_HISTORY_RECORDS)
+                if self.history_segments is None:
+                    records = min(records, len(self.data_history))
+                size = max(records, 0) * (SENSOR_ROW.size if binary else HISTORY_RECORD_JSON_BYTES)
+        except (TypeError, ValueError):
+            # Rejected by the handler, only the request itself is charged
+            return 1.0
+        return 1.0 + size / RATE_LIMIT_TOKEN_BYTES
+
+    def client_bucket(self, client_conn, message_type):
+        """Return the client's rate-limit bucket for a message type, creating it on first use"""
+        bucket = client_conn.buckets.get(message_type)
+        if bucket is None:
+            rate, burst = self.rate_limits.get(message_type, self.rate_limits['default'])
+            bucket = client_conn.buckets[message_type] = TokenBucket(rate, burst)
+        return bucket
+
+    @asynccontextmanager
+    async def expensive_request(self):
+        """Hold one of the few slots expensive requests run in, shedding load when too many wait"""
+        if self.expensive_queue_limit and self.expensive_waiting >= self.expensive_queue_limit:
+            self.expensive_rejected += 1
+            raise RequestRejected("Server busy, retry later", "busy", 1.0)
+        self.expensive_waiting += 1
+        try:
+            await self.expensive_slots.acquire()
+        finally:
+            self.expensive_waiting -= 1
+        try:
+            yield
+            # Keep the slot for one pass of the event loop, so ticks and broadcasts that became
+            # ready meanwhile run before the next expensive request
+            await asyncio.sleep(0)
+        finally:
+            self.expensive_slots.release()
+
+    def admission_stats(self):
+        """Connection limit, rate limiting and expensive-request pool counters"""
+        return {
+            "max_connections": self.max_connections or None,
+            "rejected_connections": self.rejected_connections,
+            "rate_limiting": self.rate_limiting_enabled,
+            "rate_limited_requests": self.rate_limited_requests,
+            "expensive_concurrency": self.expensive_concurrency,
+            "expensive_queue_limit": self.expensive_queue_limit,
+            "expensive_waiting": self.expensive_waiting,
+            "expensive_rejected": self.expensive_rejected
+        }
+
+    async def handle_get_schema(self, client_conn, data, binary=False):
+        """Reply with the packed row layout used by the binary protocol"""
+        return {
+            "type": "schema",
+            "timestamp": datetime.now().isoformat(),
+            "protocol": WS_PROTOCOL_BINARY,
+            "schema": self.data_history.schema(),
+            # Replies built as JSON once and shared (get_status, get_sensors with an id, batch) keep
+            # tag 0x11, other replies use 0x10 when MessagePack is installed. Requests may use either
+            "frame_tags": {
+                "sensor": BINARY_TAG_SENSOR,
+                "history": BINARY_TAG_HISTORY,
+                "msgpack": BINARY_TAG_MSGPACK if msgpack is not None else None,
+                "json": BINARY_TAG_JSON
+            }
+        }
+
+    async def handle_batch(self, client_conn, data, binary=False):
+        """Answer an array of requests with one combined frame, or stream each response"""
+        requests = data.get("requests")
+        if not isinstance(requests, list):
+            raise MessageError("Batch requests must be a list")
+        if len(requests) > MAX_BATCH_REQUESTS:
+            raise MessageError(f"Batch too large: {len(requests)} requests (max {MAX_BATCH_REQUESTS})")
+
+        stream = bool(data.get("stream", False))
+        responses = []
+        for request in requests:
+            if isinstance(request, dict) and request.get("type") == "batch":
+                response = json_dumps(self.error_response("Nested batches are not supported"))
+                if request.get("id") is not None:
+                    response = add_fields(response, {"id": request["id"]})
+            else:
+                response = await self.build_response(client_conn, request)
+            if response is None:
+                continue
+            if stream:
+                await self.send_response(client_conn, response)
+            else:
+                responses.append(response)
+
+        if stream:
+            return {
+                "type": "batch_complete",
+                "timestamp": datetime.now().isoformat(),
+                "count": len(requests)
+            }
+        # Responses are already encoded, join them instead of decoding and re-encoding
+        return build_frame({
+            "type": "batch_response",
+            "timestamp": datetime.now().isoformat(),
+            "count": len(responses)
+        }, responses='[' + ','.join(responses) + ']')
+
+    async def handle_get_sensors(self, client_conn, data, binary=False):
+        """Reply with the frame encoded for the current snapshot version"""
+        if binary and data.get("id") is None:
+            return self.get_packed_sensor_frame(BINARY_KIND_SENSOR_DATA)
+        return self.get_snapshot_frame("sensor_data")
+
+    async def handle_get_status(self, client_conn, data, binary=False):
+        """Reply with the cached system status block"""
+        return build_frame({
+            "type": "system_status",
+            "timestamp": datetime.now().isoformat()
+        }, system=self.encoded_system_status())
+
+    async def handle_get_history(self, client_conn, data, binary=False):
+        """Reply with raw or downsampled history"""
+        try:
+            return await self.read_history(data, packed=binary and data.get("max_points") is None)
+        except (TypeError, ValueError) as e:
+            raise MessageError(f"Invalid history query: {e}")
+
+    async def handle_resync(self, client_conn, data, binary=False):
+        """Client detected a gap in the delta sequence, queue a keyframe right away"""
+        # Queued deltas are already covered by the keyframe and would arrive after it
+        client_conn.needs_keyframe = True
+        client_conn.discard_queued("sensor_delta")
+
+        request_id = data.get("id")
+        if binary and request_id is None and client_conn.subscription is None:
+            frame = self.get_packed_sensor_frame()
+        else:
+            if client_conn.subscription is None:
+                frame = self.get_snapshot_frame("sensor_update")
+            else:
+                # Subscribed clients follow their group's sequence, a global keyframe would leave a gap
+                frame = self.encode_filtered_keyframe(self.subscription_index[client_conn.subscription])
+            if request_id is not None:
+                frame = add_fields(frame, {"id": request_id})
+            if binary:
+                frame = self.encode_binary(frame)
+
+        # Through the writer task, so the keyframe keeps its place among queued frames
+        if client_conn.enqueue(frame, "sensor_update"):
+            client_conn.needs_keyframe = False
+        else:
+            await self.disconnect_slow_clients([client_conn.client_id])
+        return None
+
+    async def handle_subscribe(self, client_conn, data, binary=False):
+        """Change the client's channel subscription"""
+        try:
+            return self.handle_subscription(client_conn, data, data.get("type") == "subscribe")
+        except (TypeError, ValueError, ZeroDivisionError) as e:
+            raise MessageError(f"Invalid subscription: {e}")
+
+    async def handle_clear_history(self, client_conn, data, binary=False):
+        """Clear the history store"""
+        self.data_history.clear()
+        if self.history_executor:
+            # Behind any queued appends, on the same thread that writes the segments
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.history_executor, self.history_segments.clear)
+            except OSError as e:
+                raise MessageError(f"Could not clear history segments: {e}")
+        self.history_generation += 1
+        return {
+            "type": "history_cleared",
+            "message": "History cleared successfully",
+            "timestamp": datetime.now().isoformat()
+        }
+
+    async def handle_ping(self, client_conn, data, binary=False):
+        """Reply to an application-level ping"""
+        return {
+            "type": "pong",
+            "timestamp": datetime.now().isoformat(),
+            "client_id": client_conn.client_id
+        }
+
+    async def handle_get_client_info(self, client_conn, data, binary=False):
+        """Reply with this client's connection details"""
+        return {
+            "type": "client_info",
+            "timestamp": datetime.now().isoformat(),
+            "client_id": client_conn.client_id,
+            "connected_since": monotonic_to_datetime(client_conn.connected_at).isoformat(),
+            "message_count": client_conn.message_count,
+            "last_activity": monotonic_to_datetime(client_conn.last_seen).isoformat(),
+            "delta": client_conn.delta,
+            "subscription": None if client_conn.subscription is None else sorted(client_conn.subscription),
+            "outbound_queue": client_conn.queue_stats()
+        }
+
+    async def handle_alarm_subscription(self, client_conn, data, binary=False):
+        """Start or stop pushing alarm_raised/alarm_cleared events to this client"""
+        if self.alarm_engine is None:
+            raise MessageError("No alarm rules are configured")
+        if data.get("type") == "subscribe_alarms":
+            self.alarm_subscribers.add(client_conn.client_id)
+        else:
+            self.alarm_subscribers.discard(client_conn.client_id)
+        return {
+            "type": "alarm_subscription_ack",
+            "timestamp": datetime.now().isoformat(),
+            "subscribed": client_conn.client_id in self.alarm_subscribers,
+            # Alarms already raised, so a new subscriber starts in sync
+            "active": [rule.describe() for rule in self.alarm_engine.active.values()]
+        }
+
+    async def handle_get_alarms(self, client_conn, data, binary=False):
+        """Reply with the active alarms, and the rule set when asked"""
+        if self.alarm_engine is None:
+            raise MessageError("No alarm rules are configured")
+        response = {
+            "type": "alarms",
+            "timestamp": datetime.now().isoformat(),
+            "seq": self.snapshot_version,
+            "active": [rule.describe() for rule in self.alarm_engine.active.values()]
+        }
+        if data.get("rules"):
+            response["rules"] = [rule.describe() for rule in self.alarm_engine.rules.values()]
+        return response
+
+    def require_fleet(self):
+        """Return the device fleet, or reject the request when fleet mode is off"""
+        if self.fleet is None:
+            raise MessageError("Fleet mode is disabled (set FLEET_SIZE)")
+        return self.fleet
+
+    async def handle_device_subscription(self, client_conn, data, binary=False):
+        """Subscribe to or unsubscribe from fleet devices and device groups"""
+        fleet = self.require_fleet()
+        devices = data.get("devices", [])
+        groups = data.get("groups", [])
+        if not isinstance(devices, list) or not isinstance(groups, list):
+            raise MessageError("devices and groups must be lists")
+        keys = []
+        for device_id in devices:
+            if device_id not in fleet.index:
+                raise MessageError(f"Unknown device: {device_id}")
+            keys.append(('device', device_id))
+        for group in groups:
+            if group not in fleet.groups:
+                raise MessageError(f"Unknown device group: {group}")
+            keys.append(('group', group))
+
+        subscribe = data.get("type") == "subscribe_devices"
+        for key in keys:
+            if subscribe:
+                self.add_fleet_subscription(client_conn, key)
+            else:
+                self.remove_fleet_subscription(client_conn, key)
+
+        return {
+            "type": "device_subscription_ack",
+            "timestamp": datetime.now().isoformat(),
+            "devices": sorted(name for kind, name in client_conn.fleet_keys if kind == 'device'),
+            "groups": sorted(name for kind, name in client_conn.fleet_keys if kind == 'group')
+        }
+
+    async def handle_get_fleet(self, client_conn, data, binary=False):
+        """Reply with the fleet's device groups"""
+        fleet = self.require_fleet()
+        return {
+            "type": "fleet_info",
+            "timestamp": datetime.now().isoformat(),
+            "devices": fleet.size,
+            "groups": {
+                group: {
+                    "first": fleet.device_ids[devices.start],
+                    "last": fleet.device_ids[devices.stop - 1],
+                    "count": len(devices)
+                }
+                for group, devices in fleet.groups.items()
+            }
+        }
+
+    async def handle_get_device(self, client_conn, data, binary=False):
+        """Reply with one fleet device's current sensors"""
+        fleet = self.require_fleet()
+        device_id = data.get("device_id")
+        if device_id not in fleet.index:
+            raise MessageError(f"Unknown device: {device_id}")
+        return build_frame({
+            "type": "device_data",
+            "device_id": device_id,
+            "timestamp": fleet.timestamp.isoformat(),
+            "seq": fleet.tick
+        }, sensors=fleet.encoded_sensors(fleet.index[device_id]))
+
+    def normalize_command(self, device, value):
+        """Validate a command and return the snapshot value it sets, None to release the device"""
+        if device not in COMMAND_DEVICES:
+            raise MessageError(f"Unknown device: {device} (expected one of {', '.join(COMMAND_DEVICES)})")
+        if isinstance(value, str) and value.upper() == COMMAND_RELEASE:
+            return None
+        if device == 'PUMP':
+            normalized = COMMAND_PUMP_VALUES.get(str(value).upper())
+            if normalized is None:
+                raise MessageError(f"Invalid PUMP value: {value} (expected ON/OFF)")
+            return normalized
+        try:
+            position = float(str(value).rstrip('%'))
+        except ValueError:
+            raise MessageError(f"Invalid ACTUATOR value: {value} (expected a position in %)")
+        if not 0 <= position <= 100:
+            raise MessageError(f"ACTUATOR position out of range: {position:g} (expected 0-100)")
+        return f"{position:.1f}%"
+
+    async def handle_command(self, client_conn, data, binary=False):
+        """Queue an actuator command and reply with its actuator_ack once it is broadcast"""
+        received_at = time.perf_counter()
+        if self.feed_port is not None:
+            raise MessageError("Actuator commands are not supported on worker processes")
+        device = data.get("device")
+        value = self.normalize_command(device, data.get("value", data.get("action")))
+
+        self.command_counter += 1
+        command_id = data.get("command_id", data.get("id"))
+        if command_id is None:
+            command_id = f"{client_conn.client_id}-cmd_{self.command_counter}"
+
+        queue = self.command_queues.get(device)
+        if queue is None:
+            queue = self.command_queues[device] = CommandQueue(device)
+        future = asyncio.get_running_loop().create_future()
+        queue.pending.append((command_id, value, received_at, future))
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self.run_command_queue(queue))
+
+        result = await future
+        return {
+            "type": "actuator_ack",
+            "timestamp": datetime.now().isoformat(),
+            "command_id": command_id,
+            "device": device,
+            "requested": COMMAND_RELEASE if value is None else value,
+            **result
+        }
+
+    async def run_command_queue(self, queue):
+        """Apply one device's commands in order, only the newest of a backlog reaches the state"""
+        device = queue.device
+        while queue.pending:
+            batch = list(queue.pending)
+            queue.pending.clear()
+            _, value, _, _ = batch[-1]
+            broadcast = True
+            try:
+                if value is None:
+                    self.actuator_state.pop(device, None)
+                    # Hand the device back to its gateway sensor or the newest generated value
+                    value = self.gateway_values.get(device, self.generated_values.get(device))
+                    broadcast = value is not None
+                else:
+                    self.actuator_state[device] = value
+                if broadcast:
+                    # Copy-on-write so readers of the previous snapshot are unaffected
+                    snapshot = dict(self.sensor_data)
+                    snapshot[device] = value
+                    await self.apply_snapshot(snapshot)
+            except Exception as e:
+                logger.error(f"Error applying {device} command: {e}")
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            applied_at = time.perf_counter()
+            queue.applied += 1
+            queue.coalesced += len(batch) - 1
+            for index, (_, _, received_at, future) in enumerate(batch, 1):
+                latency = applied_at - received_at
+                if broadcast:
+                    self.command_latency.record(latency)
+                if not future.done():
+                    future.set_result({
+                        "status": "applied" if index == len(batch) else "coalesced",
+                        "value": self.sensor_data.get(device),
+                        "seq": self.snapshot_version,
+                        # Nothing went out for a release before the first generated sample
+                        "latency_ms": round(latency * 1000, 3) if broadcast else None
+                    })
+
+    def command_stats(self):
+        """Actuator command queues and command-to-broadcast latency for the health endpoint"""
+        return {
+            "overrides": dict(self.actuator_state),
+            "devices": {device: queue.stats() for device, queue in self.command_queues.items()},
+            "command_to_broadcast_ms": self.command_latency.stats()
+        }
+
+    def feed_line(self):
+        """Encode the current snapshot, and the fleet tick workers step to, as one feed line"""
+        fields = {"epoch": self.snapshot_epoch}
+        if self.feed_fleet_seed is not None:
+            fields["fleet_seed"] = self.feed_fleet_seed
+            fields["fleet_tick"] = self.feed_fleet_tick
+        return (build_frame(fields, sensors=self.encoded_sensors()) + '\n').encode('utf-8')
+
+    def publish_to_feed(self):
+        """Send the current snapshot to every worker process subscribed to the feed"""
+        line = self.feed_line()
+        for writer in list(self.feed_writers):
+            if writer.is_closing():
+                self.feed_writers.discard(writer)
+            elif writer.transport.get_write_buffer_size() > FEED_MAX_BUFFER:
+                # The worker is behind, it catches up with a later snapshot
+                logger.warning("Feed subscriber is lagging, skipping snapshot")
+            else:
+                writer.write(line)
+
+    async def handle_feed_subscriber(self, reader, writer):
+        """Serve the snapshot feed to one worker process"""
+        logger.info(f"Worker subscribed to feed from {writer.get_extra_info('peername')}")
+        self.feed_writers.add(writer)
+        try:
+            if self.sensor_data:
+                writer.write(self.feed_line())
+            # Workers never send anything, wait for them to disconnect
+            await reader.read()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.feed_writers.discard(writer)
+            writer.close()
+            logger.info("Worker unsubscribed from feed")
+
+    async def consume_feed(self):
+        """Apply snapshots from the producer process, reconnecting with backoff"""
+        retry_delay = FEED_RETRY_MIN
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.feed_port)
+                logger.info(f"Worker {self.worker_index} connected to feed on port {self.feed_port}")
+                retry_delay = FEED_RETRY_MIN
+                try:
+                    while self.running:
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        message = json.loads(line)
+                        await self.apply_snapshot(message["sensors"], message["epoch"])
+                        # Step to the producer's fleet tick, command snapshots repeat the current one
+                        fleet_tick = message.get("fleet_tick")
+                        if self.fleet and fleet_tick is not None and \
+                                (fleet_tick, message["fleet_seed"]) != (self.fleet.tick, self.fleet.seed):
+                            self.fleet.seed = message["fleet_seed"]
+                            await self.broadcast_fleet(fleet_tick, message["epoch"])
+                finally:
+                    writer.close()
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Worker {self.worker_index} feed unavailable: {e}")
+            except Exception as e:
+                logger.error(f"Error consuming feed: {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, FEED_RETRY_MAX)
+
+    async def run_feed_producer(self, feed_port):
+        """Generate samples and publish them to worker processes over a local socket"""
+        self.loop = asyncio.get_running_loop()
+        # Workers step their own fleets to the tick and seed in the feed, nobody connects to the producer
+        if self.fleet:
+            self.feed_fleet_seed = self.fleet.seed
+            self.fleet = None
+        server = await asyncio.start_server(self.handle_feed_subscriber, '127.0.0.1', feed_port)
+        logger.info(f"Snapshot feed listening on 127.0.0.1:{feed_port}")
+        self.open_history_segments()
+        self.setup_mock_data()
+        self.start_modbus_server()
+        await self.start_gateway()
+        try:
+            async with server:
+                while self.running:
+                    await asyncio.sleep(1)
+        finally:
+            self.generator_task.cancel()
+            self.stop_modbus_server()
+            await self.stop_gateway()
+            self.close_history_segments()
+            self.close_capture()
+
     def find_available_port(self, start_port=8765):
         """Find an available port starting from start_port"""
         for port in range(start_port, start_port + 100):
@@ -341,14 +4116,68 @@ class M300WebSocketSimulator:
                 
                 if self.connected_clients:
                     logger.info(f"Active clients: {len(self.connected_clients)}")
-                    for client_id, client_conn in self.connected_clients.items():
-                        connection_duration = datetime.now() - client_conn.connected_at
-                        last_activity = datetime.now() - client_conn.last_ping
-                        logger.debug(f"{client_id}: Duration={connection_duration}, Last activity={last_activity}, Messages={client_conn.message_count}")
+                    # Idle clients are found by the liveness reaper, this walk is only for debug logging
+                    if logger.isEnabledFor(logging.DEBUG):
+                        now = time.monotonic()
+                        for client_id, client_conn in self.connected_clients.items():
+                            logger.debug(f"{client_id}: Duration={now - client_conn.connected_at:.1f}s, Idle={now - client_conn.last_seen:.1f}s, Messages={client_conn.message_count}, Queue depth={len(client_conn.outbound)}, Dropped={client_conn.dropped_count}")
                         
             except Exception as e:
                 logger.error(f"Error in periodic client check: {e}")
     
+    async def reap_idle_clients(self):
+        """Ping clients that have gone quiet and close the ones that never answer"""
+        monitor = self.liveness
+        while self.running:
+            try:
+                now = time.monotonic()
+                for client_id in monitor.pop_due(now):
+                    client_conn = self.connected_clients.get(client_id)
+                    if client_conn is None:
+                        continue
+                    last_seen = client_conn.last_seen
+                    if last_seen + monitor.interval > now:
+                        # Heard from it since this check was scheduled
+                        monitor.schedule(last_seen + monitor.interval, client_id)
+                    elif client_conn.ping_sent <= last_seen:
+                        client_conn.ping_sent = now
+                        monitor.pings_sent += 1
+                        self.start_liveness_task(self.ping_client(client_conn))
+                        monitor.schedule(now + monitor.timeout, client_id)
+                    else:
+                        monitor.reaped += 1
+                        self.start_liveness_task(self.close_unresponsive_client(client_conn))
+                await monitor.wait(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in liveness check: {e}")
+                await asyncio.sleep(1)
+
+    def start_liveness_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.liveness_tasks.add(task)
+        task.add_done_callback(self.liveness_tasks.discard)
+
+    async def ping_client(self, client_conn):
+        try:
+            await client_conn.transport.ping()
+        except Exception as e:
+            logger.debug(f"Ping to {client_conn.client_id} failed: {e}")
+
+    async def close_unresponsive_client(self, client_conn):
+        """Drop a client that did not answer its liveness ping"""
+        idle = time.monotonic() - client_conn.last_seen
+        logger.warning(f"Closing unresponsive client {client_conn.client_id} - silent for {idle:.1f}s")
+        await self.remove_client(client_conn.client_id)
+        try:
+            await client_conn.transport.close()
+        except Exception as e:
+            logger.debug(f"Error closing {client_conn.client_id}: {e}")
+
+    def liveness_stats(self):
+        return self.liveness.stats() if self.liveness else None
+
     async def health_check(self, request):
         """HTTP health check endpoint"""
         return web.json_response({
@@ -356,171 +4185,219 @@ class M300WebSocketSimulator:
             "timestamp": datetime.now().isoformat(),
             "service": "M300 WebSocket Simulator",
             "version": "1.0.0",
-            "connected_clients": len(self.connected_clients),
+            "connected_clients": len(self.connected_clients) if self.client_counts is None else sum(self.client_counts),
             "data_points": len(self.sensor_data),
-            "history_records": len(self.data_history)
+            "history_records": len(self.data_history),
+            "cluster": self.cluster_stats(),
+            "history_capacity": self.data_history.capacity,
+            "history_segments": self.history_segments.stats() if self.history_segments else None,
+            "capture": self.capture_stats(),
+            "snapshot_version": self.snapshot_version,
+            "sample_period": self.sample_period,
+            "missed_ticks": self.missed_ticks,
+            "signal_seed": self.signals.seed,
+            "json_backend": JSON_BACKEND,
+            "binary_clients": sum(1 for c in self.connected_clients.values() if c.binary),
+            "encoding": self.encoding_report(),
+            "compression": self.compressor.stats() if self.compression else None,
+            "modbus": self.modbus_stats(),
+            "gateway": self.gateway_stats(),
+            "commands": self.command_stats(),
+            "fleet": None if self.fleet is None else {
+                **self.fleet.stats(),
+                "subscriptions": len(self.fleet_subscribers),
+                "frames_queued": self.fleet_frames
+            },
+            "delta": {
+                "clients": sum(1 for c in self.connected_clients.values() if c.delta),
+                "keyframe_interval": self.keyframe_interval,
+                "keyframes_sent": self.keyframes_sent,
+                "deltas_sent": self.deltas_sent
+            },
+            "frames_encoded": self.frames_encoded,
+            "subscription_groups": len(self.subscription_index),
+            "backpressure": self.backpressure_stats(),
+            "liveness": self.liveness_stats(),
+            "alarms": self.alarm_engine.stats() if self.alarm_engine else None,
+            "admission": self.admission_stats()
         })
+
+    def cluster_stats(self):
+        """Client counts across worker processes, None when running as a single process"""
+        if self.client_counts is None:
+            return None
+        return {
+            "workers": len(self.client_counts),
+            "worker_index": self.worker_index,
+            "worker_clients": len(self.connected_clients),
+            "per_worker": list(self.client_counts)
+        }
+
+    async def measure_loop_lag(self):
+        """Sample how late the event loop wakes a sleeping task"""
+        loop = asyncio.get_running_loop()
+        while self.running:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(loop.time() - expected, 0.0)
+            self.metrics.loop_lag_seconds.observe(lag)
+            self.metrics.loop_lag_last = lag
+
+    async def metrics_endpoint(self, request):
+        """Prometheus text exposition of the hot-path metrics"""
+        if self.metrics is None:
+            raise web.HTTPNotFound(text="Metrics are disabled")
+        metrics = self.metrics
+        clients = list(self.connected_clients.values())
+        lines = []
+
+        def sample(name, kind, help_text, value):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+        def histogram(name, help_text, source):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            source.render(lines, name)
+
+        sample("m300_connected_clients", "gauge", "Connected WebSocket clients", len(clients))
+        sample("m300_snapshot_version", "counter", "Snapshots published", self.snapshot_version)
+        sample("m300_missed_ticks_total", "counter", "Generator ticks skipped because sampling fell behind", self.missed_ticks)
+        sample("m300_frames_encoded_total", "counter", "Sensor frames encoded", self.frames_encoded)
+        sample("m300_frames_sent_total", "counter", "Frames written by client writer tasks",
+               metrics.closed_client_frames + sum(c.sent_count for c in clients))
+        sample("m300_bytes_sent_total", "counter", "Payload bytes written to WebSocket clients",
+               metrics.closed_client_bytes + metrics.response_bytes + sum(c.bytes_sent for c in clients))
+        sample("m300_dropped_frames_total", "counter", "Frames dropped by full outbound queues of connected clients",
+               sum(c.dropped_count for c in clients))
+        sample("m300_queued_frames", "gauge", "Frames waiting in outbound queues", sum(len(c.outbound) for c in clients))
+        sample("m300_send_failures_total", "counter", "Client sends that failed", metrics.send_failures)
+        sample("m300_slow_client_disconnects_total", "counter", "Clients disconnected for falling behind", self.dropped_clients)
+        sample("m300_rejected_connections_total", "counter", "Connections refused at MAX_CONNECTIONS", self.rejected_connections)
+        sample("m300_rate_limited_requests_total", "counter", "Requests refused by per-client rate limits", self.rate_limited_requests)
+        sample("m300_expensive_requests_waiting", "gauge", "Expensive requests waiting for a pool slot", self.expensive_waiting)
+        sample("m300_expensive_requests_rejected_total", "counter", "Expensive requests shed because too many were waiting", self.expensive_rejected)
+        sample("m300_event_loop_lag_seconds", "gauge", "Most recent event-loop lag sample", f"{metrics.loop_lag_last:.9g}")
+        histogram("m300_tick_duration_seconds", "Generation tick duration", metrics.tick_seconds)
+        histogram("m300_encode_duration_seconds", "Frame encode duration", metrics.encode_seconds)
+        histogram("m300_fanout_duration_seconds", "Time to queue one snapshot on every client", metrics.fanout_seconds)
+        histogram("m300_event_loop_lag_distribution_seconds", "Event-loop lag", metrics.loop_lag_seconds)
+
+        lines.append("# HELP m300_handler_duration_seconds Message handler latency by message type")
+        lines.append("# TYPE m300_handler_duration_seconds histogram")
+        for message_type, source in metrics.handler_seconds.items():
+            if source.count:
+                source.render(lines, "m300_handler_duration_seconds", f'type="{message_type}"')
+
+        return web.Response(text='\n'.join(lines) + '\n', headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    def backpressure_stats(self):
+        """Aggregate outbound queue counters across all clients"""
+        clients = list(self.connected_clients.values())
+        return {
+            "queue_size": self.queue_size,
+            "overflow_policy": self.overflow_policy,
+            "queued_frames": sum(len(c.outbound) for c in clients),
+            "max_queue_depth": max((c.max_queue_depth for c in clients), default=0),
+            "dropped_frames": sum(c.dropped_count for c in clients),
+            "coalesced_frames": sum(c.coalesced_count for c in clients),
+            "disconnected_slow_clients": self.dropped_clients
+        }
     
+    def snapshot_etag(self, *parts):
+        """Entity tag of the current snapshot, plus anything else the resource depends on"""
+        return '-'.join(str(part) for part in (self.snapshot_version, int(self.snapshot_epoch * 1000)) + parts)
+
+    def conditional_response(self, request, etag):
+        """Return a 304 when the client's copy is current, otherwise None"""
+        if_none_match = request.if_none_match
+        if if_none_match is not None:
+            fresh = any(tag.value == etag or tag.value == '*' for tag in if_none_match)
+        else:
+            # Last-Modified is the snapshot time rounded up to a whole second. When an earlier
+            # snapshot rounded to the same second the date cannot tell them apart, the ETag can
+            since = request.if_modified_since
+            fresh = since is not None and not self.snapshot_second_shared \
+                and math.ceil(self.snapshot_epoch) <= since.timestamp()
+        if not fresh:
+            return None
+        return self.set_validators(web.Response(status=304), etag)
+
+    def set_validators(self, response, etag):
+        response.etag = etag
+        response.last_modified = self.snapshot_epoch
+        # Let caches store it but always revalidate, a 304 is cheap
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    async def sensors_endpoint(self, request):
+        """Current sensor snapshot over plain HTTP"""
+        etag = self.snapshot_etag()
+        not_modified = self.conditional_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+        response = web.Response(text=self.get_snapshot_frame("sensor_update"), content_type='application/json')
+        return self.set_validators(response, etag)
+
+    async def history_endpoint(self, request):
+        """History over plain HTTP, taking the get_history parameters as query parameters"""
+        etag = self.snapshot_etag(self.history_generation)
+        not_modified = self.conditional_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        query = request.query
+        data = {key: query[key] for key in ("from", "to", "method") if key in query}
+        try:
+            for key in ("limit", "max_points"):
+                if key in query:
+                    data[key] = int(query[key])
+            if "channels" in query:
+                data["channels"] = [channel for value in query.getall("channels")
+                                    for channel in value.split(',') if channel]
+            async with self.expensive_request():
+                history = await self.read_history(data)
+        except (TypeError, ValueError) as e:
+            raise web.HTTPBadRequest(text=f"Invalid history query: {e}")
+        except RequestRejected as e:
+            raise web.HTTPServiceUnavailable(text=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+        response = web.Response(text=json_dumps(history), content_type='application/json')
+        return self.set_validators(response, etag)
+
+    async def stream_handler(self, request):
+        """Server-Sent Events stream carrying the same frames WebSocket clients get"""
+        self.admit_connection()
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
+        await response.prepare(request)
+        await self.serve_client(SseTransport(response, request))
+        return response
+
     async def websocket_handler(self, request):
         """HTTP to WebSocket upgrade handler"""
-        ws = web.WebSocketResponse()
-        await ws.prepare(request)
-        
-        # Convert aiohttp WebSocket to websockets-like interface
-        client_id = None
-        client_conn = None
-        
+        self.admit_connection()
+        ws = web.WebSocketResponse(protocols=(WS_PROTOCOL_JSON, WS_PROTOCOL_BINARY), compress=self.compression, autoping=False)
+        # Handshakes in flight count against the limit until the client is registered
+        self.admitting += 1
         try:
-            # Add client to tracking
-            self.client_counter += 1
-            client_id = f"client_{self.client_counter}"
-            
-            # Create a mock websocket object for compatibility
-            mock_websocket = type('MockWebSocket', (), {
-                'remote_address': (request.remote, 0),
-                'send': ws.send_str,
-                'close': ws.close
-            })()
-            
-            client_conn = ClientConnection(mock_websocket, client_id)
-            self.connected_clients[client_id] = client_conn
-            
-            logger.info(f"New HTTP-WS client connected: {client_id} from {request.remote} - Total clients: {len(self.connected_clients)}")
-            
-            # Send initial data
-            initial_message = {
-                "type": "initial_data",
-                "timestamp": datetime.now().isoformat(),
-                "client_id": client_id,
-                "sensors": self.sensor_data,
-                "system": {
-                    "gateway": "online",
-                    "sensors": {
-                        "digital": "active" if 'FLOW' in self.sensor_data else "inactive",
-                        "modbus": "active" if 'pH' in self.sensor_data else "inactive"
-                    },
-                    "data_points": len(self.sensor_data),
-                    "history_records": len(self.data_history),
-                    "connected_clients": len(self.connected_clients)
-                },
-                "status": "connected"
-            }
-            
-            await ws.send_str(json.dumps(initial_message))
-            logger.info(f"Sent initial data to {client_id}")
-            
-            # Handle messages
-            async for msg in ws:
-                if msg.type == WSMsgType.TEXT:
-                    try:
-                        data = json.loads(msg.data)
-                        await self.handle_http_ws_message(ws, data, client_conn)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON decode error from {client_id}: {e}")
-                        error_response = {
-                            "type": "error",
-                            "message": "Invalid JSON format",
-                            "timestamp": datetime.now().isoformat()
-                        }
-                        await ws.send_str(json.dumps(error_response))
-                elif msg.type == WSMsgType.ERROR:
-                    logger.error(f"WebSocket error from {client_id}: {ws.exception()}")
-                    break
-                elif msg.type == WSMsgType.CLOSE:
-                    logger.info(f"WebSocket closed for {client_id}")
-                    break
-                    
-        except Exception as e:
-            logger.error(f"Error in WebSocket handler for {client_id}: {e}")
+            await ws.prepare(request)
         finally:
-            # Cleanup
-            if client_id and client_id in self.connected_clients:
-                await self.remove_client(client_id)
-                
+            self.admitting -= 1
+
+        await self.serve_client(AiohttpTransport(ws, request, self.compressor if self.compression else None))
         return ws
-    
-    async def handle_http_ws_message(self, ws, data, client_conn):
-        """Handle messages from HTTP WebSocket clients"""
-        message_type = data.get("type", "unknown")
-        client_conn.update_activity()
-        
-        try:
-            if message_type == "get_sensors":
-                response = {
-                    "type": "sensor_data",
-                    "timestamp": datetime.now().isoformat(),
-                    "sensors": self.sensor_data,
-                    "status": "active"
-                }
-                await ws.send_str(json.dumps(response))
-                
-            elif message_type == "get_status":
-                response = {
-                    "type": "system_status",
-                    "timestamp": datetime.now().isoformat(),
-                    "system": {
-                        "gateway": "online",
-                        "sensors": {
-                            "digital": "active" if 'FLOW' in self.sensor_data else "inactive",
-                            "modbus": "active" if 'pH' in self.sensor_data else "inactive"
-                        },
-                        "data_points": len(self.sensor_data),
-                        "history_records": len(self.data_history),
-                        "connected_clients": len(self.connected_clients)
-                    }
-                }
-                await ws.send_str(json.dumps(response))
-                
-            elif message_type == "get_history":
-                limit = data.get("limit", 100)
-                response = {
-                    "type": "history_data",
-                    "timestamp": datetime.now().isoformat(),
-                    "history": self.data_history[-limit:],
-                    "total_records": len(self.data_history),
-                    "limit": limit
-                }
-                await ws.send_str(json.dumps(response))
-                
-            elif message_type == "clear_history":
-                self.data_history.clear()
-                response = {
-                    "type": "history_cleared",
-                    "message": "History cleared successfully",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await ws.send_str(json.dumps(response))
-                
-            elif message_type == "ping":
-                response = {
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat(),
-                    "client_id": client_conn.client_id
-                }
-                await ws.send_str(json.dumps(response))
-                
-            elif message_type == "get_client_info":
-                response = {
-                    "type": "client_info",
-                    "timestamp": datetime.now().isoformat(),
-                    "client_id": client_conn.client_id,
-                    "connected_since": client_conn.connected_at.isoformat(),
-                    "message_count": client_conn.message_count,
-                    "last_activity": client_conn.last_ping.isoformat()
-                }
-                await ws.send_str(json.dumps(response))
-                
-            else:
-                error_response = {
-                    "type": "error",
-                    "message": f"Unknown message type: {message_type}",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await ws.send_str(json.dumps(error_response))
-                
-        except Exception as e:
-            logger.error(f"Error handling HTTP-WS message type {message_type}: {e}")
-    
+
+    async def device_websocket_handler(self, request):
+        """WebSocket upgrade for one fleet device's stream"""
+        device_id = request.match_info['device_id']
+        if self.fleet is None or device_id not in self.fleet.index:
+            raise web.HTTPNotFound(text=f"Unknown device: {device_id}")
+        return await self.websocket_handler(request)
+
     def setup_http_app(self):
         """Setup HTTP application with WebSocket support"""
         self.app = web.Application()
@@ -538,8 +4415,13 @@ class M300WebSocketSimulator:
         # Add routes
         self.app.router.add_get('/', self.health_check)
         self.app.router.add_get('/health', self.health_check)
+        self.app.router.add_get('/metrics', self.metrics_endpoint)
+        self.app.router.add_get('/sensors', self.sensors_endpoint)
+        self.app.router.add_get('/history', self.history_endpoint)
+        self.app.router.add_get('/stream', self.stream_handler)
         self.app.router.add_get('/ws', self.websocket_handler)
         self.app.router.add_get('/websocket', self.websocket_handler)
+        self.app.router.add_get('/ws/{device_id}', self.device_websocket_handler)
         
         # Add CORS to all routes
         for route in list(self.app.router.routes()):
@@ -549,44 +4431,101 @@ class M300WebSocketSimulator:
         """Start combined HTTP and WebSocket server"""
         if port is None:
             port = int(os.environ.get('PORT', 8765))
-        
+
+        if self.worker_index:
+            # Only the first worker prints the banner
+            await self.serve(host, port)
+            return
+
         print(f"🚀 M300 WebSocket Simulator starting...")
         print(f"🌐 HTTP Server: http://{host}:{port}")
         print(f"🔌 WebSocket Endpoint: ws://{host}:{port}/ws")
         print(f"📱 Ready for Flutter app connections")
         print(f"🔄 Mock data generation: Active")
+        print(f"🧾 JSON encoder: {JSON_BACKEND}")
         print(f"📊 Message types supported:")
-        print(f"   - sensor_update (auto-broadcast every 3s)")
+        print(f"   - sensor_update (auto-broadcast every {self.sample_period:g}s)")
+        print(f"   - sensor_delta (changed keys only, connect with ?delta=1)")
+        print(f"   - resync (request a full keyframe after a sequence gap)")
+        print(f"   - subscribe/unsubscribe (channel groups: {', '.join(CHANNEL_GROUPS)} or keys, max_rate)")
         print(f"   - get_sensors (request current data)")
         print(f"   - get_status (request system status)")
-        print(f"   - get_history (request historical data)")
+        print(f"   - get_history (request historical data, with from/to/channels/max_points)")
         print(f"   - get_client_info (request client connection info)")
         print(f"   - clear_history (clear data history)")
         print(f"   - ping/pong (connection test)")
-        
+        print(f"   - get_schema (packed row layout for the {WS_PROTOCOL_BINARY} subprotocol)")
+        print(f"   - batch (several requests in one frame, add \"id\" to any request to pipeline it)")
+        print(f"   - set_actuator/command (device {'/'.join(COMMAND_DEVICES)}, value, command_id, answered with actuator_ack)")
+        if self.modbus_port and self.feed_port is None:
+            print(f"🏭 Modbus TCP Server: {self.modbus_host}:{self.modbus_port} (registers {', '.join(f'{c}={a}' for c, (a, _) in MODBUS_REGISTER_MAP.items())})")
+        if self.gateway_enabled and self.feed_port is None:
+            print(f"🔗 TCP Gateway: sensors on {self.digital_port}, actuators on {self.actuator_port}, controller {self.controller_host}:{self.controller_port}")
+        if self.record_file:
+            print(f"⏺️ Recording traffic to {self.record_file}")
+        if self.replay_file:
+            speed = f"{self.replay_speed:g}x" if self.replay_speed > 0 else "max speed"
+            print(f"⏯️ Replaying {self.replay_file} at {speed}{' in a loop' if self.replay_loop else ''}")
+        if self.history_dir:
+            print(f"💾 History segments: {self.history_dir}")
+        if self.fleet:
+            print(f"🚚 Fleet mode: {self.fleet.size} virtual gateways in {len(self.fleet.groups)} groups ({self.fleet.backend}), ws://{host}:{port}/ws/{{device_id}}")
+        if self.client_counts is not None:
+            print(f"🧩 Worker processes: {len(self.client_counts)} sharing port {port}")
+
+        await self.serve(host, port)
+
+    async def serve(self, host, port):
+        """Run the HTTP/WebSocket server until stopped"""
         # Store the event loop for broadcasting
         self.loop = asyncio.get_event_loop()
         
         # Setup HTTP app with WebSocket support
         self.setup_http_app()
         
+        # Workers read the producer's segments but never write them
+        self.open_history_segments(readonly=self.feed_port is not None)
+
+        # Generate data on this loop, or follow the producer process in multi-worker mode
+        if self.feed_port is None:
+            self.setup_mock_data()
+            self.start_modbus_server()
+            await self.start_gateway()
+        else:
+            self.generator_task = asyncio.create_task(self.consume_feed())
+
         # Start periodic client health check
         health_check_task = asyncio.create_task(self.periodic_client_check())
+        if self.metrics:
+            self.loop_lag_task = asyncio.create_task(self.measure_loop_lag())
+        if self.liveness:
+            self.liveness_task = asyncio.create_task(self.reap_idle_clients())
         
         try:
             # Start HTTP server with WebSocket support
             runner = web.AppRunner(self.app)
             await runner.setup()
-            site = web.TCPSite(runner, host, port)
+            # Workers share the port through SO_REUSEPORT
+            site = web.TCPSite(runner, host, port, reuse_port=self.worker_index is not None)
             await site.start()
-            
+
+            if self.worker_index:
+                logger.info(f"Worker {self.worker_index} serving on port {port}")
+                while self.running:
+                    await asyncio.sleep(1)
+                return
+
             print(f"✅ HTTP/WebSocket server started successfully!")
             print(f"💡 Connect your Flutter app to: ws://{host}:{port}/ws")
             print(f"🌐 Health check available at: http://{host}:{port}/health")
             print(f"📡 Testing with Postman:")
             print(f"   - HTTP: GET http://{host}:{port}/health")
+            print(f"   - HTTP: GET http://{host}:{port}/sensors, /history?limit=100")
+            print(f"   - SSE: GET http://{host}:{port}/stream")
             print(f"   - WebSocket: ws://{host}:{port}/ws")
             print(f"📈 Client health checks running every 30 seconds")
+            if self.liveness:
+                print(f"💓 Pinging clients idle for {self.liveness.interval:g}s, closing after {self.liveness.timeout:g}s without a reply")
             
             # Keep server running
             while self.running:
@@ -597,6 +4536,16 @@ class M300WebSocketSimulator:
             raise
         finally:
             health_check_task.cancel()
+            if self.loop_lag_task:
+                self.loop_lag_task.cancel()
+            if self.liveness_task:
+                self.liveness_task.cancel()
+            if self.generator_task:
+                self.generator_task.cancel()
+            self.stop_modbus_server()
+            await self.stop_gateway()
+            self.close_history_segments()
+            self.close_capture()
             if hasattr(self, 'app') and self.app:
                 await runner.cleanup()
     
@@ -614,8 +4563,54 @@ class M300WebSocketSimulator:
             logger.error(f"Server error: {e}")
             raise
 
+def run_worker(worker_index, host, port, feed_port, client_counts):
+    """Entry point of a worker process serving /ws from the producer's snapshot feed"""
+    simulator = M300WebSocketSimulator()
+    simulator.worker_index = worker_index
+    simulator.client_counts = client_counts
+    simulator.feed_port = feed_port
+    simulator.run(host=host, port=port)
+
+def run_cluster(host, port, workers):
+    """Run one producer process plus N workers accepting /ws on a shared port"""
+    feed_port = int(os.environ.get('FEED_PORT', 8899))
+    context = multiprocessing.get_context('spawn')
+    client_counts = context.Array('l', workers, lock=False)
+
+    processes = []
+    for worker_index in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(worker_index, host, port, feed_port, client_counts),
+            name=f"m300-worker-{worker_index}",
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    producer = M300WebSocketSimulator()
+    try:
+        asyncio.run(producer.run_feed_producer(feed_port))
+    except KeyboardInterrupt:
+        print("\n🛑 WebSocket cluster stopped by user")
+    finally:
+        producer.running = False
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+
 def main():
     """Main function to start the WebSocket simulator"""
+    workers = int(os.environ.get('WORKERS', 1))
+    if workers > 1:
+        # Scale-out mode: one sample producer, N worker processes on a shared port
+        host = os.environ.get('HOST', '0.0.0.0')
+        port = int(os.environ.get('PORT', 8765))
+        print(f"🧩 Starting {workers} worker processes on port {port}")
+        run_cluster(host, port, workers)
+        return
+
     simulator = M300WebSocketSimulator()
     
     # Check for environment variables